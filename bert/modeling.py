@@ -316,29 +316,98 @@ def get_activation(activation_string):
     raise ValueError("Unsupported activation: %s" % act)
 
 
+class VariableIndex(object):
+  """Looks up variables, and the optimizer slots of each, by name.
+
+  `variables` holds `tf.Variable`s or `(name, value)` pairs, e.g. the
+  `(name, shape)` pairs of `tf.train.list_variables` or of a checkpoint's
+  `get_variable_to_shape_map().items()`. Names are indexed without their
+  ":0" output suffix, and a name ending with one of `slot_suffixes` is
+  indexed as a slot of the variable it prefixes rather than as a variable,
+  so every lookup takes constant time.
+  """
+
+  SLOT_SUFFIXES = ("/adam_m", "/adam_v")
+
+  def __init__(self, variables, slot_suffixes=SLOT_SUFFIXES):
+    self._variables = collections.OrderedDict()
+    self._slots = collections.defaultdict(collections.OrderedDict)
+    for item in variables:
+      if isinstance(item, tuple):
+        (name, value) = item
+      else:
+        (name, value) = (item.name, item)
+      name = _strip_output_suffix(name)
+      for suffix in slot_suffixes:
+        if name.endswith(suffix):
+          self._slots[name[:-len(suffix)]][suffix[1:]] = value
+          break
+      else:
+        self._variables[name] = value
+
+  def __contains__(self, name):
+    return _strip_output_suffix(name) in self._variables
+
+  def __getitem__(self, name):
+    return self._variables[_strip_output_suffix(name)]
+
+  def __len__(self):
+    return len(self._variables)
+
+  def get(self, name, default=None):
+    return self._variables.get(_strip_output_suffix(name), default)
+
+  def names(self):
+    """Returns the names of the variables, without the slots."""
+    return list(self._variables)
+
+  def slots(self, name):
+    """Returns a dict from slot name (e.g. "adam_m") to slot of `name`."""
+    return dict(self._slots.get(_strip_output_suffix(name), {}))
+
+  def match(self, names):
+    """Splits `names` against the index in one pass.
+
+    Returns:
+      A tuple of the names found in the index, the names not found in it, and
+      the indexed names that are not in `names`, each in order.
+    """
+    matched = []
+    unmatched = []
+    for name in names:
+      if name in self:
+        matched.append(_strip_output_suffix(name))
+      else:
+        unmatched.append(name)
+    matched_set = set(matched)
+    missing = [name for name in self._variables if name not in matched_set]
+    return (matched, unmatched, missing)
+
+
+def _strip_output_suffix(name):
+  """Returns `name` without the ":<output index>" of a tensor name."""
+  m = re.match("^(.*):\\d+$", name)
+  if m is not None:
+    name = m.group(1)
+  return name
+
+
 def get_assignment_map_from_checkpoint(tvars, init_checkpoint):
   """Compute the union of the current variables and checkpoint variables."""
-  assignment_map = {}
   initialized_variable_names = {}
 
-  name_to_variable = collections.OrderedDict()
-  for var in tvars:
-    name = var.name
-    m = re.match("^(.*):\\d+$", name)
-    if m is not None:
-      name = m.group(1)
-    name_to_variable[name] = var
-
+  index = VariableIndex(tvars, slot_suffixes=())
   init_vars = tf.train.list_variables(init_checkpoint)
+  (matched, _, missing) = index.match([name for (name, _) in init_vars])
 
   assignment_map = collections.OrderedDict()
-  for x in init_vars:
-    (name, var) = (x[0], x[1])
-    if name not in name_to_variable:
-      continue
+  for name in matched:
     assignment_map[name] = name
     initialized_variable_names[name] = 1
     initialized_variable_names[name + ":0"] = 1
+  if missing:
+    tf.logging.info("%d variables are not in %s", len(missing),
+                    init_checkpoint)
 
   return (assignment_map, initialized_variable_names)
 
@@ -132,6 +132,25 @@ class BertModelTest(tf.test.TestCase):
     self.assertEqual(obj["vocab_size"], 99)
     self.assertEqual(obj["hidden_size"], 37)
 
+  def test_variable_index(self):
+    index = modeling.VariableIndex([
+        ("bert/w", [2, 3]),
+        ("bert/w/adam_m", [2, 3]),
+        ("bert/w/adam_v", [2, 3]),
+        ("bert/b:0", [3]),
+    ])
+
+    self.assertEqual(index.names(), ["bert/w", "bert/b"])
+    self.assertIn("bert/w:0", index)
+    self.assertNotIn("bert/w/adam_m", index)
+    self.assertEqual(index["bert/b"], [3])
+    self.assertEqual(index.slots("bert/w"),
+                     {"adam_m": [2, 3], "adam_v": [2, 3]})
+    self.assertEqual(index.slots("bert/b"), {})
+    self.assertEqual(
+        index.match(["bert/w:0", "output_bias"]),
+        (["bert/w"], ["output_bias"], ["bert/b"]))
+
   def run_tester(self, tester):
     with self.test_session() as sess:
       ops = tester.create_model()
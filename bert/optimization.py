@@ -18,11 +18,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import re
 import tensorflow as tf
 
 
-def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu):
+def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu,
+                     fused=False):
   """Creates an optimizer training op."""
   global_step = tf.train.get_or_create_global_step()
 
@@ -62,7 +64,8 @@ def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu):
       beta_1=0.9,
       beta_2=0.999,
       epsilon=1e-6,
-      exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"])
+      exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"],
+      fused=fused)
 
   if use_tpu:
     optimizer = tf.contrib.tpu.CrossShardOptimizer(optimizer)
@@ -94,8 +97,18 @@ class AdamWeightDecayOptimizer(tf.train.Optimizer):
                beta_2=0.999,
                epsilon=1e-6,
                exclude_from_weight_decay=None,
+               fused=False,
                name="AdamWeightDecayOptimizer"):
-    """Constructs a AdamWeightDecayOptimizer."""
+    """Constructs a AdamWeightDecayOptimizer.
+
+    If `fused` is true, the Adam m/v of all the variables that share a weight
+    decay setting are kept in one flat buffer and updated with a handful of
+    vectorized ops, which produces the same numbers. Flattening a gradient
+    and applying the update to its variable stay per-variable ops, 3 to 5 of
+    them instead of the 16 or so of the unfused update.
+    The slots are then named `<name>/decay/adam_m` etc. instead of
+    `<variable>/adam_m`.
+    """
     super(AdamWeightDecayOptimizer, self).__init__(False, name)
 
     self.learning_rate = learning_rate
@@ -104,9 +117,13 @@ class AdamWeightDecayOptimizer(tf.train.Optimizer):
     self.beta_2 = beta_2
     self.epsilon = epsilon
     self.exclude_from_weight_decay = exclude_from_weight_decay
+    self.fused = fused
 
   def apply_gradients(self, grads_and_vars, global_step=None, name=None):
     """See base class."""
+    if self.fused:
+      return self._apply_gradients_fused(grads_and_vars, name=name)
+
     assignments = []
     for (grad, param) in grads_and_vars:
       if grad is None or param is None:
@@ -156,6 +173,62 @@ class AdamWeightDecayOptimizer(tf.train.Optimizer):
            v.assign(next_v)])
     return tf.group(*assignments, name=name)
 
+  def _apply_gradients_fused(self, grads_and_vars, name=None):
+    """Applies the same update as `apply_gradients` on flat m/v buffers."""
+    groups = collections.OrderedDict([(True, []), (False, [])])
+    for (grad, param) in grads_and_vars:
+      if grad is None or param is None:
+        continue
+      param_name = self._get_variable_name(param.name)
+      groups[self._do_use_weight_decay(param_name)].append((grad, param))
+
+    assignments = []
+    with tf.variable_scope(None, default_name=self.get_name()):
+      for (use_weight_decay, group) in groups.items():
+        if not group:
+          continue
+        params = [param for (_, param) in group]
+        sizes = [param.shape.num_elements() for param in params]
+        grad = tf.concat(
+            [tf.reshape(tf.convert_to_tensor(grad), [-1]) for (grad, _) in group],
+            axis=0)
+
+        group_name = "decay" if use_weight_decay else "no_decay"
+        m = tf.get_variable(
+            name=group_name + "/adam_m",
+            shape=[sum(sizes)],
+            dtype=tf.float32,
+            trainable=False,
+            initializer=tf.zeros_initializer())
+        v = tf.get_variable(
+            name=group_name + "/adam_v",
+            shape=[sum(sizes)],
+            dtype=tf.float32,
+            trainable=False,
+            initializer=tf.zeros_initializer())
+
+        # The same element-wise update as in `apply_gradients`.
+        next_m = (
+            tf.multiply(self.beta_1, m) + tf.multiply(1.0 - self.beta_1, grad))
+        next_v = (
+            tf.multiply(self.beta_2, v) + tf.multiply(1.0 - self.beta_2,
+                                                      tf.square(grad)))
+
+        update = next_m / (tf.sqrt(next_v) + self.epsilon)
+
+        update_with_lr = self.learning_rate * update
+
+        # The parameters are updated in place rather than concatenated into a
+        # flat copy every step, so their weight decay is added per variable.
+        decay_with_lr = self.learning_rate * self.weight_decay_rate
+        for (var, value) in zip(params, tf.split(update_with_lr, sizes)):
+          var_update = tf.reshape(value, var.shape)
+          if use_weight_decay:
+            var_update += decay_with_lr * var
+          assignments.append(var.assign_sub(var_update))
+        assignments.extend([m.assign(next_m), v.assign(next_v)])
+    return tf.group(*assignments, name=name)
+
   def _do_use_weight_decay(self, param_name):
     """Whether to use L2 weight decay for `param_name`."""
     if not self.weight_decay_rate:
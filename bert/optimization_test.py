@@ -43,6 +43,50 @@ class OptimizationTest(tf.test.TestCase):
       w_np = sess.run(w)
       self.assertAllClose(w_np.flat, [0.4, 0.2, -0.5], rtol=1e-2, atol=1e-2)
 
+  def test_fused_adam(self):
+    values = []
+    for fused in [False, True]:
+      with tf.Graph().as_default() as graph:
+        w = tf.get_variable(
+            "w",
+            shape=[2, 3],
+            initializer=tf.constant_initializer([0.1, -0.2, -0.1, 0.3, 0.0,
+                                                 0.2]))
+        b = tf.get_variable(
+            "bias", shape=[3], initializer=tf.constant_initializer(0.1))
+        x = tf.constant([[0.4, 0.2], [-0.5, 0.3]])
+        y = tf.constant([[0.1, 0.2, 0.3], [-0.3, -0.2, -0.1]])
+        loss = tf.reduce_mean(tf.square(tf.matmul(x, w) + b - y))
+        tvars = tf.trainable_variables()
+        grads = tf.gradients(loss, tvars)
+        optimizer = optimization.AdamWeightDecayOptimizer(
+            learning_rate=0.2,
+            weight_decay_rate=0.01,
+            exclude_from_weight_decay=["bias"],
+            fused=fused)
+        train_op = optimizer.apply_gradients(zip(grads, tvars))
+        with self.test_session(graph=graph) as sess:
+          sess.run(tf.global_variables_initializer())
+          for _ in range(10):
+            sess.run(train_op)
+          values.append(sess.run(tvars))
+    for (value, fused_value) in zip(*values):
+      self.assertAllClose(value, fused_value, rtol=1e-6, atol=1e-6)
+
+  def test_fused_adam_op_count(self):
+    num_ops = []
+    for fused in [False, True]:
+      with tf.Graph().as_default() as graph:
+        tvars = [tf.get_variable("w_%d" % i, shape=[4, 3]) for i in range(20)]
+        loss = tf.add_n([tf.reduce_sum(tf.square(w)) for w in tvars])
+        grads = tf.gradients(loss, tvars)
+        optimizer = optimization.AdamWeightDecayOptimizer(
+            learning_rate=0.2, weight_decay_rate=0.01, fused=fused)
+        num_model_ops = len(graph.get_operations())
+        optimizer.apply_gradients(zip(grads, tvars))
+        num_ops.append(len(graph.get_operations()) - num_model_ops)
+    self.assertLess(2 * num_ops[1], num_ops[0])
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -19,6 +19,8 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import json
+import os
 import re
 import unicodedata
 import six
@@ -158,23 +160,130 @@ def whitespace_tokenize(text):
   return tokens
 
 
+# The word cache size of `FullTokenizer`s that enable the cache.
+DEFAULT_WORD_CACHE_SIZE = 100000
+
+
+def default_word_cache_file(vocab_file, do_lower_case):
+  """Returns the path of the persisted word cache beside `vocab_file`."""
+  return "%s.%s.word_cache.json" % (
+      vocab_file, "uncased" if do_lower_case else "cased")
+
+
 class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
-  def __init__(self, vocab_file, do_lower_case=True):
+  def __init__(self, vocab_file, do_lower_case=True, word_cache_size=0,
+               word_cache_file=None):
+    """Constructs a FullTokenizer.
+
+    Args:
+      vocab_file: The vocabulary file.
+      do_lower_case: Whether to lower case the input.
+      word_cache_size: Number of whitespace-separated words whose word pieces
+        are kept in an LRU cache, e.g. `DEFAULT_WORD_CACHE_SIZE`. 0, the
+        default, disables the cache.
+      word_cache_file: (optional) File the cache is warmed from, if it exists,
+        and written to by `save_word_cache`, e.g. `default_word_cache_file`.
+    """
     self.vocab = load_vocab(vocab_file)
     self.inv_vocab = {v: k for k, v in self.vocab.items()}
+    self.do_lower_case = do_lower_case
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
     self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
 
+    self.word_cache_size = word_cache_size
+    self.word_cache_file = word_cache_file
+    self.word_cache_hits = 0
+    self.word_cache_misses = 0
+    self._word_cache = collections.OrderedDict()
+    if word_cache_size and word_cache_file and tf.gfile.Exists(word_cache_file):
+      self._load_word_cache(word_cache_file)
+
   def tokenize(self, text):
+    if not self.word_cache_size:
+      split_tokens = []
+      for token in self.basic_tokenizer.tokenize(text):
+        for sub_token in self.wordpiece_tokenizer.tokenize(token):
+          split_tokens.append(sub_token)
+
+      return split_tokens
+
+    # `BasicTokenizer` never joins characters across whitespace once the text
+    # is cleaned, so every word can be tokenized (and cached) on its own.
+    text = convert_to_unicode(text)
     split_tokens = []
-    for token in self.basic_tokenizer.tokenize(text):
-      for sub_token in self.wordpiece_tokenizer.tokenize(token):
-        split_tokens.append(sub_token)
+    for word in self.basic_tokenizer._clean_and_split(text):
+      sub_tokens = self._word_cache.pop(word, None)
+      if sub_tokens is None:
+        self.word_cache_misses += 1
+        sub_tokens = tuple(
+            sub_token for token in self.basic_tokenizer.tokenize(word)
+            for sub_token in self.wordpiece_tokenizer.tokenize(token))
+        if len(self._word_cache) >= self.word_cache_size:
+          self._word_cache.popitem(last=False)
+      else:
+        self.word_cache_hits += 1
+      # (Re-)inserting moves the word to the most recently used end.
+      self._word_cache[word] = sub_tokens
+      split_tokens.extend(sub_tokens)
 
     return split_tokens
 
+  def word_cache_hit_rate(self):
+    """Returns the fraction of the words found in the word cache."""
+    lookups = self.word_cache_hits + self.word_cache_misses
+    return float(self.word_cache_hits) / lookups if lookups else 0.0
+
+  def word_cache_items(self):
+    """Returns the cached `(word, sub_tokens)` pairs, least recently used first."""
+    return list(self._word_cache.items())
+
+  def update_word_cache(self, items):
+    """Adds `(word, sub_tokens)` pairs as the most recently used words.
+
+    This merges the caches of other tokenizers of the same vocab, e.g. of
+    worker processes, before a single `save_word_cache`.
+    """
+    for (word, sub_tokens) in items:
+      self._word_cache.pop(word, None)
+      self._word_cache[word] = tuple(sub_tokens)
+      if len(self._word_cache) > self.word_cache_size:
+        self._word_cache.popitem(last=False)
+
+  def save_word_cache(self, word_cache_file=None):
+    """Writes the word cache, least recently used words first."""
+    word_cache_file = word_cache_file or self.word_cache_file
+    cache = {
+        "do_lower_case": self.do_lower_case,
+        "vocab_size": len(self.vocab),
+        "words": [[word, list(sub_tokens)]
+                  for (word, sub_tokens) in self.word_cache_items()],
+    }
+    # Write to a temporary file first so that concurrent readers never see a
+    # partial cache.
+    tmp_file = "%s.tmp-%d" % (word_cache_file, os.getpid())
+    with tf.gfile.GFile(tmp_file, "w") as writer:
+      writer.write(json.dumps(cache))
+    tf.gfile.Rename(tmp_file, word_cache_file, overwrite=True)
+
+  def _load_word_cache(self, word_cache_file):
+    """Warms the word cache from `word_cache_file` if it fits this tokenizer."""
+    with tf.gfile.GFile(word_cache_file, "r") as reader:
+      cache = json.loads(reader.read())
+    if (cache["do_lower_case"] != self.do_lower_case or
+        cache["vocab_size"] != len(self.vocab)):
+      tf.logging.warning("Ignoring word cache %s built for another vocab.",
+                         word_cache_file)
+      return
+    for (word, sub_tokens) in cache["words"][-self.word_cache_size:]:
+      if not all(sub_token in self.vocab for sub_token in sub_tokens):
+        tf.logging.warning("Ignoring word cache %s built for another vocab.",
+                           word_cache_file)
+        self._word_cache.clear()
+        return
+      self._word_cache[word] = tuple(sub_tokens)
+
   def convert_tokens_to_ids(self, tokens):
     return convert_by_vocab(self.vocab, tokens)
 
@@ -196,7 +305,6 @@ class BasicTokenizer(object):
   def tokenize(self, text):
     """Tokenizes a piece of text."""
     text = convert_to_unicode(text)
-    text = self._clean_text(text)
 
     # This was added on November 1st, 2018 for the multilingual and Chinese
     # models. This is also applied to the English models now, but it doesn't
@@ -204,9 +312,7 @@ class BasicTokenizer(object):
     # and generally don't have any Chinese data in them (there are Chinese
     # characters in the vocabulary because Wikipedia does have some Chinese
     # words in the English Wikipedia.).
-    text = self._tokenize_chinese_chars(text)
-
-    orig_tokens = whitespace_tokenize(text)
+    orig_tokens = self._clean_and_split(text)
     split_tokens = []
     for token in orig_tokens:
       if self.do_lower_case:
@@ -214,46 +320,66 @@ class BasicTokenizer(object):
         token = self._run_strip_accents(token)
       split_tokens.extend(self._run_split_on_punc(token))
 
-    output_tokens = whitespace_tokenize(" ".join(split_tokens))
-    return output_tokens
+    return split_tokens
+
+  def _clean_and_split(self, text):
+    """Runs `_clean_text`, `_tokenize_chinese_chars` and `whitespace_tokenize`.
+
+    This is a single pass over the characters of `text`.
+    """
+    output = []
+    word = []
+    for char in text:
+      char_class = _char_class(char)
+      if char_class & _CHAR_REMOVED:
+        continue
+      if char_class & _CHAR_SPLIT:
+        if word:
+          output.append("".join(word))
+          word = []
+      elif char_class & _CHAR_CHINESE:
+        if word:
+          output.append("".join(word))
+          word = []
+        output.append(char)
+      else:
+        word.append(char)
+    if word:
+      output.append("".join(word))
+    return output
 
   def _run_strip_accents(self, text):
     """Strips accents from a piece of text."""
+    # ASCII text has neither decompositions nor marks.
+    if not _NON_ASCII_RE.search(text):
+      return text
     text = unicodedata.normalize("NFD", text)
     output = []
     for char in text:
-      cat = unicodedata.category(char)
-      if cat == "Mn":
+      if _char_class(char) & _CHAR_NONSPACING_MARK:
         continue
       output.append(char)
     return "".join(output)
 
   def _run_split_on_punc(self, text):
     """Splits punctuation on a piece of text."""
-    chars = list(text)
-    i = 0
-    start_new_word = True
     output = []
-    while i < len(chars):
-      char = chars[i]
-      if _is_punctuation(char):
-        output.append([char])
-        start_new_word = True
-      else:
-        if start_new_word:
-          output.append([])
-        start_new_word = False
-        output[-1].append(char)
-      i += 1
-
-    return ["".join(x) for x in output]
+    start = 0
+    for (i, char) in enumerate(text):
+      if _char_class(char) & _CHAR_PUNCTUATION:
+        if start < i:
+          output.append(text[start:i])
+        output.append(char)
+        start = i + 1
+    if start < len(text):
+      output.append(text[start:])
+    return output
 
   def _tokenize_chinese_chars(self, text):
     """Adds whitespace around any CJK character."""
     output = []
     for char in text:
-      cp = ord(char)
-      if self._is_chinese_char(cp):
+      if _char_class(char) & _CHAR_CHINESE:
         output.append(" ")
         output.append(char)
         output.append(" ")
@@ -263,40 +389,45 @@ class BasicTokenizer(object):
 
   def _is_chinese_char(self, cp):
     """Checks whether CP is the codepoint of a CJK character."""
-    # This defines a "chinese character" as anything in the CJK Unicode block:
-    #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-    #
-    # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-    # despite its name. The modern Korean Hangul alphabet is a different block,
-    # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-    # space-separated words, so they are not treated specially and handled
-    # like the all of the other languages.
-    if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-        (cp >= 0x3400 and cp <= 0x4DBF) or  #
-        (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-        (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-        (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-        (cp >= 0x2B820 and cp <= 0x2CEAF) or
-        (cp >= 0xF900 and cp <= 0xFAFF) or  #
-        (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-      return True
-
-    return False
+    return _is_chinese_char(cp)
 
   def _clean_text(self, text):
     """Performs invalid character removal and whitespace cleanup on text."""
     output = []
     for char in text:
-      cp = ord(char)
-      if cp == 0 or cp == 0xfffd or _is_control(char):
+      char_class = _char_class(char)
+      if char_class & _CHAR_REMOVED:
         continue
-      if _is_whitespace(char):
+      if char_class & _CHAR_WHITESPACE:
         output.append(" ")
       else:
         output.append(char)
     return "".join(output)
 
 
+def _is_chinese_char(cp):
+  """Checks whether CP is the codepoint of a CJK character."""
+  # This defines a "chinese character" as anything in the CJK Unicode block:
+  #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
+  #
+  # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
+  # despite its name. The modern Korean Hangul alphabet is a different block,
+  # as is Japanese Hiragana and Katakana. Those alphabets are used to write
+  # space-separated words, so they are not treated specially and handled
+  # like the all of the other languages.
+  if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
+      (cp >= 0x3400 and cp <= 0x4DBF) or  #
+      (cp >= 0x20000 and cp <= 0x2A6DF) or  #
+      (cp >= 0x2A700 and cp <= 0x2B73F) or  #
+      (cp >= 0x2B740 and cp <= 0x2B81F) or  #
+      (cp >= 0x2B820 and cp <= 0x2CEAF) or
+      (cp >= 0xF900 and cp <= 0xFAFF) or  #
+      (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
+    return True
+
+  return False
+
+
 class WordpieceTokenizer(object):
   """Runs WordPiece tokenziation."""
 
@@ -305,6 +436,15 @@ class WordpieceTokenizer(object):
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
 
+    # Prefix tries of the vocab: `_trie` matches the first piece of a word,
+    # `_suffix_trie` the following pieces, with the "##" stripped.
+    self._trie = {}
+    self._suffix_trie = {}
+    for token in vocab:
+      _trie_insert(self._trie, token, token)
+      if token.startswith("##"):
+        _trie_insert(self._suffix_trie, token[2:], token)
+
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
 
@@ -336,16 +476,18 @@ class WordpieceTokenizer(object):
       start = 0
       sub_tokens = []
       while start < len(chars):
-        end = len(chars)
+        # Walk the trie as far as the characters go; the last vocab entry
+        # passed on the way is the longest match.
+        node = self._trie if start == 0 else self._suffix_trie
+        end = start
         cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
+        for i in range(start, len(chars)):
+          node = node.get(chars[i])
+          if node is None:
             break
-          end -= 1
+          if _TRIE_END in node:
+            cur_substr = node[_TRIE_END]
+            end = i + 1
         if cur_substr is None:
           is_bad = True
           break
@@ -359,6 +501,63 @@ class WordpieceTokenizer(object):
     return output_tokens
 
 
+# Key of the vocab entry that ends at a trie node. Never a single character.
+_TRIE_END = ""
+
+
+def _trie_insert(trie, key, value):
+  """Adds `key` to a nested dict trie, storing `value` where it ends."""
+  node = trie
+  for char in key:
+    node = node.setdefault(char, {})
+  node[_TRIE_END] = value
+
+
+# Bits of the character classes in `_char_class`.
+_CHAR_REMOVED = 1  # Dropped by `_clean_text`.
+_CHAR_WHITESPACE = 2  # `_is_whitespace`.
+_CHAR_SPLIT = 4  # Split on by `whitespace_tokenize`.
+_CHAR_PUNCTUATION = 8  # `_is_punctuation`.
+_CHAR_CHINESE = 16  # `_is_chinese_char`.
+_CHAR_NONSPACING_MARK = 32  # Unicode category "Mn".
+
+_NON_ASCII_RE = re.compile(u"[^\x00-\x7f]")
+
+# Classes of all the Basic Multilingual Plane codepoints, built on first use.
+_bmp_char_classes = None
+
+
+def _compute_char_class(char):
+  """Computes the class bits of `char` from its Unicode properties."""
+  cp = ord(char)
+  char_class = 0
+  if cp == 0 or cp == 0xfffd or _is_control(char):
+    char_class |= _CHAR_REMOVED
+  if _is_whitespace(char):
+    char_class |= _CHAR_WHITESPACE | _CHAR_SPLIT
+  if char.isspace():
+    char_class |= _CHAR_SPLIT
+  if _is_punctuation(char):
+    char_class |= _CHAR_PUNCTUATION
+  if _is_chinese_char(cp):
+    char_class |= _CHAR_CHINESE
+  if unicodedata.category(char) == "Mn":
+    char_class |= _CHAR_NONSPACING_MARK
+  return char_class
+
+
+def _char_class(char):
+  """Returns the class bits of `char`, looked up in a table for the BMP."""
+  global _bmp_char_classes
+  cp = ord(char)
+  if cp >= 0x10000:
+    return _compute_char_class(char)
+  if _bmp_char_classes is None:
+    _bmp_char_classes = bytearray(
+        _compute_char_class(six.unichr(i)) for i in range(0x10000))
+  return _bmp_char_classes[cp]
+
+
 def _is_whitespace(char):
   """Checks whether `chars` is a whitespace character."""
   # \t, \n, and \r are technically contorl characters but we treat them
@@ -48,6 +48,84 @@ class TokenizationTest(tf.test.TestCase):
     self.assertAllEqual(
         tokenizer.convert_tokens_to_ids(tokens), [7, 4, 5, 10, 8, 9])
 
+  def test_full_tokenizer_word_cache(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      if six.PY2:
+        vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+      else:
+        vocab_writer.write("".join(
+            [x + "\n" for x in vocab_tokens]).encode("utf-8"))
+
+      vocab_file = vocab_writer.name
+
+    word_cache_file = tokenization.default_word_cache_file(vocab_file, True)
+    tokenizer = tokenization.FullTokenizer(
+        vocab_file, word_cache_size=2, word_cache_file=word_cache_file)
+    uncached_tokenizer = tokenization.FullTokenizer(
+        vocab_file, word_cache_size=0)
+
+    text = u"UNwant\u00E9d,running unwanted\tUNwant\u00E9d,running"
+    self.assertAllEqual(tokenizer.tokenize(text),
+                        uncached_tokenizer.tokenize(text))
+    self.assertAllEqual(tokenizer.tokenize(text),
+                        uncached_tokenizer.tokenize(text))
+    self.assertEqual(tokenizer.word_cache_misses, 2)
+    self.assertEqual(tokenizer.word_cache_hits, 4)
+    self.assertAllClose(tokenizer.word_cache_hit_rate(), 4.0 / 6.0)
+
+    tokenizer.tokenize(u"wa runn")
+    self.assertEqual(len(tokenizer._word_cache), 2)
+
+    tokenizer.save_word_cache()
+    warm_tokenizer = tokenization.FullTokenizer(
+        vocab_file, word_cache_size=2, word_cache_file=word_cache_file)
+    os.unlink(vocab_file)
+    os.unlink(word_cache_file)
+
+    self.assertAllEqual(warm_tokenizer.tokenize(u"wa runn"), ["wa", "runn"])
+    self.assertEqual(warm_tokenizer.word_cache_hits, 2)
+    self.assertEqual(warm_tokenizer.word_cache_misses, 0)
+
+  def test_merged_word_cache(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      if six.PY2:
+        vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+      else:
+        vocab_writer.write("".join(
+            [x + "\n" for x in vocab_tokens]).encode("utf-8"))
+
+      vocab_file = vocab_writer.name
+
+    self.assertEqual(tokenization.FullTokenizer(vocab_file).word_cache_size, 0)
+
+    word_cache_file = tokenization.default_word_cache_file(vocab_file, True)
+    workers = [tokenization.FullTokenizer(vocab_file, word_cache_size=3)
+               for _ in range(2)]
+    workers[0].tokenize(u"unwanted running")
+    workers[1].tokenize(u"wa running")
+    merged = tokenization.FullTokenizer(
+        vocab_file, word_cache_size=3, word_cache_file=word_cache_file)
+    for worker in workers:
+      merged.update_word_cache(worker.word_cache_items())
+    merged.save_word_cache()
+
+    warm_tokenizer = tokenization.FullTokenizer(
+        vocab_file, word_cache_size=3, word_cache_file=word_cache_file)
+    os.unlink(vocab_file)
+    os.unlink(word_cache_file)
+
+    self.assertEqual(
+        [word for (word, _) in warm_tokenizer.word_cache_items()],
+        ["unwanted", "wa", "running"])
+
   def test_chinese(self):
     tokenizer = tokenization.BasicTokenizer()
 
@@ -63,6 +141,22 @@ class TokenizationTest(tf.test.TestCase):
         ["hello", "!", "how", "are", "you", "?"])
     self.assertAllEqual(tokenizer.tokenize(u"H\u00E9llo"), ["hello"])
 
+  def test_basic_tokenizer_char_classes(self):
+    tokenizer = tokenization.BasicTokenizer(do_lower_case=True)
+
+    self.assertAllEqual(
+        tokenizer.tokenize(u"a b\u0000c\uFFFDd\u200Be \u0301"),
+        ["a", "bcde"])
+    self.assertAllEqual(
+        tokenizer.tokenize(u"\u00C0b\u4E2D\uF900!\U0001F600"),
+        ["ab", u"\u4E2D", u"\u8C48", "!", u"\U0001F600"])
+
+    for cp in [0, 9, 32, 33, 65, 0x85, 0xA0, 0x301, 0x2028, 0x4E2D, 0xFFFD]:
+      char = six.unichr(cp)
+      self.assertEqual(
+          tokenization._char_class(char),
+          tokenization._compute_char_class(char))
+
   def test_basic_tokenizer_no_lower(self):
     tokenizer = tokenization.BasicTokenizer(do_lower_case=False)
 
@@ -90,6 +184,24 @@ class TokenizationTest(tf.test.TestCase):
     self.assertAllEqual(
         tokenizer.tokenize("unwantedX running"), ["[UNK]", "runn", "##ing"])
 
+  def test_wordpiece_tokenizer_longest_match(self):
+    vocab_tokens = [
+        "[UNK]", "a", "ab", "abc", "##", "##b", "##bc", "##c", "##d", "##ab",
+        "#"
+    ]
+
+    vocab = {}
+    for (i, token) in enumerate(vocab_tokens):
+      vocab[token] = i
+    tokenizer = tokenization.WordpieceTokenizer(vocab=vocab)
+
+    self.assertAllEqual(tokenizer.tokenize("abcd"), ["abc", "##d"])
+    self.assertAllEqual(tokenizer.tokenize("abd"), ["ab", "##d"])
+    self.assertAllEqual(tokenizer.tokenize("abab"), ["ab", "##ab"])
+    self.assertAllEqual(tokenizer.tokenize("acbc"), ["a", "##c", "##bc"])
+    self.assertAllEqual(tokenizer.tokenize("#b"), ["#", "##b"])
+    self.assertAllEqual(tokenizer.tokenize("abx"), ["[UNK]"])
+
   def test_convert_tokens_to_ids(self):
     vocab_tokens = [
         "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
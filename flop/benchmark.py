@@ -0,0 +1,318 @@
+"""Microbenchmarks for the FLOP pruning code path."""
+import os
+import sys
+sys.path.append(os.path.join(sys.path[0], "../bert"))
+import time
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+import common
+import nn
+import tokenization
+import modeling_flop
+import run_classifier
+import data_processor
+
+
+# GLUE task name to (processor, directory in the GLUE download).
+GLUE_TASKS = {
+    "cola": (data_processor.ColaProcessor, "CoLA"),
+    "mnli": (data_processor.MnliProcessor, "MNLI"),
+    "mrpc": (data_processor.MrpcProcessor, "MRPC"),
+    "qnli": (data_processor.QnliProcessor, "QNLI"),
+    "qqp": (data_processor.QqpProcessor, "QQP"),
+    "rte": (data_processor.RteProcessor, "RTE"),
+    "sst-2": (data_processor.Sst2Processor, "SST-2"),
+    "sts-b": (data_processor.StsProcessor, "STS-B"),
+    "wnli": (data_processor.WnliProcessor, "WNLI"),
+}
+
+
+def diag_gate(x, gate):
+    """The original masking, kept here as the benchmark baseline."""
+    return tf.matmul(x, tf.linalg.tensor_diag(gate))
+
+
+class SlicingWordpieceTokenizer(tokenization.WordpieceTokenizer):
+    """The original substring-slicing WordPiece, kept as the baseline."""
+
+    def tokenize(self, text):
+        text = tokenization.convert_to_unicode(text)
+
+        output_tokens = []
+        for token in tokenization.whitespace_tokenize(text):
+            chars = list(token)
+            if len(chars) > self.max_input_chars_per_word:
+                output_tokens.append(self.unk_token)
+                continue
+
+            is_bad = False
+            start = 0
+            sub_tokens = []
+            while start < len(chars):
+                end = len(chars)
+                cur_substr = None
+                while start < end:
+                    substr = "".join(chars[start:end])
+                    if start > 0:
+                        substr = "##" + substr
+                    if substr in self.vocab:
+                        cur_substr = substr
+                        break
+                    end -= 1
+                if cur_substr is None:
+                    is_bad = True
+                    break
+                sub_tokens.append(cur_substr)
+                start = end
+
+            if is_bad:
+                output_tokens.append(self.unk_token)
+            else:
+                output_tokens.extend(sub_tokens)
+        return output_tokens
+
+
+def time_op(sess, op, warmup_steps, steps):
+    """Returns the mean wall-clock time of `sess.run(op)` in milliseconds."""
+    for _ in range(warmup_steps):
+        sess.run(op)
+    start = time.time()
+    for _ in range(steps):
+        sess.run(op)
+    return (time.time() - start) / steps * 1000
+
+
+def benchmark_gate(batch_size, seq_length, ranks, warmup_steps, steps):
+    """Compares the diagonal-matrix mask with the broadcast mask.
+
+    For every rank a [batch_size * seq_length, rank] activation is gated with a
+    hard-concrete sample, and the forward plus backward pass (gradients with
+    respect to the activation and `log_alpha`) is timed for both
+    implementations.
+    """
+    results = []
+    for rank in ranks:
+        tf.reset_default_graph()
+        x = tf.get_variable(
+            "x",
+            shape=[batch_size * seq_length, rank],
+            initializer=tf.random_normal_initializer())
+        log_alpha = tf.get_variable(
+            "log_alpha",
+            shape=[rank],
+            initializer=tf.random_normal_initializer())
+        gate = common.hard_concrete_mean(log_alpha)
+        steps_ops = {}
+        outputs = {}
+        for name, gate_fn in [("diag", diag_gate), ("broadcast", nn.apply_gate)]:
+            output = gate_fn(x, gate)
+            loss = tf.reduce_sum(tf.square(output))
+            outputs[name] = output
+            steps_ops[name] = tf.gradients(loss, [x, log_alpha])
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        diag_output, broadcast_output = sess.run(
+            [outputs["diag"], outputs["broadcast"]])
+        max_diff = np.max(np.abs(diag_output - broadcast_output))
+        diag_ms = time_op(sess, steps_ops["diag"], warmup_steps, steps)
+        broadcast_ms = time_op(sess, steps_ops["broadcast"], warmup_steps, steps)
+        sess.close()
+        results.append((rank, diag_ms, broadcast_ms, max_diff))
+        tf.logging.info(
+            "rank=%d diag=%.3fms broadcast=%.3fms speedup=%.2fx max_abs_diff=%g",
+            rank, diag_ms, broadcast_ms, diag_ms / broadcast_ms, max_diff)
+    return results
+
+
+def benchmark_tokenizer(data_patterns, vocab_file, do_lower_case, repeats):
+    """Compares the slicing WordPiece with the trie-based one.
+
+    Every line of the files matching `data_patterns` is split into words by
+    `BasicTokenizer` up front, so only the WordPiece step is timed. The two
+    implementations must produce identical pieces.
+    """
+    vocab = tokenization.load_vocab(vocab_file)
+    basic_tokenizer = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
+    lines = []
+    for pattern in data_patterns:
+        for data_file in tf.gfile.Glob(pattern):
+            with tf.gfile.GFile(data_file, "r") as reader:
+                for line in reader:
+                    lines.append(" ".join(basic_tokenizer.tokenize(line)))
+    num_words = sum(len(line.split()) for line in lines)
+
+    results = {}
+    outputs = {}
+    for name, tokenizer_class in [
+            ("slicing", SlicingWordpieceTokenizer),
+            ("trie", tokenization.WordpieceTokenizer)]:
+        tokenizer = tokenizer_class(vocab=vocab)
+        start = time.time()
+        for _ in range(repeats):
+            outputs[name] = [tokenizer.tokenize(line) for line in lines]
+        seconds = (time.time() - start) / repeats
+        num_pieces = sum(len(pieces) for pieces in outputs[name])
+        results[name] = seconds
+        tf.logging.info("%s: %.0f words/sec, %.0f pieces/sec", name,
+                        num_words / seconds, num_pieces / seconds)
+    if outputs["slicing"] != outputs["trie"]:
+        raise ValueError("The trie WordPiece output differs from the slicing one.")
+    tf.logging.info("%d lines, %d words: trie is %.2fx faster, same output",
+                    len(lines), num_words, results["slicing"] / results["trie"])
+    return results
+
+
+def benchmark_padding(glue_dir, tasks, vocab_file, do_lower_case,
+                      bert_config_file, max_seq_length, batch_size,
+                      bucket_width, max_examples, warmup_steps, steps):
+    """Compares fixed padding with dynamic, length-bucketed padding.
+
+    For every task, (up to `max_examples` of) the train set is converted both
+    ways and a training step, the forward and backward pass of
+    `BertModelHardConcrete`, is timed on batches of the matching input
+    pipeline. Tokens/sec only counts real WordPieces, and the wall-clock per
+    epoch extrapolates the mean step time to the whole train set.
+    """
+    bert_config = modeling_flop.BertConfig.from_json_file(bert_config_file)
+    tokenizer = tokenization.FullTokenizer(
+        vocab_file=vocab_file, do_lower_case=do_lower_case,
+        word_cache_size=tokenization.DEFAULT_WORD_CACHE_SIZE)
+    bucket_boundaries = run_classifier.length_bucket_boundaries(
+        max_seq_length, bucket_width)
+    record_dir = tempfile.mkdtemp()
+    results = []
+    for task in tasks:
+        processor_class, task_dir = GLUE_TASKS[task]
+        processor = processor_class()
+        label_list = processor.get_labels()
+        examples = processor.get_train_examples(os.path.join(glue_dir, task_dir))
+        num_epoch_steps = len(examples) // batch_size
+        examples = examples[:max_examples]
+
+        task_results = {}
+        for name, dynamic_padding in [("fixed", False), ("dynamic", True)]:
+            record_file = os.path.join(record_dir, "%s-%s.tf_record" % (task, name))
+            run_classifier.file_based_convert_examples_to_features(
+                examples, label_list, max_seq_length, tokenizer, record_file,
+                pad_to_max_length=not dynamic_padding)
+            input_fn = run_classifier.file_based_input_fn_builder(
+                input_file=record_file,
+                seq_length=max_seq_length,
+                is_training=True,
+                drop_remainder=True,
+                sts=len(label_list) == 0,
+                batch_size=batch_size,
+                dynamic_padding=dynamic_padding,
+                bucket_boundaries=bucket_boundaries)
+
+            tf.reset_default_graph()
+            features = tf.data.make_one_shot_iterator(input_fn()).get_next()
+            model = modeling_flop.BertModelHardConcrete(
+                config=bert_config,
+                is_training=True,
+                input_ids=features["input_ids"],
+                input_mask=features["input_mask"],
+                token_type_ids=features["segment_ids"])
+            loss = tf.reduce_mean(tf.square(model.get_pooled_output()))
+            grads = [grad for grad in tf.gradients(loss, tf.trainable_variables())
+                     if grad is not None]
+            num_tokens = tf.reduce_sum(features["input_mask"])
+
+            sess = tf.Session()
+            sess.run(tf.global_variables_initializer())
+            for _ in range(warmup_steps):
+                sess.run(grads)
+            total_tokens = 0
+            start = time.time()
+            for _ in range(steps):
+                total_tokens += sess.run([grads, num_tokens])[1]
+            step_time = (time.time() - start) / steps
+            sess.close()
+
+            task_results[name] = step_time
+            tf.logging.info(
+                "%s %s padding: %.1fms/step, %.0f tokens/sec, %.1fmin/epoch",
+                task, name, step_time * 1000, total_tokens / (step_time * steps),
+                step_time * num_epoch_steps / 60)
+        tf.logging.info("%s: dynamic padding is %.2fx faster per epoch", task,
+                        task_results["fixed"] / task_results["dynamic"])
+        results.append((task, task_results["fixed"], task_results["dynamic"]))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    gate_parser = subparsers.add_parser(
+        "gate", help="diagonal-matrix vs broadcast hard-concrete gating")
+    gate_parser.add_argument("--batch_size", type=int, default=32)
+    gate_parser.add_argument("--max_seq_length", type=int, default=128)
+    gate_parser.add_argument(
+        "--ranks", default="768,3072",
+        help="comma separated mask widths, defaults to the BERT-base FFN masks")
+    gate_parser.add_argument("--warmup_steps", type=int, default=5)
+    gate_parser.add_argument("--steps", type=int, default=50)
+
+    padding_parser = subparsers.add_parser(
+        "padding", help="fixed vs dynamic, length-bucketed padding on GLUE")
+    padding_parser.add_argument("--glue_dir", help="GLUE data directory")
+    padding_parser.add_argument(
+        "--tasks", default="cola,mrpc,rte,sst-2",
+        help="comma separated GLUE tasks, e.g. cola,mrpc,rte,sst-2,qqp")
+    padding_parser.add_argument("--vocab_file", help="vocab file")
+    padding_parser.add_argument("--bert_config_file", help="bert config file")
+    padding_parser.add_argument(
+        "--do_lower_case", type=lambda x: x.lower() == "true", default=True)
+    padding_parser.add_argument("--max_seq_length", type=int, default=128)
+    padding_parser.add_argument("--batch_size", type=int, default=32)
+    padding_parser.add_argument("--bucket_width", type=int, default=16)
+    padding_parser.add_argument(
+        "--max_examples", type=int, default=20000,
+        help="number of train examples converted per task")
+    padding_parser.add_argument("--warmup_steps", type=int, default=3)
+    padding_parser.add_argument("--steps", type=int, default=20)
+
+    tokenizer_parser = subparsers.add_parser(
+        "tokenizer", help="slicing vs trie WordPiece throughput")
+    tokenizer_parser.add_argument(
+        "--data_files",
+        default=os.path.join(sys.path[0], "../datasets/*/*.tsv"),
+        help="comma separated glob patterns of the files to tokenize")
+    tokenizer_parser.add_argument("--vocab_file", help="vocab file")
+    tokenizer_parser.add_argument(
+        "--do_lower_case", type=lambda x: x.lower() == "true", default=True)
+    tokenizer_parser.add_argument("--repeats", type=int, default=3)
+
+    args = parser.parse_args()
+    tf.logging.set_verbosity(tf.logging.INFO)
+    if args.command == "gate":
+        benchmark_gate(
+            batch_size=args.batch_size,
+            seq_length=args.max_seq_length,
+            ranks=[int(r) for r in args.ranks.split(",")],
+            warmup_steps=args.warmup_steps,
+            steps=args.steps)
+    elif args.command == "tokenizer":
+        benchmark_tokenizer(
+            data_patterns=args.data_files.split(","),
+            vocab_file=args.vocab_file,
+            do_lower_case=args.do_lower_case,
+            repeats=args.repeats)
+    elif args.command == "padding":
+        benchmark_padding(
+            glue_dir=args.glue_dir,
+            tasks=args.tasks.split(","),
+            vocab_file=args.vocab_file,
+            do_lower_case=args.do_lower_case,
+            bert_config_file=args.bert_config_file,
+            max_seq_length=args.max_seq_length,
+            batch_size=args.batch_size,
+            bucket_width=args.bucket_width,
+            max_examples=args.max_examples,
+            warmup_steps=args.warmup_steps,
+            steps=args.steps)
+    else:
+        parser.print_help()
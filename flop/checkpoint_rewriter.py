@@ -0,0 +1,137 @@
+"""Rewrites checkpoints as NumPy arrays, without building the model graph."""
+import os
+import collections
+import numpy as np
+import tensorflow as tf
+from tensorflow.python import pywrap_tensorflow
+from tensorflow.python.ops import io_ops
+
+
+# Writes the source tensor under a new name.
+Rename = collections.namedtuple("Rename", ["source", "target"])
+# Writes the arrays returned by `split_fn(tensor)` under `targets`.
+Split = collections.namedtuple("Split", ["source", "targets", "split_fn"])
+# Writes `np.take(tensor, indices, axis)`, optionally with the kept entries
+# multiplied by `scale` along `axis`.
+Slice = collections.namedtuple(
+    "Slice", ["source", "target", "indices", "axis", "scale"])
+Slice.__new__.__defaults__ = (0, None)
+
+
+class MergedCheckpointReader(object):
+    """Reads the variables of several checkpoints as one.
+
+    A variable present in more than one checkpoint is read from the first
+    of them, e.g. a mask-only delta followed by its base checkpoint.
+    """
+
+    def __init__(self, *checkpoints):
+        self._readers = {}
+        self._shapes = {}
+        self._dtypes = {}
+        for checkpoint in checkpoints:
+            reader = pywrap_tensorflow.NewCheckpointReader(checkpoint)
+            dtypes = reader.get_variable_to_dtype_map()
+            for name, shape in reader.get_variable_to_shape_map().items():
+                if name not in self._readers:
+                    self._readers[name] = reader
+                    self._shapes[name] = shape
+                    self._dtypes[name] = dtypes[name]
+
+    def get_variable_to_shape_map(self):
+        return dict(self._shapes)
+
+    def get_variable_to_dtype_map(self):
+        return dict(self._dtypes)
+
+    def has_tensor(self, name):
+        return name in self._readers
+
+    def get_tensor(self, name):
+        return self._readers[name].get_tensor(name)
+
+
+class ArrayReader(object):
+    """Reads variables from a dict of arrays, e.g. tensors loaded once."""
+
+    def __init__(self, tensors):
+        self.tensors = tensors
+
+    def get_variable_to_shape_map(self):
+        return dict((name, list(np.shape(tensor)))
+                    for name, tensor in self.tensors.items())
+
+    def has_tensor(self, name):
+        return name in self.tensors
+
+    def get_tensor(self, name):
+        return self.tensors[name]
+
+
+def write_checkpoint(prefix, tensors):
+    """Writes `tensors`, a dict from variable name to array, to `prefix`.
+
+    The arrays are fed to a single `SaveV2` op, the only op of its graph, so
+    the result is a regular V2 checkpoint (`prefix.index` and
+    `prefix.data-*`) that any `tf.train.Saver` or `init_from_checkpoint`
+    can restore, written without building or initializing the model.
+    """
+    names = sorted(tensors)
+    directory = os.path.dirname(prefix)
+    if directory:
+        tf.gfile.MakeDirs(directory)
+    with tf.Graph().as_default():
+        placeholders = [
+            tf.placeholder(tf.as_dtype(np.asarray(tensors[name]).dtype),
+                           shape=np.shape(tensors[name]))
+            for name in names]
+        save_op = io_ops.save_v2(
+            prefix, names, [""] * len(names), placeholders)
+        with tf.Session() as sess:
+            sess.run(save_op, feed_dict=dict(
+                (placeholder, tensors[name])
+                for placeholder, name in zip(placeholders, names)))
+
+
+def apply_rules(reader, rules):
+    """Returns the dict of the arrays produced by `rules` from `reader`.
+
+    `rules` is a list of `Rename`, `Split` and `Slice`, each reading its
+    `source` variable from `reader`.
+    """
+    tensors = collections.OrderedDict()
+    for rule in rules:
+        tensor = reader.get_tensor(rule.source)
+        if isinstance(rule, Rename):
+            tensors[rule.target] = tensor
+        elif isinstance(rule, Split):
+            outputs = rule.split_fn(tensor)
+            if len(outputs) != len(rule.targets):
+                raise ValueError("Split of %s returned %d arrays for %d "
+                                 "targets" % (rule.source, len(outputs),
+                                              len(rule.targets)))
+            for target, output in zip(rule.targets, outputs):
+                tensors[target] = output
+        elif isinstance(rule, Slice):
+            output = np.take(tensor, rule.indices, axis=rule.axis)
+            if rule.scale is not None:
+                shape = [1] * output.ndim
+                shape[rule.axis] = -1
+                output = output * np.reshape(
+                    rule.scale, shape).astype(output.dtype)
+            tensors[rule.target] = output
+        else:
+            raise ValueError("Unknown checkpoint rule: %r" % (rule,))
+    return tensors
+
+
+def rewrite_checkpoint(reader, rules, prefix, tensors=None):
+    """Writes the arrays produced by `rules` from `reader` to `prefix`.
+
+    `tensors` adds arrays computed elsewhere, written as they are.
+    """
+    outputs = apply_rules(reader, rules)
+    if tensors:
+        outputs.update(tensors)
+    write_checkpoint(prefix, outputs)
+    return outputs
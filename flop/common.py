@@ -22,6 +22,7 @@ from __future__ import division
 from __future__ import print_function
 
 import tensorflow as tf
+import numpy as np
 import math
 
 # Small constant value to add when taking logs or sqrts to avoid NaNs
@@ -101,3 +102,21 @@ def hard_concrete_mean(
         stretched_values,
         clip_value_max=1.0,
         clip_value_min=0.0)
+
+
+def hard_concrete_mean_numpy(
+        log_alpha,
+        limit_l=LIMIT_L,
+        limit_r=LIMIT_R):
+    """NumPy version of `hard_concrete_mean` for values read from checkpoints.
+
+    Args:
+      log_alpha: np.ndarray of the log alpha parameters.
+      limit_l: The lower bound of the stretched distribution.
+      limit_r: The upper bound of the stretched distribution.
+    Returns:
+      A np.ndarray representing the calculated means.
+    """
+    log_alpha = np.asarray(log_alpha, dtype=np.float64)
+    stretched_values = 1.0 / (1.0 + np.exp(-log_alpha)) * (limit_r - limit_l) + limit_l
+    return np.clip(stretched_values, 0.0, 1.0)
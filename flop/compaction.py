@@ -0,0 +1,142 @@
+"""Physical compaction of dead FLOP mask dimensions during training."""
+import os
+import json
+import numpy as np
+import tensorflow as tf
+import checkpoint_rewriter
+
+
+COMPACTION_FILE = "compaction.json"
+SLOT_SUFFIXES = ["", "/adam_m", "/adam_v"]
+
+
+class CompactionHook(tf.train.SessionRunHook):
+    """Stops training once some mask dimensions have been dead for a while.
+
+    Every `every_n_steps` steps the `_g/log_alpha` variables are read, and a
+    dimension whose `log_alpha` is below `log_alpha_threshold` increments its
+    dead count (any check above the threshold resets it). Once at least
+    `min_dims` dimensions have been dead for `patience` consecutive checks,
+    the hook records them in `dead_indices` and requests a stop, so that the
+    caller can shrink the checkpoint with `compact_checkpoint` and resume
+    training on a smaller graph.
+    """
+
+    def __init__(self,
+                 every_n_steps,
+                 log_alpha_threshold=-10.0,
+                 patience=3,
+                 min_dims=1):
+        self.every_n_steps = every_n_steps
+        self.log_alpha_threshold = log_alpha_threshold
+        self.patience = patience
+        self.min_dims = min_dims
+        self.dead_indices = {}
+
+    def begin(self):
+        self.dead_indices = {}
+        self._dead_counts = {}
+        self._last_check = None
+        self._global_step = tf.train.get_global_step()
+        self._log_alphas = {}
+        for var in tf.global_variables():
+            if var.op.name.endswith("_g/log_alpha"):
+                self._log_alphas[var.op.name] = var
+
+    def before_run(self, run_context):
+        return tf.train.SessionRunArgs(self._global_step)
+
+    def after_run(self, run_context, run_values):
+        global_step = run_values.results
+        if self._last_check is None:
+            self._last_check = global_step
+        if global_step - self._last_check < self.every_n_steps:
+            return
+        self._last_check = global_step
+
+        log_alphas = run_context.session.run(self._log_alphas)
+        dead_indices = {}
+        for name, log_alpha in log_alphas.items():
+            counts = self._dead_counts.get(name, np.zeros(log_alpha.shape, np.int64))
+            counts = np.where(log_alpha < self.log_alpha_threshold, counts + 1, 0)
+            self._dead_counts[name] = counts
+            indices = np.flatnonzero(counts >= self.patience)
+            # Always keep one dimension so that no kernel becomes empty.
+            if len(indices) == len(log_alpha):
+                indices = indices[1:]
+            if len(indices):
+                dead_indices[name] = indices
+
+        num_dead = sum(len(indices) for indices in dead_indices.values())
+        if num_dead >= self.min_dims:
+            tf.logging.info("Compacting %d dead mask dimensions at step %d",
+                            num_dead, global_step)
+            self.dead_indices = dead_indices
+            run_context.request_stop()
+
+
+def load_compaction_state(model_dir):
+    """Returns the compaction state saved in `model_dir`, or None."""
+    path = os.path.join(model_dir, COMPACTION_FILE)
+    if not tf.gfile.Exists(path):
+        return None
+    with tf.gfile.GFile(path, "r") as reader:
+        return json.loads(reader.read())
+
+
+def compact_checkpoint(model_dir, dead_indices):
+    """Removes `dead_indices` from the latest checkpoint in `model_dir`.
+
+    The `_p` kernel columns, `_g/log_alpha` entries and `_q` kernel rows of
+    every dead dimension are sliced out, together with their Adam slots, and
+    the checkpoint is rewritten in place with the same global step.
+
+    Args:
+      model_dir: Estimator model directory.
+      dead_indices: Dict from `log_alpha` variable name to the indices to drop.
+    Returns:
+      The updated compaction state: `masked_layers_dim`, the new width of every
+      compacted `_p` kernel, and `prunable_parameters`, the size of the
+      uncompacted `_p`/`_q` kernels, which stays the denominator of the
+      expected sparsity.
+    """
+    checkpoint = tf.train.latest_checkpoint(model_dir)
+    reader = tf.train.load_checkpoint(checkpoint)
+    var_to_shape_map = reader.get_variable_to_shape_map()
+
+    state = load_compaction_state(model_dir)
+    if state is None:
+        prunable_parameters = 0
+        for name, shape in var_to_shape_map.items():
+            if name.endswith("_p/kernel") or name.endswith("_q/kernel"):
+                prunable_parameters += shape[0] * shape[1]
+        state = {"masked_layers_dim": {},
+                 "prunable_parameters": int(prunable_parameters)}
+
+    rules = dict((name, checkpoint_rewriter.Rename(name, name))
+                 for name in var_to_shape_map)
+    for log_alpha_name, indices in dead_indices.items():
+        base = log_alpha_name[:-len("_g/log_alpha")]
+        keep = np.setdiff1d(
+            np.arange(var_to_shape_map[log_alpha_name][0]), indices)
+        for suffix in SLOT_SUFFIXES:
+            for name, axis in [(base + "_p/kernel" + suffix, 1),
+                               (log_alpha_name + suffix, 0),
+                               (base + "_q/kernel" + suffix, 0)]:
+                if name in rules:
+                    rules[name] = checkpoint_rewriter.Slice(
+                        name, name, keep, axis=axis)
+        state["masked_layers_dim"][base + "_p/kernel"] = int(len(keep))
+
+    # Every tensor is read before the checkpoint is overwritten in place.
+    checkpoint_rewriter.rewrite_checkpoint(
+        reader, [rules[name] for name in sorted(rules)], checkpoint)
+
+    # The old meta graph describes the uncompacted shapes.
+    if tf.gfile.Exists(checkpoint + ".meta"):
+        tf.gfile.Remove(checkpoint + ".meta")
+    with tf.gfile.GFile(os.path.join(model_dir, COMPACTION_FILE), "w") as writer:
+        writer.write(json.dumps(state, indent=2, sort_keys=True))
+    tf.logging.info("Compacted %s: %s", checkpoint,
+                    json.dumps(state["masked_layers_dim"], sort_keys=True))
+    return state
@@ -0,0 +1,88 @@
+"""Tests of resuming training on a compacted checkpoint."""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../bert"))
+import numpy as np
+import tensorflow as tf
+import compaction
+import modeling_flop
+import run_classifier
+
+
+class CompactionTest(tf.test.TestCase):
+
+    def setUp(self):
+        self.model_dir = os.path.join(self.get_temp_dir(), "model")
+        self.warm_start_dir = os.path.join(self.get_temp_dir(), "warm_start")
+        self.bert_config = modeling_flop.BertConfig(
+            vocab_size=32,
+            hidden_size=16,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+            intermediate_size=24,
+            max_position_embeddings=16,
+            masked_layers_dim={})
+
+    def build_model_fn(self, init_checkpoint):
+        """Builds the eval graph of `self.bert_config` in the default graph."""
+        model_fn = run_classifier.model_fn_builder(
+            bert_config=self.bert_config,
+            num_labels=2,
+            init_checkpoint=init_checkpoint,
+            learning_rate=0,
+            num_train_steps=None,
+            num_warmup_steps=None,
+            learning_rate_warmup=0,
+            lambda_learning_rate=0,
+            alpha_learning_rate=0,
+            target_sparsity=0,
+            target_sparsity_warmup=0,
+            freeze_eval_masks=False)
+        features = {
+            "input_ids": tf.constant(np.ones([2, 8], np.int32)),
+            "input_mask": tf.constant(np.ones([2, 8], np.int32)),
+            "segment_ids": tf.constant(np.zeros([2, 8], np.int32)),
+            "label_ids": tf.constant(np.zeros([2], np.int32)),
+        }
+        tf.train.get_or_create_global_step()
+        return model_fn(features, None, tf.estimator.ModeKeys.EVAL, {},
+                        tf.estimator.RunConfig(model_dir=self.model_dir))
+
+    def test_resume_after_compaction(self):
+        with tf.Graph().as_default():
+            self.build_model_fn(init_checkpoint=None)
+            log_alpha = [var.op.name for var in tf.global_variables()
+                         if var.op.name.endswith("_g/log_alpha")][0]
+            saver = tf.train.Saver()
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                warm_start = saver.save(
+                    sess, os.path.join(self.warm_start_dir, "model.ckpt"))
+                saver.save(sess, os.path.join(self.model_dir, "model.ckpt"),
+                           global_step=0)
+
+        state = compaction.compact_checkpoint(
+            self.model_dir, {log_alpha: np.array([0, 1])})
+        self.bert_config.masked_layers_dim = state["masked_layers_dim"]
+
+        # The full width warm start no longer fits the compacted graph.
+        with tf.Graph().as_default():
+            with self.assertRaises(ValueError):
+                self.build_model_fn(init_checkpoint=warm_start)
+
+        with tf.Graph().as_default():
+            self.build_model_fn(init_checkpoint=None)
+            with tf.Session() as sess:
+                tf.train.Saver().restore(
+                    sess, tf.train.latest_checkpoint(self.model_dir))
+                variables = dict((var.op.name, var)
+                                 for var in tf.global_variables())
+                width = sess.run(variables[log_alpha]).shape[0]
+        self.assertEqual(
+            width, state["masked_layers_dim"][
+                log_alpha[:-len("_g/log_alpha")] + "_p/kernel"])
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -1,11 +1,14 @@
 import tensorflow as tf
 import tokenization
 import csv
+import itertools
 import os
 
 class InputExample(object):
   """A single training/test example for simple sequence classification."""
 
+  __slots__ = ("guid", "text_a", "text_b", "label")
+
   def __init__(self, guid, text_a, text_b=None, label=None):
     """Constructs a InputExample.
 
@@ -43,14 +46,93 @@ class DataProcessor(object):
     raise NotImplementedError()
 
   @classmethod
-  def _read_tsv(cls, input_file, quotechar=None):
-    """Reads a tab separated value file."""
+  def _read_tsv(cls, input_file, quotechar=None, start=0, stop=None):
+    """Yields the `(line number, row)` pairs of a tab separated value file.
+
+    Only the lines from `start` up to `stop` are parsed, the ones before are
+    skipped unparsed. Every line is a row, as no processor quotes fields.
+    """
     with tf.gfile.Open(input_file, "r") as f:
-      reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-      lines = []
-      for line in reader:
-        lines.append(line)
-      return lines
+      reader = csv.reader(itertools.islice(f, start, stop), delimiter="\t",
+                          quotechar=quotechar)
+      for (i, line) in enumerate(reader, start):
+        yield (i, line)
+
+
+def count_lines(input_file, block_size=1 << 20):
+  """Returns the number of lines of `input_file` without parsing them."""
+  num_lines = 0
+  last_block = b""
+  with tf.gfile.GFile(input_file, "rb") as f:
+    while True:
+      block = f.read(block_size)
+      if not block:
+        break
+      num_lines += block.count(b"\n")
+      last_block = block
+  if last_block and not last_block.endswith(b"\n"):
+    num_lines += 1
+  return num_lines
+
+
+class ExampleStream(object):
+  """The `InputExample`s of a data file, read lazily on every iteration.
+
+  `create_examples(lines, set_type)` turns the numbered rows of `input_file`
+  into examples one at a time, so iterating never holds more than one row and
+  one example in memory. A stream is picklable and can be sliced into the
+  streams of contiguous ranges of its rows after the header, whose examples
+  are read without parsing the rows before them.
+
+  `len()` counts the lines of the file instead of parsing it, less
+  `num_header_lines`. It is the number of examples when every row is an
+  example, and an upper bound for the processors that skip rows.
+  """
+
+  def __init__(self, create_examples, input_file, set_type,
+               num_header_lines=1, start=0, stop=None):
+    self.create_examples = create_examples
+    self.input_file = input_file
+    self.set_type = set_type
+    self.num_header_lines = num_header_lines
+    self.start = start
+    self.stop = stop
+    self._num_file_examples = None
+
+  def __iter__(self):
+    # Only the first slice reads the header, which `create_examples` skips by
+    # its line number.
+    start = self.start + self.num_header_lines if self.start else 0
+    stop = None
+    if self.stop is not None:
+      stop = self.stop + self.num_header_lines
+    return self.create_examples(
+        DataProcessor._read_tsv(self.input_file, start=start, stop=stop),
+        self.set_type)
+
+  def __len__(self):
+    if self._num_file_examples is None:
+      self._num_file_examples = max(
+          count_lines(self.input_file) - self.num_header_lines, 0)
+    stop = self._num_file_examples
+    if self.stop is not None:
+      stop = min(stop, self.stop)
+    return max(stop - self.start, 0)
+
+  def __getitem__(self, index):
+    if not isinstance(index, slice) or index.step not in (None, 1):
+      raise TypeError("ExampleStream only supports contiguous slices")
+    start, stop, _ = index.indices(len(self))
+    if index.stop is None:
+      # `len()` may be an upper bound, so an open slice reads to the end.
+      stop = None
+    else:
+      stop = self.start + stop
+    stream = ExampleStream(self.create_examples, self.input_file,
+                           self.set_type, self.num_header_lines,
+                           self.start + start, stop)
+    stream._num_file_examples = self._num_file_examples
+    return stream
 
 
 class XnliProcessor(DataProcessor):
@@ -61,40 +143,45 @@ class XnliProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    lines = self._read_tsv(
+    return ExampleStream(
+        self._create_train_examples,
         os.path.join(data_dir, "multinli",
-                     "multinli.train.%s.tsv" % self.language))
-    examples = []
-    for (i, line) in enumerate(lines):
+                     "multinli.train.%s.tsv" % self.language), "train")
+
+  def get_dev_examples(self, data_dir):
+    """See base class."""
+    return ExampleStream(
+        self._create_dev_examples, os.path.join(data_dir, "xnli.dev.tsv"),
+        "dev")
+
+  def _create_train_examples(self, lines, set_type):
+    """Yields the examples of the training set."""
+    for (i, line) in lines:
       if i == 0:
         continue
-      guid = "train-%d" % (i)
+      guid = "%s-%d" % (set_type, i)
       text_a = tokenization.convert_to_unicode(line[0])
       text_b = tokenization.convert_to_unicode(line[1])
       label = tokenization.convert_to_unicode(line[2])
       if label == tokenization.convert_to_unicode("contradictory"):
         label = tokenization.convert_to_unicode("contradiction")
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=text_b, label=label)
 
-  def get_dev_examples(self, data_dir):
-    """See base class."""
-    lines = self._read_tsv(os.path.join(data_dir, "xnli.dev.tsv"))
-    examples = []
-    for (i, line) in enumerate(lines):
+  def _create_dev_examples(self, lines, set_type):
+    """Yields the examples of the dev set in `self.language`."""
+    for (i, line) in lines:
       if i == 0:
         continue
-      guid = "dev-%d" % (i)
+      guid = "%s-%d" % (set_type, i)
       language = tokenization.convert_to_unicode(line[0])
       if language != tokenization.convert_to_unicode(self.language):
         continue
       text_a = tokenization.convert_to_unicode(line[6])
       text_b = tokenization.convert_to_unicode(line[7])
       label = tokenization.convert_to_unicode(line[1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=text_b, label=label)
 
   def get_labels(self):
     """See base class."""
@@ -106,28 +193,28 @@ class MnliProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev_matched.tsv")),
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "dev_matched.tsv"),
         "dev_matched")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test_matched.tsv")), "test")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "test_matched.tsv"),
+        "test")
 
   def get_labels(self):
     """See base class."""
     return ["contradiction", "entailment", "neutral"]
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    """Yields the examples of the training and dev sets."""
+    for (i, line) in lines:
       if i == 0:
         continue
       guid = "%s-%s" % (set_type, tokenization.convert_to_unicode(line[0]))
@@ -137,9 +224,8 @@ class MnliProcessor(DataProcessor):
         label = "contradiction"
       else:
         label = tokenization.convert_to_unicode(line[-1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class ColaProcessor(DataProcessor):
@@ -147,27 +233,28 @@ class ColaProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "train.tsv"), "train",
+        num_header_lines=0)
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "dev.tsv"), "dev",
+        num_header_lines=0)
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["0", "1"]
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    """Yields the examples of the training and dev sets."""
+    for (i, line) in lines:
       # Only the test set has a header
       if set_type == "test" and i == 0:
         continue
@@ -178,9 +265,8 @@ class ColaProcessor(DataProcessor):
       else:
         text_a = tokenization.convert_to_unicode(line[3])
         label = tokenization.convert_to_unicode(line[1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=None, label=label)
 
 
 class QnliProcessor(DataProcessor):
@@ -188,27 +274,26 @@ class QnliProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["not_entailment", "entailment"]
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    """Yields the examples of the training and dev sets."""
+    for (i, line) in lines:
       if i == 0:
         continue
       guid = "%s-%s" % (set_type, tokenization.convert_to_unicode(line[0]))
@@ -218,9 +303,8 @@ class QnliProcessor(DataProcessor):
         label = "not_entailment"
       else:
         label = tokenization.convert_to_unicode(line[-1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class QqpProcessor(DataProcessor):
@@ -228,27 +312,26 @@ class QqpProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["0", "1"]
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    """Yields the examples of the training and dev sets."""
+    for (i, line) in lines:
       if i == 0 or len(line) < 6:
         continue
       guid = "%s-%s" % (set_type, tokenization.convert_to_unicode(line[0]))
@@ -258,9 +341,8 @@ class QqpProcessor(DataProcessor):
         label = "0"
       else:
         label = tokenization.convert_to_unicode(line[-1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class RteProcessor(DataProcessor):
@@ -268,27 +350,26 @@ class RteProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["not_entailment", "entailment"]
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    """Yields the examples of the training and dev sets."""
+    for (i, line) in lines:
       if i == 0:
         continue
       guid = "%s-%s" % (set_type, tokenization.convert_to_unicode(line[0]))
@@ -298,9 +379,8 @@ class RteProcessor(DataProcessor):
         label = "not_entailment"
       else:
         label = tokenization.convert_to_unicode(line[-1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class Sst2Processor(DataProcessor):
@@ -308,27 +388,26 @@ class Sst2Processor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["0", "1"]
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    """Yields the examples of the training and dev sets."""
+    for (i, line) in lines:
       if i == 0:
         continue
       guid = "%s-%s" % (set_type, i)
@@ -337,9 +416,8 @@ class Sst2Processor(DataProcessor):
         label = "0"
       else:
         label = tokenization.convert_to_unicode(line[1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=None, label=label)
 
 
 class WnliProcessor(DataProcessor):
@@ -347,27 +425,26 @@ class WnliProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["0", "1"]
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    """Yields the examples of the training and dev sets."""
+    for (i, line) in lines:
       if i == 0:
         continue
       guid = "%s-%s" % (set_type, tokenization.convert_to_unicode(line[0]))
@@ -377,9 +454,8 @@ class WnliProcessor(DataProcessor):
         label = "0"
       else:
         label = tokenization.convert_to_unicode(line[-1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class MrpcProcessor(DataProcessor):
@@ -387,13 +463,15 @@ class MrpcProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "msr_paraphrase_train.txt")), "train")
+    return ExampleStream(
+        self._create_examples,
+        os.path.join(data_dir, "msr_paraphrase_train.txt"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "msr_paraphrase_test.txt")), "dev")
+    return ExampleStream(
+        self._create_examples,
+        os.path.join(data_dir, "msr_paraphrase_test.txt"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
@@ -404,9 +482,8 @@ class MrpcProcessor(DataProcessor):
     return ["0", "1"]
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    """Yields the examples of the training and dev sets."""
+    for (i, line) in lines:
       if i == 0:
         continue
       guid = "%s-%s-%s" % (set_type, 
@@ -415,9 +492,8 @@ class MrpcProcessor(DataProcessor):
       text_a = tokenization.convert_to_unicode(line[3])
       text_b = tokenization.convert_to_unicode(line[4])
       label = tokenization.convert_to_unicode(line[0])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+      yield InputExample(
+          guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 # Author: Colanim (https://github.com/Colanim)
@@ -427,33 +503,32 @@ class StsProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "dev.tsv"), "dev")
 
   # ADDED
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+    return ExampleStream(
+        self._create_examples, os.path.join(data_dir, "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return []
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    """Yields the examples of the training and dev sets."""
+    for (i, line) in lines:
         if i == 0:
             continue
         guid = "%s-%s" % (set_type, tokenization.convert_to_unicode(line[0]))
         text_a = tokenization.convert_to_unicode(line[-3])
         text_b = tokenization.convert_to_unicode(line[-2])
         label = float(line[-1])
-        examples.append(InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+        yield InputExample(
+            guid=guid, text_a=text_a, text_b=text_b, label=label)
@@ -1,16 +1,33 @@
 import re
 import os
 import copy
+import json
 import argparse
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 import sys
 sys.path.append(os.path.join(sys.path[0], "../bert"))
 import optimization_flop
 import modeling_flop
+import checkpoint_rewriter
 from tensorflow.python import pywrap_tensorflow
 import modeling
 
+# Optional, limits the BLAS threads of factorization workers that have
+# already loaded their BLAS library.
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+
+BLAS_THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                         "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"]
+# Every worker process loads its own TensorFlow, which outweighs the gain of
+# more workers than this by default.
+DEFAULT_MAX_WORKERS = 8
+
 def kernel_map(var_name):
     lst_one = var_name.split("/")
     lst_two = copy.deepcopy(lst_one)
@@ -35,87 +52,218 @@ def get_variable_name(param_name):
         param_name = m.group(1)
     return param_name
 
-def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
-                       labels, num_labels, finetuned):
-    model = modeling_flop.BertModelHardConcrete(
-        config=bert_config,
-        is_training=is_training,
-        input_ids=input_ids,
-        input_mask=input_mask,
-        token_type_ids=segment_ids,
-        factorize=True)
-    if finetuned:
-        num_labels = max(num_labels, 1)
-        output_layer = model.get_pooled_output()
-        hidden_size = output_layer.shape[-1].value
-        output_weights = tf.get_variable(
-            "output_weights", [num_labels, hidden_size],
-            initializer=tf.truncated_normal_initializer(stddev=0.02))
-        output_bias = tf.get_variable(
-            "output_bias", [num_labels], initializer=tf.zeros_initializer())
-
-
-def save_factorized_model(bert_config_file, init_checkpoint, output_dir, finetuned):
-    bert_config = modeling.BertConfig.from_json_file(bert_config_file)
-    input_ids = tf.constant([[31, 51, 99], [15, 5, 0]])
-    create_model(
-        bert_config=bert_config,
-        is_training=False,
-        input_ids=input_ids,
-        input_mask=None,
-        segment_ids=None,
-        labels=None,
-        num_labels=2,
-        finetuned=finetuned)
-    tvars = tf.trainable_variables()
-    tvars = tf.get_collection(tf.GraphKeys.VARIABLES)
-    total_parameters = 0
+def randomized_svd(matrix, rank, oversamples=10, power_iterations=2,
+                   seed=0):
+    """Returns the top `rank` singular triplets `u, s, vt` of `matrix`.
+
+    Uses a randomized range finder (Halko et al., 2011): `matrix` is
+    projected onto `rank + oversamples` random directions, sharpened by
+    `power_iterations` rounds of subspace iteration, and only that small
+    projection is decomposed exactly.
+    """
+    rng = np.random.RandomState(seed)
+    num_samples = min(rank + oversamples, min(matrix.shape))
+    omega = rng.standard_normal(
+        (matrix.shape[1], num_samples)).astype(matrix.dtype)
+    basis, _ = np.linalg.qr(matrix.dot(omega))
+    for _ in range(power_iterations):
+        basis, _ = np.linalg.qr(matrix.T.dot(basis))
+        basis, _ = np.linalg.qr(matrix.dot(basis))
+    u, s, vt = np.linalg.svd(basis.T.dot(matrix), full_matrices=False)
+    return basis.dot(u)[:, :rank], s[:rank], vt[:rank]
+
+
+def energy_rank(s, total_energy, energy):
+    """Returns the fewest singular values of `s` retaining `energy`.
+
+    `energy` is the fraction of `total_energy`, the squared Frobenius norm
+    of the matrix, to keep.
+    """
+    retained = np.cumsum(np.square(s, dtype=np.float64)) / total_energy
+    return min(int(np.searchsorted(retained, energy - 1e-12)) + 1, len(s))
+
+
+def break_even_rank(shape):
+    """Returns the largest rank whose factors are no larger than `shape`.
+
+    A rank `r` factorization of an [m, n] kernel holds `r * (m + n)`
+    parameters, at most the `m * n` of the kernel for `r <= mn / (m + n)`.
+    """
+    m, n = shape
+    return max(m * n // (m + n), 1)
+
+
+def factorize_kernel(kernel, rank=None, energy=None, method="truncated"):
+    """Factorizes `kernel` into `p` [input, r] and `q` [r, output].
+
+    `p` holds the left singular vectors and `q` the right ones scaled by the
+    singular values, so `p.dot(q)` is the best rank `r` approximation of
+    `kernel`. `r` is at most `rank` and, if `energy` is given, the fewest
+    singular values keeping that fraction of the squared Frobenius norm.
+    `rank` defaults to `break_even_rank(kernel.shape)`, so `p` and `q` never
+    hold more parameters than `kernel`. `method` is "truncated" for a thin
+    exact SVD or "randomized" for `randomized_svd`, which is much faster
+    when `rank` is well below `min(kernel.shape)`.
+    """
+    max_rank = min(kernel.shape)
+    if rank is None:
+        rank = break_even_rank(kernel.shape)
+    rank = min(rank, max_rank)
+    if method == "randomized":
+        u, s, vt = randomized_svd(kernel, rank)
+    elif method == "truncated":
+        u, s, vt = np.linalg.svd(kernel, full_matrices=False)
+    else:
+        raise ValueError("Unknown SVD method: %s" % method)
+    if energy is not None:
+        total_energy = np.sum(np.square(kernel, dtype=np.float64))
+        rank = min(rank, energy_rank(s, total_energy, energy))
+    p_mat = u[:, :rank]
+    q_mat = s[:rank, None] * vt[:rank]
+    return p_mat, q_mat
+
+
+# The checkpoint reader of a factorization worker process.
+_worker_reader = None
+
+
+def _init_factorize_worker(init_checkpoint, blas_threads):
+    """Opens the checkpoint once per worker and caps its BLAS threads."""
+    global _worker_reader
+    _worker_reader = pywrap_tensorflow.NewCheckpointReader(init_checkpoint)
+    if threadpoolctl is not None and blas_threads > 0:
+        threadpoolctl.threadpool_limits(limits=blas_threads, user_api="blas")
+
+
+def _factorize_worker_kernel(args):
+    """Factorizes one kernel read by the worker, see `factorize_kernel`."""
+    key, rank, energy, method = args
+    kernel = _worker_reader.get_tensor(key)
+    p_mat, q_mat = factorize_kernel(
+        kernel, rank=rank, energy=energy, method=method)
+    return key, kernel.size, p_mat, q_mat
+
+
+def factorize_kernels(init_checkpoint, keys, rank=None, energy=None,
+                      method="truncated", layer_ranks=None, num_workers=1,
+                      blas_threads=1):
+    """Yields `(key, kernel_size, p, q)` for the kernels `keys` of a checkpoint.
+
+    With `num_workers > 1` the kernels are factorized by a pool of processes
+    that each read their kernels from `init_checkpoint` and use at most
+    `blas_threads` BLAS threads, so the workers share the cores instead of
+    oversubscribing them. Every worker loads TensorFlow, so the pool never
+    has more workers than kernels. Results are yielded as soon as they are
+    ready, in no particular order.
+    """
+    layer_ranks = layer_ranks or {}
+    tasks = [(key, layer_ranks.get(key, rank), energy, method)
+             for key in keys]
+    num_workers = min(num_workers, len(tasks))
+    if num_workers <= 1:
+        _init_factorize_worker(init_checkpoint, 0)
+        for task in tasks:
+            yield _factorize_worker_kernel(task)
+        return
+
+    # Spawned workers start their BLAS library with these limits; threadpoolctl
+    # also covers libraries that ignore the environment.
+    saved_environ = dict((name, os.environ.get(name))
+                         for name in BLAS_THREAD_VARIABLES)
+    for name in BLAS_THREAD_VARIABLES:
+        os.environ[name] = str(blas_threads)
+    try:
+        # TensorFlow is not fork-safe, so the workers are spawned.
+        pool = multiprocessing.get_context("spawn").Pool(
+            num_workers,
+            initializer=_init_factorize_worker,
+            initargs=(init_checkpoint, blas_threads))
+    finally:
+        for name, value in saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    try:
+        for result in pool.imap_unordered(_factorize_worker_kernel, tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def save_factorized_model(bert_config_file, init_checkpoint, output_dir,
+                          finetuned, rank=None, energy=None,
+                          svd_method="truncated", layer_ranks=None,
+                          num_workers=1, blas_threads=1):
+    """Factorizes the encoder kernels of `init_checkpoint` into `output_dir`.
+
+    Every kernel is factorized with `factorize_kernel`, using its entry in
+    `layer_ranks` (a dict from kernel name to rank) or else `rank`, by
+    `num_workers` processes, see `factorize_kernels`. The widths of the `_p`
+    kernels are written as `masked_layers_dim` to the `bert_config.json`
+    next to the output checkpoint, which the factorized model has to be
+    built with. The checkpoint is written from the arrays with
+    `checkpoint_rewriter`, without building the model.
+    """
     reader = pywrap_tensorflow.NewCheckpointReader(init_checkpoint)
     var_to_shape_map = reader.get_variable_to_shape_map()
     kernel_pattern = "^bert/encoder/.*((query|key|value)|(dense))/kernel$"
     bias_pattern = "^bert/encoder/.*((query|key|value)|(dense))/bias$"
-    tvars_names = []
-    sess = tf.Session()
-    sess.run(tf.global_variables_initializer())
-    for var in tvars:
-        tf.logging.info(var.name)
-        tvars_names.append(var.name)
-    for key in var_to_shape_map:
+
+    factors = {}
+    masked_layers_dim = {}
+    original_params = 0
+    factorized_params = 0
+    kernel_keys = sorted(key for key in var_to_shape_map
+                         if re.match(kernel_pattern, key))
+    for key, kernel_size, p_mat, q_mat in factorize_kernels(
+            init_checkpoint, kernel_keys, rank=rank, energy=energy,
+            method=svd_method, layer_ranks=layer_ranks,
+            num_workers=num_workers, blas_threads=blas_threads):
+        factors[key] = (p_mat, q_mat)
+        masked_layers_dim[get_variable_name(kernel_map(key)[0])] = int(
+            p_mat.shape[1])
+        original_params += kernel_size
+        factorized_params += p_mat.size + q_mat.size
+        tf.logging.info("Factorized %s %s to rank %d", key,
+                        str(var_to_shape_map[key]), p_mat.shape[1])
+    tf.logging.info("Dense parameters: %d original, %d factorized",
+                    original_params, factorized_params)
+
+    # The factorized model has the variables of the BERT model, with every
+    # encoder kernel and bias moved to its `_p`/`_q` layers, and the output
+    # layer of fine-tuned checkpoints.
+    index = modeling.VariableIndex(var_to_shape_map.items())
+    rules = []
+    for key in sorted(index.names()):
         if re.match(bias_pattern, key):
             q = bias_map(key)
-            q_var = [v for v in tvars if v.name == q][0]
-            tf.logging.info("Tensor: %s %s", q, "*INIT_FROM_CKPT*")
-            sess.run(tf.assign(q_var, reader.get_tensor(key)))
-            tvars_names.remove(q)
-        elif re.match(kernel_pattern, key):
-            p, q = kernel_map(key)
-            p_var = [v for v in tvars if v.name == p][0]
-            q_var = [v for v in tvars if v.name == q][0]
-            u, s, v = np.linalg.svd(reader.get_tensor(key))
-            smat = np.zeros((u.shape[0], v.shape[0]))
-            smat[:s.shape[0], :s.shape[0]] = np.diag(s)
-            q_mat = np.dot(smat, v)
-            p_mat = u
-            tf.logging.info("Tensor: %s %s", p, "*INIT_FROM_CKPT*")
             tf.logging.info("Tensor: %s %s", q, "*INIT_FROM_CKPT*")
-            sess.run(tf.assign(p_var, p_mat))
-            sess.run(tf.assign(q_var, q_mat))
-            tvars_names.remove(p)
-            tvars_names.remove(q)
-            pass
-        elif key + ":0" in tvars_names:
-            var = [v for v in tvars if v.name == key + ":0"][0]
+            rules.append(checkpoint_rewriter.Rename(key, get_variable_name(q)))
+        elif key not in factors and (
+                key.startswith("bert/") or
+                (finetuned and key in ["output_weights", "output_bias"])):
             tf.logging.info("Tensor: %s %s", key + ":0", "*INIT_FROM_CKPT*")
-            sess.run(tf.assign(var, reader.get_tensor(key)))
-            tvars_names.remove(key + ":0")
-            pass
-        else:
-            tf.logging.info("PASSED: %s ", key)
-            pass
-    for var_name in tvars_names:
-        tf.logging.info("Tensor: %s %s", var_name, "*NOT_INIT_FROM_CKPT*")
-    saver = tf.train.Saver()
-    saver.save(sess, output_dir)
+            rules.append(checkpoint_rewriter.Rename(key, key))
+    _, _, passed = index.match(
+        [rule.source for rule in rules] + sorted(factors))
+    for key in passed:
+        tf.logging.info("PASSED: %s ", key)
+    tensors = {}
+    for key in sorted(factors):
+        p, q = kernel_map(key)
+        tf.logging.info("Tensor: %s %s", p, "*INIT_FROM_CKPT*")
+        tf.logging.info("Tensor: %s %s", q, "*INIT_FROM_CKPT*")
+        tensors[get_variable_name(p)], tensors[get_variable_name(q)] = (
+            factors[key])
+    checkpoint_rewriter.rewrite_checkpoint(reader, rules, output_dir, tensors)
+
+    bert_config = modeling_flop.BertConfig.from_json_file(bert_config_file)
+    bert_config.masked_layers_dim = masked_layers_dim
+    config_file = os.path.join(os.path.dirname(output_dir), "bert_config.json")
+    with tf.gfile.GFile(config_file, "w") as writer:
+        writer.write(bert_config.to_json_string())
 
 
 if __name__ == "__main__":
@@ -126,10 +274,45 @@ if __name__ == "__main__":
     parser.add_argument(
         "--finetuned", help="whether the checkpoint is finetuned, " +
         "if true then output layer will be loaded", action='store_true')
+    parser.add_argument(
+        "--rank", type=int, default=None,
+        help="maximum rank of every factorized kernel, " +
+        "default is input * output / (input + output), where the " +
+        "factors are as large as the kernel")
+    parser.add_argument(
+        "--energy", type=float, default=None,
+        help="if set, the fraction of the squared Frobenius norm of each " +
+        "kernel to keep, e.g. 0.9, which picks the rank per layer")
+    parser.add_argument(
+        "--svd", default="truncated", choices=["truncated", "randomized"],
+        help="exact thin SVD or randomized SVD, which is faster for a " +
+        "small --rank")
+    parser.add_argument(
+        "--layer_ranks", default=None,
+        help="json file mapping kernel names to their rank, " +
+        "overriding --rank for those kernels")
+    parser.add_argument(
+        "--num_workers", type=int, default=0,
+        help="number of factorization processes, 0 for one per core " +
+        "up to %d" % DEFAULT_MAX_WORKERS)
+    parser.add_argument(
+        "--blas_threads", type=int, default=1,
+        help="BLAS threads of every factorization process")
     args = parser.parse_args()
     tf.logging.set_verbosity(tf.logging.DEBUG)
+    layer_ranks = None
+    if args.layer_ranks:
+        with tf.gfile.GFile(args.layer_ranks, "r") as reader:
+            layer_ranks = json.load(reader)
     save_factorized_model(
         bert_config_file=args.bert_config_file,
         init_checkpoint=args.checkpoint,
         output_dir=args.output_dir,
-        finetuned=args.finetuned)
+        finetuned=args.finetuned,
+        rank=args.rank,
+        energy=args.energy,
+        svd_method=args.svd,
+        layer_ranks=layer_ranks,
+        num_workers=args.num_workers or min(
+            multiprocessing.cpu_count(), DEFAULT_MAX_WORKERS),
+        blas_threads=args.blas_threads)
@@ -0,0 +1,73 @@
+"""Tests of the kernel factorization of factorize."""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../bert"))
+import numpy as np
+import tensorflow as tf
+import factorize
+
+
+def low_rank_matrix(m, n, rank, seed=0):
+    """Returns an [m, n] matrix of `rank` with decaying singular values."""
+    rng = np.random.RandomState(seed)
+    u, _ = np.linalg.qr(rng.randn(m, rank))
+    v, _ = np.linalg.qr(rng.randn(n, rank))
+    s = 2.0 ** -np.arange(rank)
+    return (u * s).dot(v.T)
+
+
+class FactorizeTest(tf.test.TestCase):
+
+    def test_randomized_svd_matches_thin_svd(self):
+        matrix = low_rank_matrix(40, 30, 12)
+        u, s, vt = factorize.randomized_svd(matrix, 8)
+        _, exact_s, _ = np.linalg.svd(matrix, full_matrices=False)
+        self.assertEqual(u.shape, (40, 8))
+        self.assertEqual(vt.shape, (8, 30))
+        self.assertAllClose(s, exact_s[:8], atol=1e-8)
+        # Eckart-Young: the best rank 8 error is the norm of the tail.
+        error = np.linalg.norm(matrix - (u * s).dot(vt))
+        self.assertAllClose(error, np.linalg.norm(exact_s[8:]), atol=1e-8)
+
+    def test_energy_rank(self):
+        s = np.array([3.0, 2.0, 1.0, 1.0])
+        total_energy = np.sum(np.square(s))
+        self.assertEqual(factorize.energy_rank(s, total_energy, 0.5), 1)
+        self.assertEqual(factorize.energy_rank(s, total_energy, 0.7), 2)
+        # 13 of 15 is kept exactly at two singular values.
+        self.assertEqual(factorize.energy_rank(s, total_energy, 13 / 15.0), 2)
+        self.assertEqual(factorize.energy_rank(s, total_energy, 1.0), 4)
+
+    def test_factorize_kernel_energy(self):
+        kernel = low_rank_matrix(20, 10, 6)
+        p_mat, q_mat = factorize.factorize_kernel(kernel, energy=0.99)
+        self.assertEqual(p_mat.shape, (20, 4))
+        self.assertEqual(q_mat.shape, (4, 10))
+        retained = np.sum(np.square(p_mat.dot(q_mat)))
+        self.assertGreaterEqual(retained, 0.99 * np.sum(np.square(kernel)))
+
+    def test_default_rank_cap(self):
+        self.assertEqual(factorize.break_even_rank((768, 768)), 384)
+        self.assertEqual(factorize.break_even_rank((768, 3072)), 614)
+        self.assertEqual(factorize.break_even_rank((3072, 768)), 614)
+        for shape in [(24, 6), (6, 24), (12, 12)]:
+            kernel = np.random.RandomState(0).randn(*shape)
+            p_mat, q_mat = factorize.factorize_kernel(kernel)
+            self.assertEqual(p_mat.shape[1], factorize.break_even_rank(shape))
+            self.assertLessEqual(p_mat.size + q_mat.size, kernel.size)
+
+    def test_explicit_rank(self):
+        kernel = low_rank_matrix(24, 6, 6)
+        for method in ["truncated", "randomized"]:
+            p_mat, q_mat = factorize.factorize_kernel(
+                kernel, rank=100, method=method)
+            self.assertEqual(p_mat.shape, (24, 6))
+            self.assertAllClose(p_mat.dot(q_mat), kernel, atol=1e-8)
+            p_mat, q_mat = factorize.factorize_kernel(
+                kernel, rank=2, method=method)
+            self.assertEqual(q_mat.shape, (2, 6))
+
+
+if __name__ == "__main__":
+    tf.test.main()
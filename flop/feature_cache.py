@@ -0,0 +1,87 @@
+"""Cache of tokenized TFRecord features shared across runs."""
+import os
+import json
+import uuid
+import hashlib
+import tensorflow as tf
+
+
+# Bump whenever the layout of the cached records changes.
+CACHE_VERSION = 1
+
+
+def file_digest(path, block_size=1 << 20):
+    """Returns the sha1 hex digest of the contents of `path`."""
+    sha = hashlib.sha1()
+    with tf.gfile.GFile(path, "rb") as reader:
+        while True:
+            block = reader.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def examples_digest(examples):
+    """Returns the sha1 hex digest of the contents of `InputExample`s."""
+    sha = hashlib.sha1()
+    for example in examples:
+        sha.update(repr((example.guid, example.text_a, example.text_b,
+                         example.label)).encode("utf-8"))
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+
+def cache_key(examples, vocab_file, do_lower_case, max_seq_length, task_name,
+              label_list, **kwargs):
+    """Returns the key of the features of `examples`.
+
+    The key covers the examples read from the data files, the vocab contents
+    and every setting the conversion depends on, so two runs share a cache
+    entry exactly when they would write the same records. Extra conversion
+    settings can be passed as keyword arguments.
+    """
+    settings = {
+        "version": CACHE_VERSION,
+        "vocab": file_digest(vocab_file),
+        "do_lower_case": bool(do_lower_case),
+        "max_seq_length": int(max_seq_length),
+        "task_name": task_name,
+        "label_list": list(label_list),
+    }
+    settings.update(kwargs)
+    sha = hashlib.sha1()
+    sha.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    sha.update(examples_digest(examples).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def get_or_create(cache_dir, split, key, create_fn, num_shards=1):
+    """Returns the cached feature shards of `split`, creating them if missing.
+
+    `create_fn(paths)` writes the records to the `num_shards` files in
+    `paths`. It writes to unique temporary files that are renamed into place
+    once all of them are complete, so runs sharing `cache_dir` never read a
+    partial shard; if two of them race, both produce the same records and
+    the last rename wins.
+    """
+    paths = [os.path.join(cache_dir, "%s-%s-%05d-of-%05d.tf_record" %
+                          (split, key, i, num_shards))
+             for i in range(num_shards)]
+    if all(tf.gfile.Exists(path) for path in paths):
+        tf.logging.info("Using cached %s features %s", split, paths[0])
+        return paths
+
+    tf.gfile.MakeDirs(cache_dir)
+    token = uuid.uuid4().hex
+    tmp_paths = ["%s.tmp-%s" % (path, token) for path in paths]
+    try:
+        create_fn(tmp_paths)
+        for tmp_path, path in zip(tmp_paths, paths):
+            tf.gfile.Rename(tmp_path, path, overwrite=True)
+    finally:
+        for tmp_path in tmp_paths:
+            if tf.gfile.Exists(tmp_path):
+                tf.gfile.Remove(tmp_path)
+    tf.logging.info("Cached %s features in %s", split, paths[0])
+    return paths
@@ -25,6 +25,7 @@ from __future__ import print_function
 import tensorflow as tf
 import math
 
+import common
 import nn
 from tensorflow.python.layers import base  # pylint: disable=g-direct-tensorflow-import
 from tensorflow.contrib.layers.python.layers import utils as layer_utils
@@ -125,6 +126,193 @@ class FlopMask(base.Layer):
         return x
 
 
+class FlopDense(object):
+    """Fused factorized dense layer `q(mask(p(x)))` with FLOP.
+
+    Replaces the `tf.layers.dense` (_p) -> `FlopMask` (_g) -> `tf.layers.dense`
+    (_q) chain with a single layer. The hard-concrete gate is folded into the
+    `_p` kernel before the matmul, so only one [batch, rank] intermediate is
+    materialized, and in eval mode the deterministic gate scales the
+    [input, rank] kernel instead of every batch of activations.
+
+    Variables are created as `<name>_p/kernel`, `<name>_g/log_alpha`,
+    `<name>_q/kernel` and `<name>_q/bias`, the same names the unfused layers
+    use, so existing checkpoints still load.
+
+    `EVAL` recomputes the gate and the gated `_p` kernel on every run, one
+    extra [input, rank] multiply per layer and batch that `FROZEN` pays only
+    once per session. `EVAL` stays uncached because it is the mode of
+    `mask_only` eval graphs, where `_p` is itself a local variable restored
+    by the local init op, which would race with a cached copy of it.
+
+      Args:
+        units: Output size of the `_q` projection.
+        rank: Output size of the `_p` projection, i.e. the mask width.
+        mode: One of `TRAIN` (sample the gate), `EVAL` (use the mean of the
+          gate), `FROZEN` (eval with the gate folded into `_p` once per
+          session and the always-zero columns dropped) or `DEPLOYED` (no
+          mask, plain factorized layer).
+        active_bound: In `TRAIN` mode, if positive, only the gates whose
+          probability of being non-zero is above this bound are sampled and
+          the `_p`/`_q` products run on the gathered slices; the others are
+          treated as exactly zero. The active set is recomputed every step.
+        activation: Activation function applied to the output.
+        kernel_initializer: Initializer of the `_p` and `_q` kernels.
+        kernel_regularizer: Regularizer of the `_p` and `_q` kernels.
+        eps: Small epsilon value to prevent math op saturation.
+        beta: The beta parameter, which controls the "temperature" of
+          the distribution. Defaults to 1.0 from the above paper.
+        limit_l: The limit_l parameter, which controls the lower bound of the
+          stretched distribution. Defaults to -0.1 from the above paper.
+        limit_r: The limit_r parameters, which controls the upper bound of the
+          stretched distribution. Defaults to 1.1 from the above paper.
+        name: Prefix of the variable scopes of the layer.
+      Returns:
+        Output Tensor of the fully connected operation.
+    """
+
+    TRAIN = "train"
+    EVAL = "eval"
+    FROZEN = "frozen"
+    DEPLOYED = "deployed"
+
+    def __init__(self,
+                 units,
+                 rank,
+                 mode=TRAIN,
+                 active_bound=0.0,
+                 activation=None,
+                 kernel_initializer=None,
+                 kernel_regularizer=None,
+                 eps=1e-6,
+                 beta=1.0,
+                 limit_l=-0.1,
+                 limit_r=1.1,
+                 name="flop_dense"):
+        if mode not in (self.TRAIN, self.EVAL, self.FROZEN, self.DEPLOYED):
+            raise ValueError("Unknown FlopDense mode: %s" % mode)
+        self.units = units
+        self.rank = rank
+        self.mode = mode
+        self.active_bound = active_bound
+        self.activation = activation
+        self.kernel_initializer = kernel_initializer
+        self.kernel_regularizer = kernel_regularizer
+        self.eps = eps
+        self.beta = beta
+        self.limit_l = limit_l
+        self.limit_r = limit_r
+        self.name = name
+
+    def build(self, input_hidden_size):
+        with tf.variable_scope(self.name + "_p"):
+            self.kernel_p = tf.get_variable(
+                "kernel",
+                shape=[input_hidden_size, self.rank],
+                initializer=self.kernel_initializer,
+                regularizer=self.kernel_regularizer)
+
+        self.log_alpha = None
+        if self.mode != self.DEPLOYED:
+            with tf.variable_scope(self.name + "_g"):
+                self.log_alpha = tf.get_variable(
+                    "log_alpha",
+                    shape=self.rank,
+                    initializer=tf.constant_initializer(5),
+                    trainable=True)
+
+        with tf.variable_scope(self.name + "_q"):
+            self.kernel_q = tf.get_variable(
+                "kernel",
+                shape=[self.rank, self.units],
+                initializer=self.kernel_initializer,
+                regularizer=self.kernel_regularizer)
+            self.bias_q = tf.get_variable(
+                "bias",
+                shape=[self.units],
+                initializer=tf.zeros_initializer())
+
+    def gate(self, log_alpha=None):
+        """Returns the gate applied to the `_p` kernel, None when deployed."""
+        if log_alpha is None:
+            log_alpha = self.log_alpha
+        if self.mode == self.TRAIN:
+            return common.hard_concrete_sample(
+                log_alpha,
+                beta=self.beta,
+                limit_l=self.limit_l,
+                limit_r=self.limit_r,
+                eps=self.eps)
+        elif self.mode in (self.EVAL, self.FROZEN):
+            return common.hard_concrete_mean(
+                log_alpha,
+                limit_l=self.limit_l,
+                limit_r=self.limit_r)
+        return None
+
+    def freeze(self, kernel_p, kernel_q, gate):
+        """Drops the zero-gated columns and caches the compact kernels.
+
+        The compact kernels are local variables, so they are computed from the
+        restored `_p`, `_g` and `_q` variables once, when the session runs its
+        local init op, and then reused by every batch. The dropped columns are
+        read from the restored gate at that point too, so they match whichever
+        checkpoint was restored, and the compact width is only known then.
+        """
+        indices = tf.cast(tf.reshape(tf.where(gate > 0), [-1]), tf.int32)
+        with tf.variable_scope(self.name + "_p"):
+            frozen_kernel_p = tf.Variable(
+                tf.gather(kernel_p, indices, axis=1),
+                trainable=False,
+                validate_shape=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                name="frozen_kernel")
+        with tf.variable_scope(self.name + "_q"):
+            frozen_kernel_q = tf.Variable(
+                tf.gather(kernel_q, indices),
+                trainable=False,
+                validate_shape=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                name="frozen_kernel")
+        return (tf.reshape(frozen_kernel_p, [kernel_p.shape[0].value, -1]),
+                tf.reshape(frozen_kernel_q, [-1, self.units]))
+
+    def __call__(self, inputs):
+        inputs.get_shape().assert_has_rank(2)
+        self.build(inputs.shape[-1].value)
+
+        # (x p) diag(z) == x (p diag(z)): scaling the [input, rank] kernel is
+        # cheaper than scaling the [batch, rank] activations.
+        kernel_p = self.kernel_p
+        kernel_q = self.kernel_q
+        log_alpha = self.log_alpha
+        if self.mode == self.TRAIN and self.active_bound > 0:
+            # Gradients of the gathers are scattered back to the full
+            # variables, the dropped slices simply receive none from the loss.
+            indices = nn.active_indices(
+                log_alpha,
+                self.active_bound,
+                beta=self.beta,
+                limit_l=self.limit_l,
+                limit_r=self.limit_r)
+            kernel_p = tf.gather(kernel_p, indices, axis=1)
+            kernel_q = tf.gather(kernel_q, indices)
+            log_alpha = tf.gather(log_alpha, indices)
+
+        gate = self.gate(log_alpha)
+        if gate is not None:
+            kernel_p = nn.apply_gate(kernel_p, gate)
+
+        if self.mode == self.FROZEN:
+            kernel_p, kernel_q = self.freeze(kernel_p, kernel_q, gate)
+
+        outputs = tf.matmul(tf.matmul(inputs, kernel_p), kernel_q)
+        outputs = tf.nn.bias_add(outputs, self.bias_q)
+        if self.activation is not None:
+            outputs = self.activation(outputs)
+        return outputs
+
+
 def add_variable_to_collection(var, var_set, name):
     """Add provided variable to a given collection, with some checks."""
     collections = layer_utils.get_variable_collections(var_set, name) or []
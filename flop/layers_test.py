@@ -0,0 +1,46 @@
+"""Tests of the eval modes of layers.FlopDense."""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../bert"))
+import numpy as np
+import tensorflow as tf
+import layers
+
+
+class FlopDenseTest(tf.test.TestCase):
+
+    def build(self, mode):
+        """Returns the input placeholder, the layer and its output."""
+        inputs = tf.placeholder(tf.float32, [None, 6])
+        with tf.variable_scope("dense", reuse=tf.AUTO_REUSE):
+            layer = layers.FlopDense(units=5, rank=4, mode=mode, name="flop")
+            outputs = layer(inputs)
+        return inputs, layer, outputs
+
+    def test_frozen_follows_restored_gates(self):
+        x = np.random.RandomState(0).randn(3, 6).astype(np.float32)
+        with tf.Graph().as_default() as graph:
+            inputs, layer, outputs = self.build(layers.FlopDense.EVAL)
+            _, _, frozen_outputs = self.build(layers.FlopDense.FROZEN)
+            with self.test_session(graph=graph) as sess:
+                sess.run(tf.global_variables_initializer())
+                # Restores of different checkpoints, each followed by the
+                # local init op of a new session.
+                for log_alpha in [[5.0, -20.0, 5.0, -20.0],
+                                  [-20.0, 5.0, 5.0, 5.0]]:
+                    layer.log_alpha.load(log_alpha, sess)
+                    sess.run(tf.local_variables_initializer())
+                    value, frozen_value = sess.run(
+                        [outputs, frozen_outputs], {inputs: x})
+                    self.assertAllClose(value, frozen_value, atol=1e-5)
+                    widths = [sess.run(var).shape
+                              for var in tf.local_variables()]
+                    num_active = int(np.sum(np.array(log_alpha) > 0))
+                    self.assertEqual(sorted(widths),
+                                     sorted([(6, num_active),
+                                             (num_active, 5)]))
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -18,7 +18,9 @@ class BertConfig(object):
                  type_vocab_size=16,
                  initializer_range=0.02,
                  regularization_scale=0.001,
-                 pruned_layers_dim={}):
+                 pruned_layers_dim={},
+                 masked_layers_dim={},
+                 active_gate_bound=0.0):
         """Constructs BertConfig.
 
         Args:
@@ -42,6 +44,16 @@ class BertConfig(object):
             `BertModel`.
           initializer_range: The stdev of the truncated_normal_initializer for
             initializing all weight matrices.
+          regularization_scale: The scale of the l2 regularization of the
+            factorized kernels.
+          pruned_layers_dim: Dict from `_p` kernel name to its pruned width.
+            The model is built without masks when it is not empty.
+          masked_layers_dim: Dict from `_p` kernel name to its width, for
+            layers that are narrower than the default but keep their mask,
+            e.g. after an in-training compaction.
+          active_gate_bound: If positive, training only computes the mask
+            dimensions whose gate is non-zero with a probability above this
+            bound.
         """
         self.vocab_size = vocab_size
         self.hidden_size = hidden_size
@@ -56,6 +68,8 @@ class BertConfig(object):
         self.initializer_range = initializer_range
         self.regularization_scale = regularization_scale
         self.pruned_layers_dim = pruned_layers_dim
+        self.masked_layers_dim = masked_layers_dim
+        self.active_gate_bound = active_gate_bound
 
     @classmethod
     def from_dict(cls, json_object):
@@ -91,7 +105,10 @@ class BertModelHardConcrete(BertModel):
                  token_type_ids=None,
                  use_one_hot_embeddings=False,
                  scope=None,
-                 factorize=False):
+                 factorize=False,
+                 freeze_masks=False,
+                 position_ids=None,
+                 cls_positions=None):
         """Constructor for BertModel.
 
         Args:
@@ -99,11 +116,29 @@ class BertModelHardConcrete(BertModel):
           is_training: bool. true for training model, false for eval model. Controls
             whether dropout will be applied.
           input_ids: int32 Tensor of shape [batch_size, seq_length].
+            `seq_length` may be dynamic and change from batch to batch, e.g.
+            with batches padded to their longest sequence, up to
+            `max_position_embeddings`.
           input_mask: (optional) int32 Tensor of shape [batch_size, seq_length].
           token_type_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
           use_one_hot_embeddings: (optional) bool. Whether to use one-hot word
             embeddings or tf.embedding_lookup() for the word embeddings.
           scope: (optional) variable scope. Defaults to "bert".
+          factorize: (optional) bool. Whether the model is a factorized model
+            without masks.
+          freeze_masks: (optional) bool. Only used when `is_training` is
+            false; the gates of the restored `log_alpha` variables are then
+            folded into `_p` once per session and their zero-gated columns
+            are dropped, see `layers.FlopDense`.
+          position_ids: (optional) int32 Tensor of shape [batch_size,
+            seq_length], the position of every token in its sequence. Defaults
+            to 0, 1, ..., seq_length - 1.
+          cls_positions: (optional) int32 Tensor of shape [batch_size,
+            examples_per_row]. If set, every row packs several sequences:
+            `input_mask` holds the 1-based index of the sequence of each token
+            (0 for padding), attention stays within each sequence, and the
+            pooled output has one row per [CLS] position, i.e. shape
+            [batch_size * examples_per_row, hidden_size].
 
         Raises:
           ValueError: The config is invalid or one of the input tensor shapes
@@ -139,24 +174,38 @@ class BertModelHardConcrete(BertModel):
 
                 # Add positional embeddings and token type embeddings, then layer
                 # normalize and perform dropout.
-                self.embedding_output = embedding_postprocessor(
-                    input_tensor=self.embedding_output,
-                    use_token_type=True,
-                    token_type_ids=token_type_ids,
-                    token_type_vocab_size=config.type_vocab_size,
-                    token_type_embedding_name="token_type_embeddings",
-                    use_position_embeddings=True,
-                    position_embedding_name="position_embeddings",
-                    initializer_range=config.initializer_range,
-                    max_position_embeddings=config.max_position_embeddings,
-                    dropout_prob=config.hidden_dropout_prob)
+                if position_ids is None:
+                    self.embedding_output = embedding_postprocessor(
+                        input_tensor=self.embedding_output,
+                        use_token_type=True,
+                        token_type_ids=token_type_ids,
+                        token_type_vocab_size=config.type_vocab_size,
+                        token_type_embedding_name="token_type_embeddings",
+                        use_position_embeddings=True,
+                        position_embedding_name="position_embeddings",
+                        initializer_range=config.initializer_range,
+                        max_position_embeddings=config.max_position_embeddings,
+                        dropout_prob=config.hidden_dropout_prob)
+                else:
+                    self.embedding_output = embedding_postprocessor_with_positions(
+                        input_tensor=self.embedding_output,
+                        token_type_ids=token_type_ids,
+                        position_ids=position_ids,
+                        token_type_vocab_size=config.type_vocab_size,
+                        initializer_range=config.initializer_range,
+                        max_position_embeddings=config.max_position_embeddings,
+                        dropout_prob=config.hidden_dropout_prob)
 
             with tf.variable_scope("encoder"):
                 # This converts a 2D mask of shape [batch_size, seq_length] to a 3D
                 # mask of shape [batch_size, seq_length, seq_length] which is used
                 # for the attention scores.
-                attention_mask = create_attention_mask_from_input_mask(
-                    input_ids, input_mask)
+                if cls_positions is None:
+                    attention_mask = create_attention_mask_from_input_mask(
+                        input_ids, input_mask)
+                else:
+                    attention_mask = create_packed_attention_mask(
+                        input_ids, input_mask)
 
                 # Run the stacked transformer.
                 # `sequence_output` shape = [batch_size, seq_length, hidden_size].
@@ -175,7 +224,10 @@ class BertModelHardConcrete(BertModel):
                     is_training=is_training,
                     regularization_scale=config.regularization_scale,
                     factorize=factorize,
-                    pruned_layers_dim=config.pruned_layers_dim)
+                    pruned_layers_dim=config.pruned_layers_dim,
+                    masked_layers_dim=getattr(config, "masked_layers_dim", {}),
+                    freeze_masks=freeze_masks,
+                    active_gate_bound=getattr(config, "active_gate_bound", 0.0))
 
             self.sequence_output = self.all_encoder_layers[-1]
             # The "pooler" converts the encoded sequence tensor of shape
@@ -186,8 +238,15 @@ class BertModelHardConcrete(BertModel):
             with tf.variable_scope("pooler"):
                 # We "pool" the model by simply taking the hidden state corresponding
                 # to the first token. We assume that this has been pre-trained
-                first_token_tensor = tf.squeeze(
-                    self.sequence_output[:, 0:1, :], axis=1)
+                if cls_positions is None:
+                    first_token_tensor = tf.squeeze(
+                        self.sequence_output[:, 0:1, :], axis=1)
+                else:
+                    # Pool every packed sequence at its own [CLS] token.
+                    first_token_tensor = tf.reshape(
+                        tf.gather(self.sequence_output, cls_positions,
+                                  batch_dims=1),
+                        [-1, config.hidden_size])
                 self.pooled_output = tf.layers.dense(
                     first_token_tensor,
                     config.hidden_size,
@@ -197,6 +256,109 @@ class BertModelHardConcrete(BertModel):
                     kernel_regularizer=tf.contrib.layers.l2_regularizer(config.regularization_scale))
 
 
+def embedding_postprocessor_with_positions(input_tensor,
+                                           token_type_ids,
+                                           position_ids,
+                                           token_type_vocab_size=16,
+                                           initializer_range=0.02,
+                                           max_position_embeddings=512,
+                                           dropout_prob=0.1):
+    """Same as `embedding_postprocessor`, with explicit token positions.
+
+    Packed rows restart the positions for every sequence they hold, so the
+    position embeddings are gathered by `position_ids` instead of sliced. The
+    variables are those of `embedding_postprocessor`.
+    """
+    input_shape = get_shape_list(input_tensor, expected_rank=3)
+    batch_size = input_shape[0]
+    seq_length = input_shape[1]
+    width = input_shape[2]
+
+    output = input_tensor
+
+    token_type_table = tf.get_variable(
+        name="token_type_embeddings",
+        shape=[token_type_vocab_size, width],
+        initializer=create_initializer(initializer_range))
+    flat_token_type_ids = tf.reshape(token_type_ids, [-1])
+    one_hot_ids = tf.one_hot(flat_token_type_ids, depth=token_type_vocab_size)
+    token_type_embeddings = tf.matmul(one_hot_ids, token_type_table)
+    token_type_embeddings = tf.reshape(token_type_embeddings,
+                                       [batch_size, seq_length, width])
+    output += token_type_embeddings
+
+    full_position_embeddings = tf.get_variable(
+        name="position_embeddings",
+        shape=[max_position_embeddings, width],
+        initializer=create_initializer(initializer_range))
+    output += tf.gather(full_position_embeddings, position_ids)
+
+    output = layer_norm_and_dropout(output, dropout_prob)
+    return output
+
+
+def create_packed_attention_mask(from_tensor, pack_ids):
+    """Creates the block-diagonal attention mask of packed sequences.
+
+    Args:
+      from_tensor: 2D or 3D Tensor of shape [batch_size, from_seq_length, ...].
+      pack_ids: int32 Tensor of shape [batch_size, to_seq_length], the 1-based
+        index of the sequence every token belongs to, 0 for padding.
+
+    Returns:
+      float Tensor of shape [batch_size, from_seq_length, to_seq_length], 1
+      where both tokens belong to the same sequence.
+    """
+    attention_mask = create_attention_mask_from_input_mask(
+        from_tensor, tf.cast(tf.greater(pack_ids, 0), tf.int32))
+    same_sequence = tf.equal(
+        tf.expand_dims(pack_ids, axis=2), tf.expand_dims(pack_ids, axis=1))
+    return attention_mask * tf.cast(same_sequence, tf.float32)
+
+
+def flop_dense(input_tensor,
+               units,
+               rank,
+               name,
+               activation=None,
+               initializer_range=0.02,
+               is_training=True,
+               regularization_scale=0.1,
+               factorize=False,
+               pruned_layers_dim={},
+               freeze_masks=False,
+               active_gate_bound=0.0):
+    """Factorized projection `<name>_q(<name>_g(<name>_p(input_tensor)))`.
+
+    `rank` is the width of the `_p` projection unless it was pruned, in which
+    case the pruned width is looked up in `pruned_layers_dim`.
+    """
+    scope_name = tf.get_variable_scope().name
+    if scope_name + '/' + name + '_p/kernel' in pruned_layers_dim:
+        rank = pruned_layers_dim[scope_name + '/' + name + '_p/kernel']
+
+    if factorize:
+        mode = layers.FlopDense.DEPLOYED
+    elif is_training:
+        mode = layers.FlopDense.TRAIN
+    elif freeze_masks:
+        mode = layers.FlopDense.FROZEN
+    else:
+        mode = layers.FlopDense.EVAL
+
+    # Attention: eps, beta, limit_l, limit_r!
+    flop_layer = layers.FlopDense(
+        units=units,
+        rank=rank,
+        mode=mode,
+        active_bound=active_gate_bound,
+        activation=activation,
+        kernel_initializer=create_initializer(initializer_range),
+        kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale),
+        name=name)
+    return flop_layer(input_tensor)
+
+
 def attention_layer_flop(from_tensor,
                          to_tensor,
                          attention_mask=None,
@@ -214,7 +376,9 @@ def attention_layer_flop(from_tensor,
                          is_training=True,
                          regularization_scale=0.1,
                          factorize=False,
-                         pruned_layers_dim={}):
+                         pruned_layers_dim={},
+                         freeze_masks=False,
+                         active_gate_bound=0.0):
     def transpose_for_scores(input_tensor, batch_size, num_attention_heads,
                              seq_length, width):
         output_tensor = tf.reshape(
@@ -251,39 +415,20 @@ def attention_layer_flop(from_tensor,
     from_tensor_2d = reshape_to_matrix(from_tensor)
     to_tensor_2d = reshape_to_matrix(to_tensor)
 
-    scope_name = tf.get_variable_scope().name
-
-    if scope_name + '/query_p/kernel' not in pruned_layers_dim:
-        query_size = num_attention_heads * size_per_head
-    else:
-        query_size = pruned_layers_dim[scope_name + '/query_p/kernel']
-    
     # query layer matrix factorized here
-    query_layer_p = tf.layers.dense(
+    query_layer = flop_dense(
         from_tensor_2d,
-        query_size,
-        activation=None,
-        use_bias=False,
-        name="query_p",
-        kernel_initializer=create_initializer(initializer_range),
-        kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
-
-    if not factorize:
-        # Attention: eps, beta, limit_l, limit_r!
-        query_layer_mask = layers.FlopMask(
-            name="query_g",
-            is_training=is_training)
-        query_layer_mask_output = query_layer_mask(query_layer_p)
-    else:
-        query_layer_mask_output = query_layer_p
-
-    query_layer = tf.layers.dense(
-        query_layer_mask_output,
         num_attention_heads * size_per_head,
+        num_attention_heads * size_per_head,
+        name="query",
         activation=query_act,
-        name="query_q",
-        kernel_initializer=create_initializer(initializer_range),
-        kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
+        initializer_range=initializer_range,
+        is_training=is_training,
+        regularization_scale=regularization_scale,
+        factorize=factorize,
+        pruned_layers_dim=pruned_layers_dim,
+        freeze_masks=freeze_masks,
+        active_gate_bound=active_gate_bound)
 
     # # `query_layer` = [B*F, N*H]
     # query_layer = tf.layers.dense(
@@ -293,37 +438,20 @@ def attention_layer_flop(from_tensor,
     #     name="query",
     #     kernel_initializer=create_initializer(initializer_range))
 
-    if scope_name + '/key_p/kernel' not in pruned_layers_dim:
-        key_size = num_attention_heads * size_per_head
-    else:
-        key_size = pruned_layers_dim[scope_name + '/key_p/kernel']
-
     # key layer matrix factorized here
-    key_layer_p = tf.layers.dense(
+    key_layer = flop_dense(
         to_tensor_2d,
-        key_size,
-        activation=None,
-        use_bias=False,
-        name="key_p",
-        kernel_initializer=create_initializer(initializer_range),
-        kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
-
-    if not factorize:
-        # Attention: eps, beta, limit_l, limit_r!
-        key_layer_mask = layers.FlopMask(
-            name="key_g",
-            is_training=is_training)
-        key_layer_mask_output = key_layer_mask(key_layer_p)
-    else:
-        key_layer_mask_output = key_layer_p
-
-    key_layer = tf.layers.dense(
-        key_layer_mask_output,
         num_attention_heads * size_per_head,
+        num_attention_heads * size_per_head,
+        name="key",
         activation=key_act,
-        name="key_q",
-        kernel_initializer=create_initializer(initializer_range),
-        kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
+        initializer_range=initializer_range,
+        is_training=is_training,
+        regularization_scale=regularization_scale,
+        factorize=factorize,
+        pruned_layers_dim=pruned_layers_dim,
+        freeze_masks=freeze_masks,
+        active_gate_bound=active_gate_bound)
 
     # `key_layer` = [B*T, N*H]
     # key_layer = tf.layers.dense(
@@ -333,37 +461,20 @@ def attention_layer_flop(from_tensor,
     #     name="key",
     #     kernel_initializer=create_initializer(initializer_range))
 
-    if scope_name + '/value_p/kernel' not in pruned_layers_dim:
-        value_size = num_attention_heads * size_per_head
-    else:
-        value_size = pruned_layers_dim[scope_name + '/value_p/kernel']
-
     # value layer matrix factorized here
-    value_layer_p = tf.layers.dense(
+    value_layer = flop_dense(
         to_tensor_2d,
-        value_size,
-        activation=None,
-        use_bias=False,
-        name="value_p",
-        kernel_initializer=create_initializer(initializer_range),
-        kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
-
-    if not factorize:
-        # Attention: eps, beta, limit_l, limit_r!
-        value_layer_mask = layers.FlopMask(
-            name="value_g",
-            is_training=is_training)
-        value_layer_mask_output = value_layer_mask(value_layer_p)
-    else:
-        value_layer_mask_output = value_layer_p
-
-    value_layer = tf.layers.dense(
-        value_layer_mask_output,
         num_attention_heads * size_per_head,
+        num_attention_heads * size_per_head,
+        name="value",
         activation=value_act,
-        name="value_q",
-        kernel_initializer=create_initializer(initializer_range),
-        kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
+        initializer_range=initializer_range,
+        is_training=is_training,
+        regularization_scale=regularization_scale,
+        factorize=factorize,
+        pruned_layers_dim=pruned_layers_dim,
+        freeze_masks=freeze_masks,
+        active_gate_bound=active_gate_bound)
 
     # `value_layer` = [B*T, N*H]
     # value_layer = tf.layers.dense(
@@ -452,9 +563,16 @@ def transformer_model_flop(input_tensor,
                            is_training=True,
                            regularization_scale=0.1,
                            factorize=False,
-                           pruned_layers_dim={}):
+                           pruned_layers_dim={},
+                           freeze_masks=False,
+                           active_gate_bound=0.0,
+                           masked_layers_dim={}):
     if not pruned_layers_dim == {}:
         factorize = True
+    # Masked layers are sized like pruned ones, only without dropping the mask.
+    layers_dim = dict(masked_layers_dim)
+    layers_dim.update(pruned_layers_dim)
+    pruned_layers_dim = layers_dim
 
     if hidden_size % num_attention_heads != 0:
         raise ValueError(
@@ -502,7 +620,9 @@ def transformer_model_flop(input_tensor,
                         is_training=is_training,
                         regularization_scale=regularization_scale,
                         factorize=factorize,
-                        pruned_layers_dim=pruned_layers_dim)
+                        pruned_layers_dim=pruned_layers_dim,
+                        freeze_masks=freeze_masks,
+                        active_gate_bound=active_gate_bound)
                     attention_heads.append(attention_head)
 
                 attention_output = None
@@ -516,38 +636,19 @@ def transformer_model_flop(input_tensor,
                 # Run a linear projection of `hidden_size` then add a residual
                 # with `layer_input`.
                 with tf.variable_scope("output"):
-                    scope_name = tf.get_variable_scope().name
-                    if scope_name + '/dense_p/kernel' not in pruned_layers_dim:
-                        dense_size = hidden_size
-                    else:
-                        dense_size = pruned_layers_dim[scope_name + '/dense_p/kernel']
                     # attention output fractorized here
-                    attention_output_p = tf.layers.dense(
+                    attention_output = flop_dense(
                         attention_output,
-                        dense_size,
-                        use_bias=False,
-                        name="dense_p",
-                        kernel_initializer=create_initializer(
-                            initializer_range),
-                        kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
-
-                    if not factorize:
-                        # Attention: eps, beta, limit_l, limit_r!
-                        attention_output_mask = layers.FlopMask(
-                            name="dense_g",
-                            is_training=is_training)
-                        attention_output_mask_output = attention_output_mask(
-                            attention_output_p)
-                    else:
-                        attention_output_mask_output = attention_output_p
-
-                    attention_output = tf.layers.dense(
-                        attention_output_mask_output,
                         hidden_size,
-                        name="dense_q",
-                        kernel_initializer=create_initializer(
-                            initializer_range),
-                        kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
+                        hidden_size,
+                        name="dense",
+                        initializer_range=initializer_range,
+                        is_training=is_training,
+                        regularization_scale=regularization_scale,
+                        factorize=factorize,
+                        pruned_layers_dim=pruned_layers_dim,
+                        freeze_masks=freeze_masks,
+                        active_gate_bound=active_gate_bound)
 
                     # attention_output = tf.layers.dense(
                     #     attention_output,
@@ -561,38 +662,20 @@ def transformer_model_flop(input_tensor,
 
             # The activation is only applied to the "intermediate" hidden layer.
             with tf.variable_scope("intermediate"):
-                scope_name = tf.get_variable_scope().name
-                if scope_name + '/dense_p/kernel' not in pruned_layers_dim:
-                    dense_size = hidden_size
-                else:
-                    dense_size = pruned_layers_dim[scope_name + '/dense_p/kernel']
                 # intermidiate output fractorized here
-                intermediate_output_p = tf.layers.dense(
+                intermediate_output = flop_dense(
                     attention_output,
-                    dense_size,
-                    activation=None,
-                    use_bias=False,
-                    name='dense_p',
-                    kernel_initializer=create_initializer(initializer_range),
-                    kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
-
-                if not factorize:
-                    # Attention: eps, beta, limit_l, limit_r!
-                    intermediate_output_mask = layers.FlopMask(
-                        name="dense_g",
-                        is_training=is_training)
-                    intermediate_output_mask_output = intermediate_output_mask(
-                        intermediate_output_p)
-                else:
-                    intermediate_output_mask_output = intermediate_output_p
-
-                intermediate_output = tf.layers.dense(
-                    intermediate_output_mask_output,
                     intermediate_size,
+                    hidden_size,
+                    name="dense",
                     activation=intermediate_act_fn,
-                    name='dense_q',
-                    kernel_initializer=create_initializer(initializer_range),
-                    kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
+                    initializer_range=initializer_range,
+                    is_training=is_training,
+                    regularization_scale=regularization_scale,
+                    factorize=factorize,
+                    pruned_layers_dim=pruned_layers_dim,
+                    freeze_masks=freeze_masks,
+                    active_gate_bound=active_gate_bound)
 
                 # intermediate_output = tf.layers.dense(
                 #     attention_output,
@@ -602,36 +685,19 @@ def transformer_model_flop(input_tensor,
 
             # Down-project back to `hidden_size` then add the residual.
             with tf.variable_scope("output"):
-                scope_name = tf.get_variable_scope().name
-                if scope_name + '/dense_p/kernel' not in pruned_layers_dim:
-                    dense_size = intermediate_size
-                else:
-                    dense_size = pruned_layers_dim[scope_name + '/dense_p/kernel']
                 # layer output fractorized here
-                layer_output_p = tf.layers.dense(
+                layer_output = flop_dense(
                     intermediate_output,
-                    dense_size,
-                    use_bias=False,
-                    name="dense_p",
-                    kernel_initializer=create_initializer(initializer_range),
-                    kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
-
-                if not factorize:
-                    # Attention: eps, beta, limit_l, limit_r!
-                    layer_output_mask = layers.FlopMask(
-                        name="dense_g",
-                        is_training=is_training)
-                    layer_output_mask_output = layer_output_mask(
-                        layer_output_p)
-                else:
-                    layer_output_mask_output = layer_output_p
-
-                layer_output = tf.layers.dense(
-                    layer_output_mask_output,
                     hidden_size,
-                    name="dense_q",
-                    kernel_initializer=create_initializer(initializer_range),
-                    kernel_regularizer=tf.contrib.layers.l2_regularizer(regularization_scale))
+                    intermediate_size,
+                    name="dense",
+                    initializer_range=initializer_range,
+                    is_training=is_training,
+                    regularization_scale=regularization_scale,
+                    factorize=factorize,
+                    pruned_layers_dim=pruned_layers_dim,
+                    freeze_masks=freeze_masks,
+                    active_gate_bound=active_gate_bound)
 
                 # layer_output = tf.layers.dense(
                 #     intermediate_output,
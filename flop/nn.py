@@ -18,6 +18,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import math
 import tensorflow as tf
 
 import common
@@ -61,9 +62,7 @@ def matmul_train(
         limit_r,
         eps)
 
-    mask_mat = tf.linalg.tensor_diag(weight_noise)
-
-    return tf.matmul(x, mask_mat)
+    return apply_gate(x, weight_noise)
 
 
 def matmul_eval(
@@ -98,9 +97,57 @@ def matmul_eval(
         limit_l,
         limit_r)
 
-    mask_mat = tf.linalg.tensor_diag(weight_noise)
+    return apply_gate(x, weight_noise)
+
+
+def apply_gate(x, gate):
+    """Scales the columns of `x` by the hard-concrete gate.
+
+    This is numerically identical to `tf.matmul(x, tf.linalg.tensor_diag(gate))`
+    but broadcasts the gate instead of materializing a [rank, rank] diagonal
+    matrix, so it costs O(batch * rank) instead of O(batch * rank^2).
 
-    return tf.matmul(x, mask_mat)
+    Args:
+      x: 2D Tensor of shape [batch, rank].
+      gate: 1D Tensor of shape [rank].
+    Returns:
+      Tensor of the same shape as `x`.
+    """
+    x.get_shape().assert_has_rank(2)
+    gate.get_shape().assert_has_rank(1)
+    return x * gate
+
+
+def active_indices(
+        log_alpha,
+        bound,
+        beta=common.BETA,
+        limit_l=common.LIMIT_L,
+        limit_r=common.LIMIT_R):
+    """Indices of the gates that can still be sampled as non-zero.
+
+    A hard-concrete gate is non-zero with probability
+    sigmoid(log_alpha - beta * log(-limit_l / limit_r)), the same per-weight
+    term `l0_norm` sums up. Gates below `bound` are treated as exactly zero, so
+    the layer only has to compute the gathered slices of its kernels.
+
+    Args:
+      log_alpha: 1D Tensor of the log alpha parameters.
+      bound: Gates whose probability of being non-zero is not above this value
+        are dropped.
+      beta: The beta parameter, which controls the "temperature" of
+        the distribution. Defaults to 2/3 from the above paper.
+      limit_l: The limit_l parameter, which controls the lower bound of the
+        stretched distribution. Defaults to -0.1 from the above paper.
+      limit_r: The limit_r parameters, which controls the upper bound of the
+        stretched distribution. Defaults to 1.1 from the above paper.
+    Returns:
+      1D int32 Tensor of the active indices, in increasing order.
+    """
+    log_alpha.get_shape().assert_has_rank(1)
+    prob_non_zero = tf.sigmoid(log_alpha - beta * math.log(-limit_l / limit_r))
+    indices = tf.where(tf.greater(prob_non_zero, bound))
+    return tf.cast(tf.reshape(indices, [-1]), tf.int32)
 
 
 def l0_norm(
@@ -0,0 +1,47 @@
+"""Tests of the fused Adam update of optimization_flop."""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../bert"))
+import numpy as np
+import tensorflow as tf
+import optimization_flop
+
+
+class OptimizationFlopTest(tf.test.TestCase):
+
+    def test_fused_adam_skips_missing_gradients(self):
+        with tf.Graph().as_default() as graph:
+            w = tf.get_variable(
+                "w", shape=[2, 3], initializer=tf.constant_initializer(0.1))
+            b = tf.get_variable(
+                "bias", shape=[3], initializer=tf.constant_initializer(0.1))
+            unused = tf.get_variable(
+                "unused", shape=[4], initializer=tf.constant_initializer(0.5))
+            loss = tf.reduce_mean(tf.square(tf.reduce_sum(w, axis=0) + b))
+            tvars = [w, b, unused]
+            grads = tf.gradients(loss, tvars)
+            self.assertIsNone(grads[2])
+            # Every variable is excluded, so only the `no_decay` group exists.
+            optimizer = optimization_flop.AdamWeightDecayOptimizer(
+                learning_rate=0.2,
+                weight_decay_rate=0.01,
+                exclude_from_weight_decay=["w", "bias"],
+                fused=True)
+            train_op = optimizer.apply_gradients(zip(grads, tvars))
+            slots = dict((var.op.name, var.shape.as_list())
+                         for var in tf.global_variables()
+                         if "adam_" in var.op.name)
+            self.assertEqual(
+                slots, {"AdamWeightDecayOptimizer/no_decay/adam_m": [9],
+                        "AdamWeightDecayOptimizer/no_decay/adam_v": [9]})
+            with self.test_session(graph=graph) as sess:
+                sess.run(tf.global_variables_initializer())
+                sess.run(train_op)
+                w_value, unused_value = sess.run([w, unused])
+        self.assertAllClose(unused_value, np.full([4], 0.5))
+        self.assertTrue(np.all(w_value < 0.1))
+
+
+if __name__ == "__main__":
+    tf.test.main()
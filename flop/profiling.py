@@ -0,0 +1,64 @@
+"""Input pipeline versus training step timing."""
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def time_input_fn(input_fn, num_batches, warmup_batches=5):
+    """Returns the mean time in seconds the input pipeline takes per batch.
+
+    The pipeline runs on its own, so this is the best step time training
+    could reach if the model were free.
+    """
+    with tf.Graph().as_default():
+        dataset = input_fn(params={})
+        next_batch = tf.data.make_one_shot_iterator(dataset).get_next()
+        with tf.Session() as sess:
+            for _ in range(warmup_batches):
+                sess.run(next_batch)
+            start = time.time()
+            for _ in range(num_batches):
+                sess.run(next_batch)
+            return (time.time() - start) / num_batches
+
+
+class StepTimerHook(tf.train.SessionRunHook):
+    """Records the wall-clock time of every training step."""
+
+    def __init__(self, skip_steps=5):
+        self.skip_steps = skip_steps
+        self.step_times = []
+
+    def begin(self):
+        self._num_steps = 0
+
+    def before_run(self, run_context):
+        self._start = time.time()
+
+    def after_run(self, run_context, run_values):
+        self._num_steps += 1
+        # The first steps include graph warmup.
+        if self._num_steps > self.skip_steps:
+            self.step_times.append(time.time() - self._start)
+
+    def mean_step_time(self):
+        """Returns the mean step time in seconds, or None before any step."""
+        if not self.step_times:
+            return None
+        return float(np.mean(self.step_times))
+
+
+def log_input_bound(input_time, step_time):
+    """Logs whether steps taking `step_time` wait on an `input_time` pipeline.
+
+    With prefetching, a step takes about max(input, compute) time, so when
+    the isolated pipeline is nearly as slow as a whole step the input is the
+    bottleneck.
+    """
+    input_share = input_time / step_time
+    tf.logging.info(
+        "Input pipeline: %.1fms/batch, training: %.1fms/step, so training is "
+        "%s-bound (input is %.0f%% of the step time).",
+        input_time * 1000, step_time * 1000,
+        "input" if input_share > 0.9 else "compute",
+        min(input_share, 1.0) * 100)
@@ -2,44 +2,31 @@ import sys
 import os
 sys.path.append(os.path.join(sys.path[0], "../bert"))
 import re
-import json
-import math
+import time
 import argparse
+import collections
 import numpy as np
 import tensorflow as tf
+import common
+import modeling
 import modeling_flop
-from tensorflow.python.framework import ops
-from tensorflow.python import pywrap_tensorflow
+import checkpoint_rewriter
 
 
-LIMIT_L = -0.1
-LIMIT_R = 1.1
+LIMIT_L = common.LIMIT_L
+LIMIT_R = common.LIMIT_R
 
 
 def hard_concrete_sample(tensor):
-    def sigmoid(x):
-        return 1 / (1 + math.exp(-x))
-    sigmoid_v = np.vectorize(sigmoid)
-    tensor = sigmoid_v(tensor) * (LIMIT_R - LIMIT_L) + LIMIT_L
-    return np.clip(tensor, 0, 1.0)
+    """Returns the deterministic gates of the `log_alpha` values `tensor`."""
+    return common.hard_concrete_mean_numpy(
+        tensor, limit_l=LIMIT_L, limit_r=LIMIT_R)
 
 
 def get_index(tensor, threshold=0.3):
+    """Returns the gates and the indices of the gates above `threshold`."""
     tensor = hard_concrete_sample(tensor)
-    indexes = np.array([])
-    for i in range(len(tensor)):
-        if tensor[i] > threshold:
-            indexes = np.append(indexes, i)
-    indexes = indexes.astype(int)
-    return tensor, indexes
-
-
-def mask_row(tensor, indexes):
-    return tensor[indexes]
-
-
-def mask_col(tensor, indexes):
-    return tensor[:, indexes]
+    return tensor, np.flatnonzero(tensor > threshold)
 
 
 def kernel_map(var_name):
@@ -47,125 +34,253 @@ def kernel_map(var_name):
     return base + 'p/kernel', base + 'q/kernel'
 
 
-def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
-                 labels, num_labels):
-    model = modeling_flop.BertModelHardConcrete(
-        config=bert_config,
-        is_training=is_training,
-        input_ids=input_ids,
-        input_mask=input_mask,
-        token_type_ids=segment_ids,
-        factorize=True)
-    num_labels = max(num_labels, 1)
-    output_layer = model.get_pooled_output()
-    hidden_size = output_layer.shape[-1].value
-    output_weights = tf.get_variable(
-        "output_weights", [num_labels, hidden_size],
-        initializer=tf.truncated_normal_initializer(stddev=0.02))
-    output_bias = tf.get_variable(
-        "output_bias", [num_labels], initializer=tf.zeros_initializer())
-
-
-def remove_mask(bert_config_file, init_checkpoint, output_dir, threshold=0):
-    reader = pywrap_tensorflow.NewCheckpointReader(init_checkpoint)
-    kernel_pattern = "^bert/encoder/.*((query|key|value)|(dense))/kernel$"
-    var_to_shape_map = reader.get_variable_to_shape_map()
+def load_masked_tensors(init_checkpoint, base_checkpoint=None):
+    """Reads the variables of a masked checkpoint once, for any threshold.
+
+    Returns the `[layer, name]` pairs of the `log_alpha` variables and of the
+    variables to keep, sorted by layer, and a dict of all their arrays.
+    """
+    # A mask-only checkpoint is a delta, the rest is read from its base.
+    checkpoints = [init_checkpoint]
+    if base_checkpoint:
+        checkpoints.append(base_checkpoint)
+    reader = checkpoint_rewriter.MergedCheckpointReader(*checkpoints)
+    # The index leaves the optimizer slots out of the variable names.
+    var_to_shape_map = modeling.VariableIndex(
+        reader.get_variable_to_shape_map().items())
     log_alpha_pattern = ".*_g/log_alpha$"
     log_alphas = []
     tensor_names = []
-    for key in var_to_shape_map:
+    for key in var_to_shape_map.names():
         if "layer_" in key:
             layer_num = int(re.findall(
                 r'layer_\d+', key)[0].split("_")[1])
         else:
             layer_num = 0
-        if "adam" not in key and "lambda" not in key and "global_step" not in key and "log_alpha" not in key:
+        if "lambda" not in key and "global_step" not in key and "log_alpha" not in key:
             tensor_names.append([layer_num, key])
         if re.match(log_alpha_pattern, key):
             log_alphas.append([layer_num, key])
 
     log_alphas = sorted(log_alphas, key=lambda x: (x[0], x[1]))
     tensor_names = sorted(tensor_names, key=lambda x: (x[0], x[1]))
+    tensors = dict((key, reader.get_tensor(key))
+                   for layer, key in log_alphas + tensor_names)
+    return log_alphas, tensor_names, tensors
+
 
-    tensors = {}
-    for tensor_name in tensor_names:
-        tensors[tensor_name[1]] = reader.get_tensor(tensor_name[1])
+def compact_tensors(log_alphas, tensor_names, tensors, threshold=0):
+    """Returns the arrays of the model without its masks at `threshold`.
+
+    The `_p` kernels are scaled by their deterministic gates, and the
+    dimensions whose gate is at most `threshold` are sliced out of the `_p`
+    columns and `_q` rows. Also returns the pruned width of every `_p`
+    kernel and an ordered dict of the parameter counts.
+    """
     dense_total_params = 0
     dense_pruned_params = 0
     dense_origin_params = 0
     dim_dict = {}
-    count = 0
+    rules = {}
     for layer, var_name in log_alphas:
-        tensor = reader.get_tensor(var_name)
-        length = len(tensor)
-        tensor, index = get_index(tensor, threshold=threshold)
-        pruned_length = len(index)
-        layer_sparsity = pruned_length / length
+        tensor, index = get_index(tensors[var_name], threshold=threshold)
         p, q = kernel_map(var_name)
-        tensor_p = tensors[p]
-        tensor_q = tensors[q]
-        tensor_p = tensor_p.dot(np.diag(tensor))
-        dense_total_params += tensor_p.shape[0] * tensor_p.shape[1]
-        dense_total_params += tensor_q.shape[0] * tensor_q.shape[1]
-        dense_origin_params += tensor_p.shape[0] * tensor_q.shape[1]
-        tensor_p = mask_col(tensor_p, index)
-        tensor_q = mask_row(tensor_q, index)
-        dense_pruned_params += tensor_p.shape[0] * tensor_p.shape[1]
-        dense_pruned_params += tensor_q.shape[0] * tensor_q.shape[1]
-        tensors[p] = tensor_p
-        tensors[q] = tensor_q
-        dim_dict[p] = tensor_p.shape[1]
+        shape_p = np.shape(tensors[p])
+        shape_q = np.shape(tensors[q])
+        dense_total_params += shape_p[0] * shape_p[1]
+        dense_total_params += shape_q[0] * shape_q[1]
+        dense_origin_params += shape_p[0] * shape_q[1]
+        dense_pruned_params += shape_p[0] * len(index)
+        dense_pruned_params += len(index) * shape_q[1]
+        rules[p] = checkpoint_rewriter.Slice(
+            p, p, index, axis=1, scale=tensor[index])
+        rules[q] = checkpoint_rewriter.Slice(q, q, index, axis=0)
+        dim_dict[p] = len(index)
 
     non_kernel_params = 0
-    for key in tensors.keys():
+    for layer, key in tensor_names:
+        if key not in rules:
+            rules[key] = checkpoint_rewriter.Rename(key, key)
         if "kernel" not in key:
-            tensor = tensors[key]
-            if len(tensor.shape) == 2:
-                non_kernel_params += tensor.shape[0] * tensor.shape[1]
-            else:
-                non_kernel_params += tensor.shape[0]
+            non_kernel_params += int(np.prod(np.shape(tensors[key])))
     total_params = dense_origin_params + non_kernel_params
     pruned_total_params = dense_pruned_params + non_kernel_params
 
-    ops.reset_default_graph()
-    input_ids = tf.constant([[31, 51, 99], [15, 5, 0]])
+    compact = checkpoint_rewriter.apply_rules(
+        checkpoint_rewriter.ArrayReader(tensors),
+        [rules[key] for layer, key in tensor_names])
+    info = collections.OrderedDict([
+        ("dense_total_params", dense_total_params),
+        ("dense_pruned_params", dense_pruned_params),
+        ("dense_origin_params", dense_origin_params),
+        ("dense_sparsity", 1 - dense_pruned_params / dense_total_params),
+        ("non_kernel_params", non_kernel_params),
+        ("total_params", total_params),
+        ("pruned_total_params", pruned_total_params),
+        ("actual_compact_rate", pruned_total_params / total_params)])
+    return compact, dim_dict, info
+
+
+def write_compact_model(bert_config_file, output_dir, tensors, dim_dict, info,
+                        write_checkpoint=True):
+    """Writes `info.txt`, and the checkpoint and config of a compact model."""
+    tf.gfile.MakeDirs(output_dir)
+    with open(os.path.join(output_dir, "info.txt"), "w") as txt_file:
+        for key, value in info.items():
+            if isinstance(value, float):
+                txt_file.write("%s: %f\n" % (key, value))
+            else:
+                txt_file.write("%s: %d\n" % (key, value))
+    if not write_checkpoint:
+        return
     bert_config = modeling_flop.BertConfig.from_json_file(bert_config_file)
     bert_config.pruned_layers_dim = dim_dict
-    create_model(
-        bert_config=bert_config,
-        is_training=False,
-        input_ids=input_ids,
-        input_mask=None,
-        segment_ids=None,
-        labels=None,
-        num_labels=2)
-    tvars = tf.trainable_variables()
-    sess = tf.Session()
-    sess.run(tf.global_variables_initializer())
-    for tensor_name in tensors.keys():
-        tvar = [v for v in tvars if v.name == tensor_name + ":0"][0]
-        tf.logging.info("Tensor: %s %s", tvar.name, "*INIT_FROM_CKPT*")
-        sess.run(tf.assign(tvar, tensors[tensor_name]))
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    saver = tf.train.Saver()
-    saver.save(sess, os.path.join(output_dir, "bert_model_f.ckpt"))
-    info = ["dense_total_params: %d" % dense_total_params,
-            "dense_pruned_params: %d" % dense_pruned_params,
-            "dense_origin_params: %d" % dense_origin_params,
-            "dense_sparsity: %f" % (
-                1 - dense_pruned_params / dense_total_params),
-            "non_kernel_params: %d" % non_kernel_params,
-            "total_params: %d" % total_params,
-            "pruned_total_params: %d" % pruned_total_params,
-            "actual_compact_rate: %f" % (pruned_total_params / total_params)]
-    with open(os.path.join(output_dir, "info.txt"), "w") as txt_file:
-        for line in info:
-            txt_file.write(line + "\n")
+    checkpoint_rewriter.write_checkpoint(
+        os.path.join(output_dir, "bert_model_f.ckpt"), tensors)
     with open(os.path.join(output_dir, "bert_config.json"), "w") as json_file:
         json_file.write(bert_config.to_json_string())
 
 
+def remove_mask(bert_config_file, init_checkpoint, output_dir, threshold=0,
+                base_checkpoint=None):
+    """Writes the masked model of `init_checkpoint` without its masks.
+
+    See `compact_tensors`. The checkpoint is rewritten from the arrays with
+    `checkpoint_rewriter`, without building the model.
+    """
+    log_alphas, tensor_names, tensors = load_masked_tensors(
+        init_checkpoint, base_checkpoint)
+    compact, dim_dict, info = compact_tensors(
+        log_alphas, tensor_names, tensors, threshold=threshold)
+    for layer, key in tensor_names:
+        tf.logging.info("Tensor: %s %s", key + ":0", "*INIT_FROM_CKPT*")
+    write_compact_model(bert_config_file, output_dir, compact, dim_dict, info)
+
+
+def dev_set_evaluator(task_name, data_dir, vocab_file, do_lower_case,
+                      max_seq_length, eval_batch_size, output_dir):
+    """Returns `evaluate(model_dir)` scoring a compact model on the dev set.
+
+    The dev set is converted to features once, into `output_dir`, and shared
+    by every model. `evaluate` loads the `remove_mask` output of `model_dir`
+    and returns the name and value of the task metric and the seconds the
+    evaluation took.
+    """
+    # Imported here so that plain mask removal does not define the flags.
+    import run_classifier
+    import tokenization
+    processor = run_classifier.processors[task_name.lower()]()
+    label_list = processor.get_labels()
+    sts = len(label_list) == 0
+    tokenizer = tokenization.FullTokenizer(
+        vocab_file=vocab_file, do_lower_case=do_lower_case,
+        word_cache_size=tokenization.DEFAULT_WORD_CACHE_SIZE)
+    tf.gfile.MakeDirs(output_dir)
+    eval_file = os.path.join(output_dir, "eval.tf_record")
+    run_classifier.file_based_convert_examples_to_features(
+        processor.get_dev_examples(data_dir), label_list, max_seq_length,
+        tokenizer, eval_file)
+    metric = "pearson" if sts else "eval_accuracy"
+
+    def evaluate(model_dir):
+        bert_config = modeling_flop.BertConfig.from_json_file(
+            os.path.join(model_dir, "bert_config.json"))
+        model_fn = run_classifier.model_fn_builder(
+            bert_config=bert_config,
+            num_labels=len(label_list),
+            init_checkpoint=os.path.join(model_dir, "bert_model_f.ckpt"),
+            learning_rate=0,
+            num_train_steps=None,
+            num_warmup_steps=None,
+            learning_rate_warmup=0,
+            lambda_learning_rate=0,
+            alpha_learning_rate=0,
+            target_sparsity=0,
+            target_sparsity_warmup=0,
+            factorized=True)
+        # A fresh model_dir, so the weights come from `init_checkpoint`.
+        estimator = tf.estimator.Estimator(
+            model_fn=model_fn, model_dir=os.path.join(model_dir, "eval"))
+        input_fn = run_classifier.file_based_input_fn_builder(
+            input_file=eval_file,
+            seq_length=max_seq_length,
+            is_training=False,
+            drop_remainder=False,
+            sts=sts,
+            batch_size=eval_batch_size)
+        start = time.time()
+        result = estimator.evaluate(input_fn=input_fn)
+        return metric, float(result[metric]), time.time() - start
+
+    return evaluate
+
+
+def pareto_front(sizes, scores):
+    """Returns the indices of the models no smaller and better model beats."""
+    front = []
+    for i in range(len(sizes)):
+        if not any(sizes[j] <= sizes[i] and scores[j] >= scores[i] and
+                   (sizes[j] < sizes[i] or scores[j] > scores[i])
+                   for j in range(len(sizes))):
+            front.append(i)
+    return front
+
+
+def sweep(bert_config_file, init_checkpoint, output_dir, thresholds,
+          base_checkpoint=None, write_checkpoints=False, evaluate=None):
+    """Runs `remove_mask` at every threshold of `thresholds`.
+
+    The checkpoint is read once and compacted in memory per threshold, into
+    `output_dir/threshold_<t>`. The checkpoints are only kept with
+    `write_checkpoints`, or written for the time `evaluate`, e.g. of
+    `dev_set_evaluator`, scores them. `sweep.tsv` lists the size and dense
+    FLOPs per token of every model, with its metric, eval time and whether
+    it is on the accuracy-vs-size Pareto front when evaluated.
+    """
+    log_alphas, tensor_names, tensors = load_masked_tensors(
+        init_checkpoint, base_checkpoint)
+    rows = []
+    metric = None
+    for threshold in sorted(thresholds):
+        compact, dim_dict, info = compact_tensors(
+            log_alphas, tensor_names, tensors, threshold=threshold)
+        model_dir = os.path.join(output_dir, "threshold_%g" % threshold)
+        write_compact_model(
+            bert_config_file, model_dir, compact, dim_dict, info,
+            write_checkpoint=write_checkpoints or evaluate is not None)
+        row = collections.OrderedDict([
+            ("threshold", threshold),
+            ("pruned_total_params", info["pruned_total_params"]),
+            ("actual_compact_rate", info["actual_compact_rate"]),
+            ("dense_sparsity", info["dense_sparsity"]),
+            # A multiply and an add per kernel weight.
+            ("dense_flops_per_token", 2 * info["dense_pruned_params"])])
+        if evaluate is not None:
+            metric, value, seconds = evaluate(model_dir)
+            row[metric] = value
+            row["eval_seconds"] = seconds
+            if not write_checkpoints:
+                for path in tf.gfile.Glob(
+                        os.path.join(model_dir, "bert_model_f.ckpt*")):
+                    tf.gfile.Remove(path)
+            tf.gfile.DeleteRecursively(os.path.join(model_dir, "eval"))
+        tf.logging.info("Threshold %g: %s", threshold, ", ".join(
+            "%s=%s" % item for item in list(row.items())[1:]))
+        rows.append(row)
+
+    if metric is not None:
+        front = pareto_front([row["pruned_total_params"] for row in rows],
+                             [row[metric] for row in rows])
+        for i, row in enumerate(rows):
+            row["pareto"] = int(i in front)
+    with open(os.path.join(output_dir, "sweep.tsv"), "w") as tsv_file:
+        tsv_file.write("\t".join(rows[0].keys()) + "\n")
+        for row in rows:
+            tsv_file.write("\t".join(str(value) for value in row.values())
+                           + "\n")
+    return rows
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--bert_config_file", help="bert config file")
@@ -173,10 +288,51 @@ if __name__ == "__main__":
         "--checkpoint", help="factorized checkpoint to remove mask")
     parser.add_argument("--output_folder_dir", help="output folder directory")
     parser.add_argument("--threshold", help="mask pruned threshold", type=float)
+    parser.add_argument(
+        "--base_checkpoint", help="init checkpoint of a --mask_only run, " +
+        "the variables missing from --checkpoint are read from it")
+    parser.add_argument(
+        "--thresholds", help="comma separated thresholds to sweep instead " +
+        "of --threshold, one threshold_<t> directory and a sweep.tsv row each")
+    parser.add_argument(
+        "--write_checkpoints", action="store_true",
+        help="keep the compact checkpoint of every swept threshold")
+    parser.add_argument(
+        "--eval", action="store_true",
+        help="evaluate every swept model on the dev set of --task_name")
+    parser.add_argument("--task_name", help="task of --eval")
+    parser.add_argument("--data_dir", help="data directory of --eval")
+    parser.add_argument("--vocab_file", help="vocab file of --eval")
+    parser.add_argument(
+        "--do_lower_case", type=lambda x: x.lower() == "true", default=True,
+        help="whether --eval lower cases the input")
+    parser.add_argument("--max_seq_length", type=int, default=128)
+    parser.add_argument("--eval_batch_size", type=int, default=8)
     args = parser.parse_args()
     tf.logging.set_verbosity(tf.logging.DEBUG)
-    remove_mask(
-        bert_config_file=args.bert_config_file,
-        init_checkpoint=args.checkpoint,
-        output_dir=args.output_folder_dir,
-        threshold=args.threshold)
+    if args.thresholds:
+        evaluate = None
+        if args.eval:
+            evaluate = dev_set_evaluator(
+                task_name=args.task_name,
+                data_dir=args.data_dir,
+                vocab_file=args.vocab_file,
+                do_lower_case=args.do_lower_case,
+                max_seq_length=args.max_seq_length,
+                eval_batch_size=args.eval_batch_size,
+                output_dir=args.output_folder_dir)
+        sweep(
+            bert_config_file=args.bert_config_file,
+            init_checkpoint=args.checkpoint,
+            output_dir=args.output_folder_dir,
+            thresholds=[float(t) for t in args.thresholds.split(",")],
+            base_checkpoint=args.base_checkpoint,
+            write_checkpoints=args.write_checkpoints,
+            evaluate=evaluate)
+    else:
+        remove_mask(
+            bert_config_file=args.bert_config_file,
+            init_checkpoint=args.checkpoint,
+            output_dir=args.output_folder_dir,
+            threshold=args.threshold,
+            base_checkpoint=args.base_checkpoint)
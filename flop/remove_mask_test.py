@@ -0,0 +1,96 @@
+"""Tests of the gate thresholding of remove_mask."""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../bert"))
+import math
+import numpy as np
+import tensorflow as tf
+import remove_mask
+
+
+def reference_hard_concrete_sample(tensor):
+    """The scalar implementation remove_mask used to have."""
+    def sigmoid(x):
+        return 1 / (1 + math.exp(-x))
+    sigmoid_v = np.vectorize(sigmoid)
+    tensor = sigmoid_v(tensor) * (remove_mask.LIMIT_R -
+                                  remove_mask.LIMIT_L) + remove_mask.LIMIT_L
+    return np.clip(tensor, 0, 1.0)
+
+
+def reference_get_index(tensor, threshold=0.3):
+    tensor = reference_hard_concrete_sample(tensor)
+    indexes = np.array([])
+    for i in range(len(tensor)):
+        if tensor[i] > threshold:
+            indexes = np.append(indexes, i)
+    indexes = indexes.astype(int)
+    return tensor, indexes
+
+
+def reference_mask_row(tensor, indexes):
+    return tensor[indexes]
+
+
+def reference_mask_col(tensor, indexes):
+    return tensor[:, indexes]
+
+
+class RemoveMaskTest(tf.test.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.log_alpha = (rng.randn(64) * 4).astype(np.float32)
+        self.kernel_p = rng.randn(16, 64).astype(np.float32)
+        self.kernel_q = rng.randn(64, 8).astype(np.float32)
+
+    def test_hard_concrete_sample(self):
+        self.assertAllClose(
+            remove_mask.hard_concrete_sample(self.log_alpha),
+            reference_hard_concrete_sample(self.log_alpha))
+
+    def test_get_index(self):
+        for threshold in [0.0, 0.3, 0.5, 0.9, 1.0]:
+            gates, index = remove_mask.get_index(self.log_alpha, threshold)
+            reference_gates, reference_index = reference_get_index(
+                self.log_alpha, threshold)
+            self.assertAllClose(gates, reference_gates)
+            self.assertAllEqual(index, reference_index)
+            self.assertEqual(index.dtype.kind, "i")
+
+    def test_compact_tensors(self):
+        tensors = {"layer_0/dense_g/log_alpha": self.log_alpha,
+                   "layer_0/dense_p/kernel": self.kernel_p,
+                   "layer_0/dense_q/kernel": self.kernel_q,
+                   "layer_0/dense_q/bias": np.zeros(8, np.float32)}
+        log_alphas = [[0, "layer_0/dense_g/log_alpha"]]
+        tensor_names = [[0, "layer_0/dense_p/kernel"],
+                        [0, "layer_0/dense_q/bias"],
+                        [0, "layer_0/dense_q/kernel"]]
+        compact, dim_dict, info = remove_mask.compact_tensors(
+            log_alphas, tensor_names, tensors, threshold=0.5)
+
+        reference_gates, reference_index = reference_get_index(
+            self.log_alpha, 0.5)
+        reference_p = reference_mask_col(
+            self.kernel_p.dot(np.diag(reference_gates)), reference_index)
+        reference_q = reference_mask_row(self.kernel_q, reference_index)
+        self.assertAllClose(compact["layer_0/dense_p/kernel"], reference_p)
+        self.assertAllEqual(compact["layer_0/dense_q/kernel"], reference_q)
+        self.assertEqual(compact["layer_0/dense_p/kernel"].dtype, np.float32)
+        self.assertEqual(sorted(compact), sorted(tensors)[1:])
+        self.assertEqual(dim_dict,
+                         {"layer_0/dense_p/kernel": len(reference_index)})
+        self.assertEqual(info["dense_pruned_params"],
+                         (16 + 8) * len(reference_index))
+        self.assertEqual(info["pruned_total_params"],
+                         (16 + 8) * len(reference_index) + 8)
+
+    def test_pareto_front(self):
+        sizes = [100, 80, 80, 60, 40]
+        scores = [0.93, 0.93, 0.92, 0.90, 0.91]
+        self.assertEqual(remove_mask.pareto_front(sizes, scores), [1, 4])
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -22,10 +22,14 @@ import sys
 sys.path.append(sys.path[0] + '/../bert')
 
 import collections
+import multiprocessing
 import os
 import modeling
 import modeling_flop
 import optimization_flop
+import compaction
+import feature_cache
+import profiling
 import tokenization
 import tensorflow as tf
 import numpy as np
@@ -145,9 +149,110 @@ flags.DEFINE_float(
 
 flags.DEFINE_bool("factorized", False, "Factorized model or not")
 
+flags.DEFINE_string(
+    "feature_cache_dir", None,
+    "Directory of the tokenized TFRecord features, shared across runs and "
+    "keyed by the contents of the data, the vocab and the conversion "
+    "settings. Defaults to `feature_cache` in the (untimestamped) "
+    "output_dir.")
+
+flags.DEFINE_integer(
+    "num_feature_shards", 16,
+    "Number of TFRecord shards the features of every split are written to. "
+    "The shards only depend on this value, not on the number of workers.")
+
+flags.DEFINE_integer(
+    "shuffle_buffer_size", 10000,
+    "Number of training records the input pipeline shuffles over.")
+
+flags.DEFINE_bool(
+    "dynamic_padding", False,
+    "Store the features without padding and pad every batch only up to its "
+    "longest sequence instead of max_seq_length.")
+
+flags.DEFINE_integer(
+    "length_bucket_width", 16,
+    "With dynamic_padding, training batches are drawn from buckets of "
+    "sequences whose lengths fall in the same window of this width. 0 "
+    "disables the bucketing.")
+
+flags.DEFINE_integer(
+    "pack_examples_per_row", 0,
+    "If positive, pack up to this many training examples into every "
+    "max_seq_length row, with attention restricted to each example. Eval "
+    "and predict are not packed.")
+
+flags.DEFINE_integer(
+    "profile_input_batches", 0,
+    "If positive, time this many batches of the training input pipeline on "
+    "its own before training and log whether training is input-bound or "
+    "compute-bound.")
+
+flags.DEFINE_bool(
+    "persist_word_cache", False,
+    "Warm the tokenizers of the conversion workers from a word cache beside "
+    "vocab_file and save the warmed cache back there.")
+
+flags.DEFINE_integer(
+    "num_conversion_workers", 0,
+    "Number of processes converting examples to features, each with its own "
+    "tokenizer. Defaults to the number of CPUs.")
+
+flags.DEFINE_float(
+    "active_gate_bound", 0.0,
+    "If positive, training gathers only the mask dimensions whose gate is "
+    "non-zero with a probability above this bound and runs the factorized "
+    "matmuls on those slices, e.g. 1e-3.")
+
+flags.DEFINE_bool(
+    "mask_only", False,
+    "Train only the masks and the Lagrange multipliers (as with "
+    "learning_rate=0). Every variable found in init_checkpoint is then loaded "
+    "as a non-trainable local variable, so no gradients or Adam slots are "
+    "built for it and checkpoints only hold the trained variables as a delta "
+    "on top of init_checkpoint. Eval graphs are not frozen in this mode.")
+
+flags.DEFINE_bool(
+    "fused_adam", False,
+    "Keep the Adam slots of each optimizer in flat buffers and update them "
+    "with a few vectorized ops instead of ~10 ops per variable. The numbers "
+    "are the same, but the checkpoints are not interchangeable with unfused "
+    "ones.")
+
+flags.DEFINE_integer(
+    "compact_every_steps", 0,
+    "If positive, check the masks every this many steps and physically remove "
+    "the dimensions that stay dead, then resume training on the smaller "
+    "model.")
+
+flags.DEFINE_float(
+    "compact_log_alpha_threshold", -10.0,
+    "A mask dimension is dead while its log_alpha is below this value.")
+
+flags.DEFINE_integer(
+    "compact_patience", 3,
+    "Number of consecutive checks a dimension must be dead before it is "
+    "removed.")
+
+flags.DEFINE_integer(
+    "compact_min_dims", 128,
+    "Minimum number of dead dimensions, summed over all masks, to compact "
+    "at once. Every compaction restarts training, so small values restart "
+    "often for little gain.")
+
+flags.DEFINE_bool(
+    "freeze_eval_masks", True,
+    "Whether to fold the deterministic gates into the `_p` kernels and drop "
+    "the zero-gated dimensions when evaluating or predicting, so the masked "
+    "model runs at the cost of the compacted one. If false, the gates and "
+    "the gated `_p` kernels are recomputed for every batch.")
+
 class InputFeatures(object):
   """A single set of features of data."""
 
+  __slots__ = ("input_ids", "input_mask", "segment_ids", "label_id",
+               "is_real_example")
+
   def __init__(self,
                input_ids,
                input_mask,
@@ -161,9 +266,90 @@ class InputFeatures(object):
     self.is_real_example = is_real_example
 
 
+class FeatureStore(object):
+  """The `InputFeatures` of a set of examples, stored column by column.
+
+  `input_ids`, `input_mask` and `segment_ids` are [num_examples, seq_length]
+  int32 arrays, and `label_ids` (float32 for regression tasks) and
+  `is_real_example` have one entry per example, so a feature value takes
+  4 bytes instead of a boxed Python int and a list slot. Indexing returns an
+  `InputFeatures` whose sequences are views into the rows.
+  """
+
+  __slots__ = ("input_ids", "input_mask", "segment_ids", "label_ids",
+               "is_real_example", "num_examples")
+
+  def __init__(self, capacity, seq_length, sts=False):
+    self.input_ids = np.zeros([capacity, seq_length], dtype=np.int32)
+    self.input_mask = np.zeros([capacity, seq_length], dtype=np.int32)
+    self.segment_ids = np.zeros([capacity, seq_length], dtype=np.int32)
+    self.label_ids = np.zeros(
+        [capacity], dtype=np.float32 if sts else np.int32)
+    self.is_real_example = np.zeros([capacity], dtype=np.int32)
+    self.num_examples = 0
+
+  @classmethod
+  def from_features(cls, features, seq_length, sts=None):
+    """Copies a list of padded `InputFeatures` into a new store.
+
+    Unless `sts` is given, float labels make a regression store.
+    """
+    if sts is None:
+      sts = bool(features) and isinstance(features[0].label_id, float)
+    store = cls(len(features), seq_length, sts=sts)
+    for feature in features:
+      store.append(feature)
+    return store
+
+  def append(self, feature):
+    """Copies a padded `InputFeatures` into the next free row."""
+    if self.num_examples == len(self.label_ids):
+      self._resize(max(2 * self.num_examples, 1))
+    i = self.num_examples
+    self.input_ids[i] = feature.input_ids
+    self.input_mask[i] = feature.input_mask
+    self.segment_ids[i] = feature.segment_ids
+    self.label_ids[i] = feature.label_id
+    self.is_real_example[i] = int(feature.is_real_example)
+    self.num_examples += 1
+
+  def trim(self):
+    """Drops the unused rows so that every array holds `len(self)` rows."""
+    self._resize(self.num_examples)
+
+  def _resize(self, capacity):
+    if capacity == len(self.label_ids):
+      return
+    for name in ["input_ids", "input_mask", "segment_ids", "label_ids",
+                 "is_real_example"]:
+      column = getattr(self, name)
+      resized = np.zeros([capacity] + list(column.shape[1:]),
+                         dtype=column.dtype)
+      size = min(capacity, len(column))
+      resized[:size] = column[:size]
+      setattr(self, name, resized)
+
+  def __len__(self):
+    return self.num_examples
+
+  def __getitem__(self, index):
+    if not 0 <= index < self.num_examples:
+      raise IndexError("FeatureStore index out of range")
+    return InputFeatures(
+        input_ids=self.input_ids[index],
+        input_mask=self.input_mask[index],
+        segment_ids=self.segment_ids[index],
+        label_id=self.label_ids[index],
+        is_real_example=bool(self.is_real_example[index]))
+
+
 def convert_single_example(ex_index, example, label_list, max_seq_length,
-                           tokenizer):
-  """Converts a single `InputExample` into a single `InputFeatures`."""
+                           tokenizer, pad_to_max_length=True):
+  """Converts a single `InputExample` into a single `InputFeatures`.
+
+  If `pad_to_max_length` is false, the features keep the length of the
+  example and the input pipeline pads them per batch.
+  """
   sts = True if len(label_list) == 0 else False
 
   if not sts:
@@ -228,14 +414,15 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   input_mask = [1] * len(input_ids)
 
   # Zero-pad up to the sequence length.
-  while len(input_ids) < max_seq_length:
-    input_ids.append(0)
-    input_mask.append(0)
-    segment_ids.append(0)
+  if pad_to_max_length:
+    while len(input_ids) < max_seq_length:
+      input_ids.append(0)
+      input_mask.append(0)
+      segment_ids.append(0)
 
-  assert len(input_ids) == max_seq_length
-  assert len(input_mask) == max_seq_length
-  assert len(segment_ids) == max_seq_length
+    assert len(input_ids) == max_seq_length
+    assert len(input_mask) == max_seq_length
+    assert len(segment_ids) == max_seq_length
 
   label_id = label_map[example.label] if not sts else example.label
 
@@ -249,7 +436,8 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
 
 
 def file_based_convert_examples_to_features(
-    examples, label_list, max_seq_length, tokenizer, output_file):
+    examples, label_list, max_seq_length, tokenizer, output_file,
+    pad_to_max_length=True):
   """Convert a set of `InputExample`s to a TFRecord file."""
 
   writer = tf.python_io.TFRecordWriter(output_file)
@@ -259,7 +447,8 @@ def file_based_convert_examples_to_features(
       tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
 
     feature = convert_single_example(ex_index, example, label_list,
-                                     max_seq_length, tokenizer)
+                                     max_seq_length, tokenizer,
+                                     pad_to_max_length=pad_to_max_length)
 
     def create_int_feature(values):
       f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
@@ -287,9 +476,233 @@ def file_based_convert_examples_to_features(
   writer.close()
 
 
+def pack_rows(lengths, max_seq_length, max_examples_per_row):
+  """Groups sequences of `lengths` into rows of at most `max_seq_length`.
+
+  The sequences are placed from the longest to the shortest, each into the
+  open row with the least room left that still fits it (best fit), so the
+  rows are deterministic and mostly full.
+
+  Returns:
+    A list of rows, each the list of the indices of its sequences.
+  """
+  rows = []
+  # Indices of the rows that can still take a sequence, by their room left.
+  open_rows = collections.defaultdict(list)
+  order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+  for i in order:
+    length = lengths[i]
+    room = None
+    for candidate in range(length, max_seq_length + 1):
+      if open_rows[candidate]:
+        room = candidate
+        row = open_rows[candidate].pop()
+        break
+    if room is None:
+      room = max_seq_length
+      row = len(rows)
+      rows.append([])
+    rows[row].append(i)
+    room -= length
+    if room > 0 and len(rows[row]) < max_examples_per_row:
+      open_rows[room].append(row)
+  return rows
+
+
+def file_based_convert_examples_to_packed_features(
+    examples, label_list, max_seq_length, tokenizer, output_file,
+    max_examples_per_row):
+  """Convert a set of `InputExample`s to a TFRecord file of packed rows.
+
+  Every row holds up to `max_examples_per_row` examples, see `pack_rows`.
+  `input_mask` holds the 1-based index of the example of every token (0 for
+  padding) and `position_ids` its position in the example. `cls_positions`,
+  `label_ids` and `is_real_example` have one entry per example slot, with
+  `is_real_example` 0 for the empty slots.
+  """
+
+  writer = tf.python_io.TFRecordWriter(output_file)
+
+  features = []
+  for (ex_index, example) in enumerate(examples):
+    if ex_index % 10000 == 0:
+      tf.logging.info("Converting example %d of %d" % (ex_index, len(examples)))
+    features.append(convert_single_example(ex_index, example, label_list,
+                                           max_seq_length, tokenizer,
+                                           pad_to_max_length=False))
+
+  rows = pack_rows([len(feature.input_ids) for feature in features],
+                   max_seq_length, max_examples_per_row)
+  tf.logging.info("Packed %d examples into %d rows" % (len(features), len(rows)))
+
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
+
+  def create_float_feature(values):
+    f = tf.train.Feature(float_list=tf.train.FloatList(value=list(values)))
+    return f
+
+  for row in rows:
+    input_ids = []
+    input_mask = []
+    segment_ids = []
+    position_ids = []
+    cls_positions = []
+    label_ids = []
+    is_real_example = []
+    for (slot, index) in enumerate(row):
+      feature = features[index]
+      cls_positions.append(len(input_ids))
+      label_ids.append(feature.label_id)
+      is_real_example.append(int(feature.is_real_example))
+      input_ids.extend(feature.input_ids)
+      input_mask.extend([slot + 1] * len(feature.input_ids))
+      segment_ids.extend(feature.segment_ids)
+      position_ids.extend(range(len(feature.input_ids)))
+
+    while len(input_ids) < max_seq_length:
+      input_ids.append(0)
+      input_mask.append(0)
+      segment_ids.append(0)
+      position_ids.append(0)
+
+    while len(cls_positions) < max_examples_per_row:
+      cls_positions.append(0)
+      label_ids.append(0)
+      is_real_example.append(0)
+
+    features_dict = collections.OrderedDict()
+    features_dict["input_ids"] = create_int_feature(input_ids)
+    features_dict["input_mask"] = create_int_feature(input_mask)
+    features_dict["segment_ids"] = create_int_feature(segment_ids)
+    features_dict["position_ids"] = create_int_feature(position_ids)
+    features_dict["cls_positions"] = create_int_feature(cls_positions)
+
+    if len(label_list) == 0:
+      features_dict["label_ids"] = create_float_feature(label_ids)
+    else:
+      features_dict["label_ids"] = create_int_feature(label_ids)
+
+    features_dict["is_real_example"] = create_int_feature(is_real_example)
+
+    tf_example = tf.train.Example(
+        features=tf.train.Features(feature=features_dict))
+    writer.write(tf_example.SerializeToString())
+  writer.close()
+
+
+def count_records(input_files):
+  """Returns the number of records in a list of TFRecord files."""
+  return sum(sum(1 for _ in tf.python_io.tf_record_iterator(input_file))
+             for input_file in input_files)
+
+
+# The tokenizer of a conversion worker process, see `_init_conversion_worker`.
+_worker_tokenizer = None
+
+
+def _init_conversion_worker(vocab_file, do_lower_case, word_cache_file=None):
+  """Gives every conversion worker its own `FullTokenizer`."""
+  global _worker_tokenizer
+  _worker_tokenizer = tokenization.FullTokenizer(
+      vocab_file=vocab_file,
+      do_lower_case=do_lower_case,
+      word_cache_size=tokenization.DEFAULT_WORD_CACHE_SIZE,
+      word_cache_file=word_cache_file)
+
+
+def _convert_shard(args):
+  """Writes one shard of examples with the tokenizer of the worker.
+
+  Returns the word cache of the worker when it is persisted, else None.
+  """
+  (examples, label_list, max_seq_length, output_file, pad_to_max_length,
+   max_examples_per_row) = args
+  if max_examples_per_row > 0:
+    file_based_convert_examples_to_packed_features(
+        examples, label_list, max_seq_length, _worker_tokenizer, output_file,
+        max_examples_per_row)
+  else:
+    file_based_convert_examples_to_features(
+        examples, label_list, max_seq_length, _worker_tokenizer, output_file,
+        pad_to_max_length=pad_to_max_length)
+  tf.logging.info("Word cache hit rate: %.3f",
+                  _worker_tokenizer.word_cache_hit_rate())
+  if _worker_tokenizer.word_cache_file:
+    return _worker_tokenizer.word_cache_items()
+  return None
+
+
+def sharded_convert_examples_to_features(
+    examples, label_list, max_seq_length, vocab_file, do_lower_case,
+    output_files, num_workers, pad_to_max_length=True,
+    max_examples_per_row=0, word_cache_file=None):
+  """Converts a set of `InputExample`s to one TFRecord file per shard.
+
+  The examples are split into `len(output_files)` contiguous chunks, so
+  reading `output_files` in order yields the same records as
+  `file_based_convert_examples_to_features`, whatever `num_workers` is. If
+  `max_examples_per_row` is positive, every chunk is packed on its own with
+  `file_based_convert_examples_to_packed_features`. Each worker warms its
+  tokenizer from `word_cache_file`, and the caches of all the workers are
+  merged and saved back there once.
+
+  `examples` can be an `ExampleStream`, whose chunks are streams too: the
+  workers then parse only their own rows of the data file, and no process
+  holds the whole set in memory.
+  """
+  num_shards = len(output_files)
+  bounds = [len(examples) * i // num_shards for i in range(num_shards + 1)]
+  shards = [(examples[bounds[i]:bounds[i + 1]], label_list, max_seq_length,
+             output_files[i], pad_to_max_length, max_examples_per_row)
+            for i in range(num_shards)]
+
+  if num_workers <= 1:
+    _init_conversion_worker(vocab_file, do_lower_case, word_cache_file)
+    for shard in shards:
+      _convert_shard(shard)
+    if word_cache_file:
+      _worker_tokenizer.save_word_cache()
+    return
+
+  # The estimator may already have started TensorFlow's thread pools, which
+  # do not survive a fork, so the workers are spawned.
+  pool = multiprocessing.get_context("spawn").Pool(
+      num_workers,
+      initializer=_init_conversion_worker,
+      initargs=(vocab_file, do_lower_case, word_cache_file))
+  try:
+    word_caches = pool.map(_convert_shard, shards, chunksize=1)
+  finally:
+    pool.terminate()
+    pool.join()
+
+  if word_cache_file:
+    tokenizer = tokenization.FullTokenizer(
+        vocab_file=vocab_file,
+        do_lower_case=do_lower_case,
+        word_cache_size=tokenization.DEFAULT_WORD_CACHE_SIZE,
+        word_cache_file=word_cache_file)
+    for word_cache in word_caches:
+      tokenizer.update_word_cache(word_cache)
+    tokenizer.save_word_cache()
+
+
 def file_based_input_fn_builder(input_file, seq_length, is_training,
-                                drop_remainder, sts, batch_size):
-  """Creates an `input_fn` closure to be passed to TrainSpec."""
+                                drop_remainder, sts, batch_size,
+                                shuffle_buffer_size=100, num_cpu_threads=4,
+                                dynamic_padding=False, bucket_boundaries=None,
+                                max_examples_per_row=0):
+  """Creates an `input_fn` closure to be passed to TrainSpec.
+
+  `input_file` is a TFRecord file or a list of shards, read in order.
+  `dynamic_padding` reads unpadded records and pads every batch to its
+  longest sequence, so the batches have a dynamic `seq_length` of at most
+  `seq_length`. When training, `bucket_boundaries` then groups sequences of
+  similar length into the same batch. A positive `max_examples_per_row`
+  reads the packed rows of `file_based_convert_examples_to_packed_features`.
+  """
 
   name_to_features = {
       "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
@@ -298,11 +711,37 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
       "label_ids": tf.FixedLenFeature([], tf.int64) if not sts else tf.FixedLenFeature([], tf.float32),
       "is_real_example": tf.FixedLenFeature([], tf.int64),
   }
+  if dynamic_padding:
+    for name in ["input_ids", "input_mask", "segment_ids"]:
+      name_to_features[name] = tf.VarLenFeature(tf.int64)
+  if max_examples_per_row > 0:
+    name_to_features["position_ids"] = tf.FixedLenFeature(
+        [seq_length], tf.int64)
+    name_to_features["cls_positions"] = tf.FixedLenFeature(
+        [max_examples_per_row], tf.int64)
+    name_to_features["label_ids"] = tf.FixedLenFeature(
+        [max_examples_per_row], tf.int64 if not sts else tf.float32)
+    name_to_features["is_real_example"] = tf.FixedLenFeature(
+        [max_examples_per_row], tf.int64)
 
   def _decode_record(record, name_to_features):
-    """Decodes a record to a TensorFlow example."""
+    """Decodes an unpadded record to a TensorFlow example."""
     example = tf.parse_single_example(record, name_to_features)
 
+    for name in list(example.keys()):
+      t = example[name]
+      if isinstance(t, tf.SparseTensor):
+        t = tf.sparse.to_dense(t)
+      if t.dtype == tf.int64:
+        t = tf.to_int32(t)
+      example[name] = t
+
+    return example
+
+  def _decode_batch(records, name_to_features):
+    """Decodes a batch of records to TensorFlow examples in one op."""
+    example = tf.parse_example(records, name_to_features)
+
     # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
     # So cast all int64 to int32.
     for name in list(example.keys()):
@@ -315,24 +754,64 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
 
   def input_fn(params=None):
     """The actual input function."""
+    input_files = input_file
+    if not isinstance(input_files, (list, tuple)):
+      input_files = [input_files]
+
     # For training, we want a lot of parallel reading and shuffling.
     # For eval, we want no shuffling and parallel reading doesn't matter.
-    d = tf.data.TFRecordDataset(input_file)
     if is_training:
+      d = tf.data.Dataset.from_tensor_slices(tf.constant(input_files))
       d = d.repeat()
-      d = d.shuffle(buffer_size=100)
-
-    d = d.apply(
-        tf.contrib.data.map_and_batch(
-            lambda record: _decode_record(record, name_to_features),
-            batch_size=batch_size,
-            drop_remainder=drop_remainder))
+      d = d.shuffle(buffer_size=len(input_files))
+
+      # `sloppy` mode means that the interleaving is not exact. This adds
+      # even more randomness to the training pipeline.
+      cycle_length = min(num_cpu_threads, len(input_files))
+      d = d.apply(
+          tf.data.experimental.parallel_interleave(
+              tf.data.TFRecordDataset,
+              sloppy=True,
+              cycle_length=cycle_length))
+      d = d.shuffle(buffer_size=shuffle_buffer_size)
+    else:
+      d = tf.data.TFRecordDataset(input_files)
+
+    if not dynamic_padding:
+      # Batch first so that every batch is parsed by a single vectorized op.
+      d = d.batch(batch_size, drop_remainder=drop_remainder)
+      d = d.map(
+          lambda records: _decode_batch(records, name_to_features),
+          num_parallel_calls=num_cpu_threads)
+    else:
+      d = d.map(
+          lambda record: _decode_record(record, name_to_features),
+          num_parallel_calls=num_cpu_threads)
+      if is_training and bucket_boundaries:
+        d = d.apply(
+            tf.data.experimental.bucket_by_sequence_length(
+                element_length_func=lambda example: tf.shape(
+                    example["input_ids"])[0],
+                bucket_boundaries=bucket_boundaries,
+                bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+                drop_remainder=drop_remainder))
+      else:
+        d = d.padded_batch(
+            batch_size,
+            padded_shapes=d.output_shapes,
+            drop_remainder=drop_remainder)
+    d = d.prefetch(tf.data.experimental.AUTOTUNE)
 
     return d
 
   return input_fn
 
 
+def length_bucket_boundaries(max_seq_length, bucket_width):
+  """Returns the boundaries of buckets of sequence lengths `bucket_width` wide."""
+  return list(range(bucket_width + 1, max_seq_length + 1, bucket_width))
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
   """Truncates a sequence pair in place to the maximum length."""
 
@@ -351,15 +830,25 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
 
 
 def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
-                 labels, num_labels):
-  """Creates a classification model."""
+                 labels, num_labels, freeze_masks=False,
+                 position_ids=None, cls_positions=None, label_weights=None,
+                 factorize=False):
+  """Creates a classification model.
+
+  For packed rows, `labels` and `label_weights` have one entry per example
+  slot and the loss is the mean over the slots with a non-zero weight.
+  `factorize` builds the factorized model without masks.
+  """
   model = modeling_flop.BertModelHardConcrete(
       config=bert_config,
       is_training=is_training,
       input_ids=input_ids,
       input_mask=input_mask,
       token_type_ids=segment_ids,
-      factorize=FLAGS.factorized)
+      factorize=factorize,
+      freeze_masks=freeze_masks,
+      position_ids=position_ids,
+      cls_positions=cls_positions)
 
   # In the demo, we are doing a simple classification task on the entire
   # segment.
@@ -398,18 +887,51 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
       logits = tf.squeeze(logits, [-1])
       per_example_loss = tf.square(logits - labels)
 
-    loss = tf.reduce_mean(per_example_loss)
+    if label_weights is None:
+      loss = tf.reduce_mean(per_example_loss)
+    else:
+      loss = (tf.reduce_sum(per_example_loss * label_weights) /
+              (tf.reduce_sum(label_weights) + 1e-5))
 
     return (loss, per_example_loss, logits, probabilities)
 
 
+def mask_only_getter_builder(init_checkpoint):
+  """Returns a custom getter that turns checkpoint variables into constants.
+
+  Every variable that exists in `init_checkpoint`, except the `log_alpha`
+  masks, is created as a non-trainable, unregularized local variable. Local
+  variables are initialized (from `init_checkpoint`) after every restore and
+  are not saved, so the checkpoints only hold the trained delta.
+  """
+  checkpoint_names = set(
+      name for (name, _) in tf.train.list_variables(init_checkpoint))
+
+  def getter(getter, name, *args, **kwargs):
+    if name in checkpoint_names and not name.endswith("log_alpha"):
+      kwargs["trainable"] = False
+      kwargs["collections"] = [tf.GraphKeys.LOCAL_VARIABLES]
+      kwargs["regularizer"] = None
+    return getter(name, *args, **kwargs)
+
+  return getter
+
+
 def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, 
                      learning_rate_warmup, lambda_learning_rate,
-                     alpha_learning_rate, target_sparsity, target_sparsity_warmup):
-  """Returns `model_fn` closure for Estimator."""
-
-  def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
+                     alpha_learning_rate, target_sparsity, target_sparsity_warmup,
+                     prunable_parameters=None, factorized=False,
+                     freeze_eval_masks=True, mask_only=False, fused_adam=False,
+                     hyperparams=None):
+  """Returns `model_fn` closure for Estimator.
+
+  `factorized`, `freeze_eval_masks`, `mask_only` and `fused_adam` mirror the
+  flags of the same names, and `hyperparams` is a list of "name=value"
+  strings written as a text summary when training.
+  """
+
+  def model_fn(features, labels, mode, params, config):  # pylint: disable=unused-argument
     """The `model_fn` for Estimator."""
     input_ids = features["input_ids"]
     input_mask = features["input_mask"]
@@ -421,11 +943,31 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
     else:
       is_real_example = tf.ones(tf.shape(label_ids), dtype=tf.float32)
 
+    # Packed rows carry one label per example slot.
+    position_ids = features.get("position_ids")
+    cls_positions = features.get("cls_positions")
+    label_weights = None
+    if cls_positions is not None:
+      label_ids = tf.reshape(label_ids, [-1])
+      is_real_example = tf.reshape(is_real_example, [-1])
+      label_weights = is_real_example
+
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
 
-    (total_loss, per_example_loss, logits, probabilities) = create_model(
-        bert_config, is_training, input_ids, input_mask, segment_ids, label_ids,
-        num_labels)
+    # The zero gates are read from the restored checkpoint once per session,
+    # also when `evaluate` or `predict` is given a `checkpoint_path`.
+    freeze_masks = (not is_training and freeze_eval_masks and not factorized
+                    and not mask_only)
+
+    custom_getter = None
+    if mask_only:
+      custom_getter = mask_only_getter_builder(init_checkpoint)
+
+    with tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter):
+      (total_loss, per_example_loss, logits, probabilities) = create_model(
+          bert_config, is_training, input_ids, input_mask, segment_ids, label_ids,
+          num_labels, freeze_masks, position_ids, cls_positions,
+          label_weights, factorize=factorized)
 
     sts = True if num_labels == 0 else False
 
@@ -433,7 +975,8 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
     initialized_variable_names = {}
     if init_checkpoint:
       (assignment_map, initialized_variable_names
-      ) = modeling.get_assignment_map_from_checkpoint(tvars, init_checkpoint)
+      ) = modeling.get_assignment_map_from_checkpoint(
+          tvars + tf.local_variables(), init_checkpoint)
       tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
 
     tf.logging.info("**** Trainable Variables ****")
@@ -457,21 +1000,12 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
           alpha_lr=alpha_learning_rate,
           target_sparsity=target_sparsity,
           target_sparsity_warmup=target_sparsity_warmup,
-          factorized=FLAGS.factorized)
+          factorized=factorized,
+          prunable_parameters=prunable_parameters,
+          fused=fused_adam)
       logging_hook = tf.train.LoggingTensorHook({"training_loss": total_loss}, every_n_iter=10)
-      hyperparams = np.array(["batch_size=%d" % FLAGS.train_batch_size,
-                              "epochs=%.2f" % FLAGS.num_train_epochs,
-                              "warmup_proportion=%.2f" % FLAGS.warmup_proportion,
-                              "init_lr=%s" % "{:.2E}".format(FLAGS.learning_rate),
-                              "lambda_lr=%s" % "{:.2E}".format(FLAGS.lambda_learning_rate),
-                              "alpha_lr=%s" % "{:.2E}".format(FLAGS.alpha_learning_rate),
-                              "lr_warmup=%d" % FLAGS.learning_rate_warmup,
-                              "target_sparsity=%.2f" % FLAGS.target_sparsity,
-                              "target_sparsity_warmup=%d" % FLAGS.target_sparsity_warmup,
-                              "hidden_dropout_prob=%.2f" % FLAGS.hidden_dropout_prob,
-                              "attention_probs_dropout_prob=%.2f" % FLAGS.attention_probs_dropout_prob,
-                              "regularization_scale=%s" % "{:.2E}".format(FLAGS.regularization_scale)])
-      hp_op = tf.summary.text("Hyperparameters", tf.constant(hyperparams))
+      if hyperparams:
+        tf.summary.text("Hyperparameters", tf.constant(np.array(hyperparams)))
       output_spec = tf.estimator.EstimatorSpec(
           mode=mode,
           loss=total_loss,
@@ -536,45 +1070,32 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
 # This function is not used by this file but is still used by the Colab and
 # people who depend on it.
 def input_fn_builder(features, seq_length, is_training, drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
 
-  all_input_ids = []
-  all_input_mask = []
-  all_segment_ids = []
-  all_label_ids = []
+  `features` is a `FeatureStore` or a list of padded `InputFeatures`, which
+  is copied into one first. Only the used rows of a store are read, so it
+  is left as it is.
+  """
 
-  for feature in features:
-    all_input_ids.append(feature.input_ids)
-    all_input_mask.append(feature.input_mask)
-    all_segment_ids.append(feature.segment_ids)
-    all_label_ids.append(feature.label_id)
+  if not isinstance(features, FeatureStore):
+    features = FeatureStore.from_features(features, seq_length)
+  num_examples = len(features)
 
   def input_fn(params):
     """The actual input function."""
     batch_size = params["batch_size"]
 
-    num_examples = len(features)
-
     # This is for demo purposes and does NOT scale to large data sets. We do
     # not use Dataset.from_generator() because that uses tf.py_func which is
     # not TPU compatible. The right way to load data is with TFRecordReader.
+    # The int32 columns are handed over as they are, without converting any
+    # Python values.
     d = tf.data.Dataset.from_tensor_slices({
-        "input_ids":
-            tf.constant(
-                all_input_ids, shape=[num_examples, seq_length],
-                dtype=tf.int32),
-        "input_mask":
-            tf.constant(
-                all_input_mask,
-                shape=[num_examples, seq_length],
-                dtype=tf.int32),
-        "segment_ids":
-            tf.constant(
-                all_segment_ids,
-                shape=[num_examples, seq_length],
-                dtype=tf.int32),
-        "label_ids":
-            tf.constant(all_label_ids, shape=[num_examples], dtype=tf.int32),
+        "input_ids": features.input_ids[:num_examples],
+        "input_mask": features.input_mask[:num_examples],
+        "segment_ids": features.segment_ids[:num_examples],
+        "label_ids": features.label_ids[:num_examples],
+        "is_real_example": features.is_real_example[:num_examples],
     })
 
     if is_training:
@@ -605,28 +1126,52 @@ def convert_examples_to_features(examples, label_list, max_seq_length,
   return features
 
 
+def convert_examples_to_feature_store(examples, label_list, max_seq_length,
+                                      tokenizer):
+  """Convert a set of `InputExample`s to a `FeatureStore`.
+
+  Unlike `convert_examples_to_features`, only one example is held as Python
+  lists at a time.
+  """
+
+  store = FeatureStore(len(examples), max_seq_length,
+                       sts=len(label_list) == 0)
+  for (ex_index, example) in enumerate(examples):
+    if ex_index % 10000 == 0:
+      tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
+
+    store.append(convert_single_example(ex_index, example, label_list,
+                                        max_seq_length, tokenizer))
+  store.trim()
+  return store
+
+
+# The data processor of every task, by lowercase task name.
+processors = {
+    "cola": ColaProcessor,
+    "mnli": MnliProcessor,
+    "mrpc": MrpcProcessor,
+    "xnli": XnliProcessor,
+    "qnli": QnliProcessor,
+    "qqp": QqpProcessor,
+    "rte": RteProcessor,
+    "wnli": WnliProcessor,
+    "sst-2": Sst2Processor,
+    "mrpc": MrpcProcessor,
+    "sts-b": StsProcessor,
+}
+
+
 def main(_):
   import time
   start = time.time()
   tf.logging.set_verbosity(tf.logging.INFO)
 
+  feature_cache_dir = FLAGS.feature_cache_dir or os.path.join(
+      FLAGS.output_dir, "feature_cache")
   time_str = utils.now_to_date()
   FLAGS.output_dir = os.path.join(FLAGS.output_dir, time_str)
 
-  processors = {
-      "cola": ColaProcessor,
-      "mnli": MnliProcessor,
-      "mrpc": MrpcProcessor,
-      "xnli": XnliProcessor,
-      "qnli": QnliProcessor,
-      "qqp": QqpProcessor,
-      "rte": RteProcessor,
-      "wnli": WnliProcessor,
-      "sst-2": Sst2Processor,
-      "mrpc": MrpcProcessor,
-      "sts-b": StsProcessor,
-  }
-
   tokenization.validate_case_matches_checkpoint(FLAGS.do_lower_case,
                                                 FLAGS.init_checkpoint)
 
@@ -634,10 +1179,29 @@ def main(_):
     raise ValueError(
         "At least one of `do_train`, `do_eval` or `do_predict' must be True.")
 
+  if FLAGS.mask_only and not FLAGS.init_checkpoint:
+    raise ValueError("`mask_only` needs an `init_checkpoint`.")
+
+  if FLAGS.mask_only and FLAGS.compact_every_steps > 0:
+    raise ValueError(
+        "`compact_every_steps` rewrites the kernels, which `mask_only` "
+        "checkpoints do not hold.")
+
+  if FLAGS.pack_examples_per_row > 0 and FLAGS.dynamic_padding:
+    raise ValueError(
+        "`pack_examples_per_row` fills fixed max_seq_length rows and cannot be "
+        "combined with `dynamic_padding`.")
+
+  if FLAGS.fused_adam and FLAGS.compact_every_steps > 0:
+    raise ValueError(
+        "`compact_every_steps` slices the per-variable Adam slots, which "
+        "`fused_adam` does not have.")
+
   bert_config = modeling_flop.BertConfig.from_json_file(FLAGS.bert_config_file)
   bert_config.attention_probs_dropout_prob = FLAGS.attention_probs_dropout_prob
   bert_config.hidden_dropout_prob = FLAGS.hidden_dropout_prob
   bert_config.regularization_scale = FLAGS.regularization_scale
+  bert_config.active_gate_bound = FLAGS.active_gate_bound
 
   if FLAGS.max_seq_length > bert_config.max_position_embeddings:
     raise ValueError(
@@ -657,44 +1221,111 @@ def main(_):
   label_list = processor.get_labels()
   sts = True if len(label_list) == 0 else False
 
-  tokenizer = tokenization.FullTokenizer(
-      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+  num_conversion_workers = (FLAGS.num_conversion_workers or
+                            multiprocessing.cpu_count())
+
+  word_cache_file = None
+  if FLAGS.persist_word_cache:
+    word_cache_file = tokenization.default_word_cache_file(
+        FLAGS.vocab_file, FLAGS.do_lower_case)
+
+  def features_file(split, examples):
+    max_examples_per_row = 0
+    if split == "train":
+      max_examples_per_row = FLAGS.pack_examples_per_row
+    key = feature_cache.cache_key(
+        examples,
+        vocab_file=FLAGS.vocab_file,
+        do_lower_case=FLAGS.do_lower_case,
+        max_seq_length=FLAGS.max_seq_length,
+        task_name=task_name,
+        label_list=label_list,
+        pad_to_max_length=not FLAGS.dynamic_padding,
+        max_examples_per_row=max_examples_per_row)
+    return feature_cache.get_or_create(
+        feature_cache_dir, split, key,
+        lambda paths: sharded_convert_examples_to_features(
+            examples, label_list, FLAGS.max_seq_length, FLAGS.vocab_file,
+            FLAGS.do_lower_case, paths, num_conversion_workers,
+            pad_to_max_length=not FLAGS.dynamic_padding,
+            max_examples_per_row=max_examples_per_row,
+            word_cache_file=word_cache_file),
+        num_shards=FLAGS.num_feature_shards)
 
   train_examples = None
   num_train_steps = None
   num_warmup_steps = None
   if FLAGS.do_train:
     train_examples = processor.get_train_examples(FLAGS.data_dir)
+    train_file = features_file("train", train_examples)
+    num_train_rows = len(train_examples)
+    if FLAGS.pack_examples_per_row > 0:
+      num_train_rows = count_records(train_file)
     num_train_steps = int(
-        len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+        num_train_rows / FLAGS.train_batch_size * FLAGS.num_train_epochs)
     num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
-  model_fn = model_fn_builder(
-      bert_config=bert_config,
-      num_labels=len(label_list),
-      init_checkpoint=FLAGS.init_checkpoint,
-      learning_rate=FLAGS.learning_rate,
-      num_train_steps=num_train_steps,
-      num_warmup_steps=num_warmup_steps,
-      learning_rate_warmup=FLAGS.learning_rate_warmup,
-      lambda_learning_rate=FLAGS.lambda_learning_rate,
-      alpha_learning_rate=FLAGS.alpha_learning_rate,
-      target_sparsity=FLAGS.target_sparsity,
-      target_sparsity_warmup=FLAGS.target_sparsity_warmup)
 
   run_config = tf.estimator.RunConfig(
     model_dir=FLAGS.output_dir,
     save_summary_steps=10,
     save_checkpoints_steps=FLAGS.save_checkpoints_steps)
-  estimator = tf.estimator.Estimator(
-    model_fn=model_fn,
-    config=run_config)
+
+  hyperparams = ["batch_size=%d" % FLAGS.train_batch_size,
+                 "epochs=%.2f" % FLAGS.num_train_epochs,
+                 "warmup_proportion=%.2f" % FLAGS.warmup_proportion,
+                 "init_lr=%s" % "{:.2E}".format(FLAGS.learning_rate),
+                 "lambda_lr=%s" % "{:.2E}".format(FLAGS.lambda_learning_rate),
+                 "alpha_lr=%s" % "{:.2E}".format(FLAGS.alpha_learning_rate),
+                 "lr_warmup=%d" % FLAGS.learning_rate_warmup,
+                 "target_sparsity=%.2f" % FLAGS.target_sparsity,
+                 "target_sparsity_warmup=%d" % FLAGS.target_sparsity_warmup,
+                 "hidden_dropout_prob=%.2f" % FLAGS.hidden_dropout_prob,
+                 "attention_probs_dropout_prob=%.2f" % FLAGS.attention_probs_dropout_prob,
+                 "regularization_scale=%s" % "{:.2E}".format(FLAGS.regularization_scale)]
+
+  def build_estimator(prunable_parameters=None,
+                      init_checkpoint=FLAGS.init_checkpoint):
+    model_fn = model_fn_builder(
+        bert_config=bert_config,
+        num_labels=len(label_list),
+        init_checkpoint=init_checkpoint,
+        learning_rate=FLAGS.learning_rate,
+        num_train_steps=num_train_steps,
+        num_warmup_steps=num_warmup_steps,
+        learning_rate_warmup=FLAGS.learning_rate_warmup,
+        lambda_learning_rate=FLAGS.lambda_learning_rate,
+        alpha_learning_rate=FLAGS.alpha_learning_rate,
+        target_sparsity=FLAGS.target_sparsity,
+        target_sparsity_warmup=FLAGS.target_sparsity_warmup,
+        prunable_parameters=prunable_parameters,
+        factorized=FLAGS.factorized,
+        freeze_eval_masks=FLAGS.freeze_eval_masks,
+        mask_only=FLAGS.mask_only,
+        fused_adam=FLAGS.fused_adam,
+        hyperparams=hyperparams)
+    return tf.estimator.Estimator(
+      model_fn=model_fn,
+      config=run_config)
+
+  estimator = build_estimator()
+
+  # The dev features are shared by the in-training and the final evaluation.
+  eval_examples = None
+  eval_file = None
+  if FLAGS.do_train or FLAGS.do_eval:
+    eval_examples = processor.get_dev_examples(FLAGS.data_dir)
+    eval_file = features_file("dev", eval_examples)
+
+  bucket_boundaries = None
+  if FLAGS.dynamic_padding and FLAGS.length_bucket_width > 0:
+    bucket_boundaries = length_bucket_boundaries(
+        FLAGS.max_seq_length, FLAGS.length_bucket_width)
+
   train_time = 0
   if FLAGS.do_train:
-    train_file = os.path.join(FLAGS.output_dir, "train.tf_record")
-    file_based_convert_examples_to_features(
-        train_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file)
     tf.logging.info("***** Running training *****")
     tf.logging.info("  Num examples = %d", len(train_examples))
+    tf.logging.info("  Num rows = %d", num_train_rows)
     tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
     tf.logging.info("  Num steps = %d", num_train_steps)
     train_input_fn = file_based_input_fn_builder(
@@ -703,43 +1334,72 @@ def main(_):
         is_training=True,
         drop_remainder=True,
         sts=sts,
-        batch_size=FLAGS.train_batch_size)
-    eval_examples = processor.get_dev_examples(FLAGS.data_dir)
-    eval_file = os.path.join(FLAGS.output_dir, "eval.tf_record")
-    file_based_convert_examples_to_features(
-        eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file)
+        batch_size=FLAGS.train_batch_size,
+        shuffle_buffer_size=FLAGS.shuffle_buffer_size,
+        dynamic_padding=FLAGS.dynamic_padding,
+        bucket_boundaries=bucket_boundaries,
+        max_examples_per_row=FLAGS.pack_examples_per_row)
     eval_input_fn = file_based_input_fn_builder(
         input_file=eval_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
         drop_remainder=False,
         sts=sts,
-        batch_size=FLAGS.eval_batch_size)
+        batch_size=FLAGS.eval_batch_size,
+        dynamic_padding=FLAGS.dynamic_padding)
+    train_hooks = []
+    step_timer = None
+    if FLAGS.profile_input_batches > 0:
+      input_time = profiling.time_input_fn(
+          train_input_fn, FLAGS.profile_input_batches)
+      step_timer = profiling.StepTimerHook()
+      train_hooks.append(step_timer)
+    compaction_hook = None
+    if FLAGS.compact_every_steps > 0 and not FLAGS.factorized:
+      compaction_hook = compaction.CompactionHook(
+          every_n_steps=FLAGS.compact_every_steps,
+          log_alpha_threshold=FLAGS.compact_log_alpha_threshold,
+          patience=FLAGS.compact_patience,
+          min_dims=FLAGS.compact_min_dims)
+      train_hooks.append(compaction_hook)
     train_spec = tf.estimator.TrainSpec(
         input_fn=train_input_fn,
-        max_steps=num_train_steps
+        max_steps=num_train_steps,
+        hooks=train_hooks
     )
     eval_spec = tf.estimator.EvalSpec(
         input_fn=eval_input_fn,
         steps=None,
         throttle_secs=1
     )
-    tf.estimator.train_and_evaluate(
-        estimator,
-        train_spec,
-        eval_spec)
+    while True:
+      tf.estimator.train_and_evaluate(
+          estimator,
+          train_spec,
+          eval_spec)
+      if compaction_hook is None or not compaction_hook.dead_indices:
+        break
+      # Shrink the dead dimensions out of the checkpoint and rebuild the graph
+      # with the smaller widths before resuming.
+      state = compaction.compact_checkpoint(
+          FLAGS.output_dir, compaction_hook.dead_indices)
+      # Factorized layers may already be narrower than the default widths.
+      masked_layers_dim = dict(bert_config.masked_layers_dim)
+      masked_layers_dim.update(state["masked_layers_dim"])
+      bert_config.masked_layers_dim = masked_layers_dim
+      # The compacted checkpoint in `output_dir` is restored instead of the
+      # full width `init_checkpoint`, whose kernels no longer fit the graph.
+      estimator = build_estimator(state["prunable_parameters"],
+                                  init_checkpoint=None)
+    if step_timer is not None and step_timer.mean_step_time():
+      profiling.log_input_bound(input_time, step_timer.mean_step_time())
     
     train_time = (time.time() - start) / 60
     start = time.time()
   
   if FLAGS.do_eval:
-    eval_examples = processor.get_dev_examples(FLAGS.data_dir)
     num_actual_eval_examples = len(eval_examples)
 
-    eval_file = os.path.join(FLAGS.output_dir, "eval.tf_record")
-    file_based_convert_examples_to_features(
-        eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file)
-
     tf.logging.info("***** Running evaluation *****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
                     len(eval_examples), num_actual_eval_examples,
@@ -755,7 +1415,8 @@ def main(_):
         is_training=False,
         drop_remainder=False,
         sts=sts,
-        batch_size=FLAGS.train_batch_size)
+        batch_size=FLAGS.train_batch_size,
+        dynamic_padding=FLAGS.dynamic_padding)
 
     result = estimator.evaluate(input_fn=eval_input_fn, steps=eval_steps)
 
@@ -775,12 +1436,9 @@ def main(_):
 
   if FLAGS.do_predict:
     predict_examples = processor.get_test_examples(FLAGS.data_dir)
-    num_actual_predict_examples = len(predict_examples)
-
-    predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
-    file_based_convert_examples_to_features(predict_examples, label_list,
-                                            FLAGS.max_seq_length, tokenizer,
-                                            predict_file)
+    predict_file = features_file("test", predict_examples)
+    # `len()` of a streamed set may overcount the rows it skips.
+    num_actual_predict_examples = count_records(predict_file)
 
     tf.logging.info("***** Running prediction*****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
@@ -794,7 +1452,8 @@ def main(_):
         is_training=False,
         drop_remainder=False,
         sts=sts,
-        batch_size=FLAGS.train_batch_size)
+        batch_size=FLAGS.train_batch_size,
+        dynamic_padding=FLAGS.dynamic_padding)
 
     result = estimator.predict(input_fn=predict_input_fn)
 
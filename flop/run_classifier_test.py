@@ -0,0 +1,115 @@
+"""Tests of the in-memory features of run_classifier."""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../bert"))
+import numpy as np
+import tensorflow as tf
+import run_classifier
+import tokenization
+
+
+class FeatureStoreTest(tf.test.TestCase):
+
+    def make_features(self, labels, seq_length=4):
+        """Returns padded `InputFeatures` with one label per example."""
+        features = []
+        for i, label in enumerate(labels):
+            features.append(run_classifier.InputFeatures(
+                input_ids=[i + 1] * 2 + [0] * (seq_length - 2),
+                input_mask=[1] * 2 + [0] * (seq_length - 2),
+                segment_ids=[0, 1] + [0] * (seq_length - 2),
+                label_id=label,
+                is_real_example=i != len(labels) - 1))
+        return features
+
+    def read_input_fn(self, features, seq_length, batch_size):
+        """Returns every batch of an eval `input_fn_builder` dataset."""
+        with tf.Graph().as_default():
+            input_fn = run_classifier.input_fn_builder(
+                features, seq_length, is_training=False, drop_remainder=False)
+            dataset = input_fn({"batch_size": batch_size})
+            dtypes = dict((name, dtype.as_numpy_dtype) for name, dtype
+                          in dataset.output_types.items())
+            next_batch = dataset.make_one_shot_iterator().get_next()
+            batches = []
+            with tf.Session() as sess:
+                while True:
+                    try:
+                        batches.append(sess.run(next_batch))
+                    except tf.errors.OutOfRangeError:
+                        break
+        return dtypes, batches
+
+    def assertBatchesMatch(self, batches, features):
+        """Checks that `batches` hold `features` in order."""
+        for name, attr in [("input_ids", "input_ids"),
+                           ("input_mask", "input_mask"),
+                           ("segment_ids", "segment_ids"),
+                           ("label_ids", "label_id")]:
+            values = np.concatenate([batch[name] for batch in batches])
+            self.assertAllClose(
+                values, np.array([getattr(f, attr) for f in features]))
+        is_real = np.concatenate([batch["is_real_example"]
+                                  for batch in batches])
+        self.assertAllEqual(is_real,
+                            [int(f.is_real_example) for f in features])
+
+    def test_list_round_trip(self):
+        features = self.make_features([1, 0, 2])
+        dtypes, batches = self.read_input_fn(features, 4, batch_size=2)
+        self.assertEqual(dtypes, {"input_ids": np.int32,
+                                  "input_mask": np.int32,
+                                  "segment_ids": np.int32,
+                                  "label_ids": np.int32,
+                                  "is_real_example": np.int32})
+        self.assertEqual([len(batch["label_ids"]) for batch in batches],
+                         [2, 1])
+        self.assertBatchesMatch(batches, features)
+
+    def test_sts_float_labels(self):
+        features = self.make_features([0.5, 3.25, 4.75])
+        store = run_classifier.FeatureStore.from_features(features, 4)
+        self.assertEqual(store.label_ids.dtype, np.float32)
+        self.assertAllClose(store[1].label_id, 3.25)
+        dtypes, batches = self.read_input_fn(features, 4, batch_size=8)
+        self.assertEqual(dtypes["label_ids"], np.float32)
+        self.assertBatchesMatch(batches, features)
+
+    def test_input_fn_keeps_store(self):
+        features = self.make_features([1, 0, 1])
+        store = run_classifier.FeatureStore(8, 4)
+        for feature in features:
+            store.append(feature)
+        _, batches = self.read_input_fn(store, 4, batch_size=8)
+        self.assertBatchesMatch(batches, features)
+        # The unused rows are neither read nor dropped from the store.
+        self.assertEqual(len(store.label_ids), 8)
+        store.append(features[0])
+        self.assertEqual(len(store), 4)
+
+    def test_convert_examples_to_feature_store(self):
+        vocab_file = os.path.join(self.get_temp_dir(), "vocab.txt")
+        with open(vocab_file, "w") as writer:
+            writer.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]",
+                                    "good", "bad", "movie"]) + "\n")
+        tokenizer = tokenization.FullTokenizer(vocab_file=vocab_file)
+        examples = [
+            run_classifier.InputExample("0", "good movie", "bad", 1.5),
+            run_classifier.InputExample("1", "bad movie", None, 4.0),
+        ]
+        store = run_classifier.convert_examples_to_feature_store(
+            examples, [], 8, tokenizer)
+        features = run_classifier.convert_examples_to_features(
+            examples, [], 8, tokenizer)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(len(store.label_ids), 2)
+        self.assertEqual(store.label_ids.dtype, np.float32)
+        for i, feature in enumerate(features):
+            self.assertAllEqual(store[i].input_ids, feature.input_ids)
+            self.assertAllEqual(store[i].segment_ids, feature.segment_ids)
+            self.assertAllClose(store[i].label_id, feature.label_id)
+
+
+if __name__ == "__main__":
+    tf.test.main()